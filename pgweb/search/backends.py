@@ -0,0 +1,198 @@
+from django.conf import settings
+
+import urllib
+import psycopg2
+import json
+import socket
+import ssl
+import threading
+import time
+import logging
+
+from pgweb.search.dbpool import get_search_pool
+from pgweb.search.httppool import get_archives_pool, ArchivesPoolExhausted
+from pgweb.search.cache import get_search_cache, make_cache_key
+from pgweb.search.timing import SearchTimer
+
+log = logging.getLogger(__name__)
+
+# The two search backends: website search, which runs site_search() in
+# the search database, and list search, which is passed on to the http
+# API on the archives server. Results from both are cached, and any
+# failure is reported as a SearchBackendError carrying a message that
+# can be shown to the user.
+
+class SearchBackendError(Exception):
+	pass
+
+def _fetch_list_hits(urlstr, timer):
+	# Ask the archives server for list search hits, over one of the
+	# pooled keep-alive connections.
+	try:
+		with timer.phase('archives'):
+			(status, reason, body) = get_archives_pool().request('POST', '/archives-search/', urlstr, {'Content-type': 'application/x-www-form-urlencoded; charset=utf-8'})
+	except (socket.timeout, ssl.SSLError, ArchivesPoolExhausted):
+		raise SearchBackendError('Timeout when talking to search server. Please try your search again later, or with a more restrictive search terms.')
+	if status != 200:
+		raise SearchBackendError('Error talking to search server: %s' % reason)
+	return json.loads(body)
+
+def _fetch_site_hits(query, firsthit, hitsperpage, allsites, suburl, include_internal, headlines, timer):
+	# Website search is still done by making a regular pgsql connection
+	# to the search server, taken from the per-process pool.
+	try:
+		with timer.phase('connect'):
+			pool = get_search_pool()
+			conn = pool.getconn()
+	except Exception:
+		raise SearchBackendError('Could not connect to search database.')
+
+	# perform the query for general web search
+	broken = False
+	try:
+		with timer.phase('sitesearch'):
+			curs = conn.cursor()
+			curs.execute("SELECT * FROM site_search(%(query)s, %(firsthit)s, %(hitsperpage)s, %(allsites)s, %(suburl)s, %(internal)s, %(headlines)s)", {
+				'query': query,
+				'firsthit': firsthit - 1,
+				'hitsperpage': hitsperpage,
+				'allsites': allsites,
+				'suburl': suburl,
+				'internal': include_internal,
+				'headlines': headlines,
+				})
+			return curs.fetchall()
+	except psycopg2.ProgrammingError:
+		raise SearchBackendError('Error executing search query.')
+	except psycopg2.Error:
+		# Anything else means we can't trust the connection anymore
+		broken = True
+		raise SearchBackendError('Error talking to search database.')
+	finally:
+		pool.putconn(conn, broken)
+
+
+def search_lists(query, listsort, listnames, dateval, timer):
+	"""
+	Search the list archives. listnames is a comma separated string of
+	list names, or None for all lists. Returns the full list of hits, or
+	a dict if the query matched a messageid.
+	"""
+	p = {
+		'q': query.encode('utf-8'),
+		's': listsort,
+		}
+	if listnames:
+		p['ln'] = listnames
+	if dateval:
+		p['d'] = dateval
+	urlstr = urllib.urlencode(p)
+	# Don't casefold, since the query might be a messageid
+	with timer.phase('cache'):
+		return get_search_cache().get(
+			make_cache_key('list', query, casefold=False, ln=listnames or '', d=dateval, s=listsort),
+			lambda: _fetch_list_hits(urlstr, timer))
+
+def search_site(query, firsthit, hitsperpage, allsites, suburl, timer, headlines=True):
+	"""
+	Search the website(s). Returns the hits on the requested page as
+	rows from site_search(), followed by a row with the total number of
+	hits in the rank column. If headlines is False, the (expensive)
+	abstracts are not generated, and are returned as None.
+	"""
+	# This is kind of a hack, but... Some URLs are flagged as internal
+	# and should as such only be included in searches that explicitly
+	# reference the suburl that they are in.
+	if suburl and suburl.startswith('/docs/devel'):
+		include_internal = True
+	else:
+		include_internal = False
+
+	pagenum = (firsthit - 1) / hitsperpage + 1
+	with timer.phase('cache'):
+		return get_search_cache().get(
+			make_cache_key('site', query, allsites=allsites, suburl=suburl or '', p=pagenum, n=hitsperpage, h=headlines),
+			lambda: _fetch_site_hits(query, firsthit, hitsperpage, allsites, suburl, include_internal, headlines, timer))
+
+
+def federated_search(query, firsthit, hitsperpage, allsites, suburl, listnames, dateval, timer):
+	"""
+	Search the website and the list archives at the same time, giving
+	up on whichever is still running when SEARCH_FEDERATED_TIMEOUT has
+	passed. Returns a tuple of (sitehits, listhits, errors), where the
+	hits from a backend that failed or timed out are None, and errors is
+	a list of messages about those. The list hits are always sorted by
+	rank, since that's what the hits are merged on.
+	"""
+	results = {}
+	timers = {}
+
+	def _run(name, fn):
+		# SearchTimer isn't threadsafe, so give each backend its own
+		timers[name] = SearchTimer()
+		try:
+			results[name] = fn(timers[name])
+		except SearchBackendError, e:
+			results[name] = e
+		except Exception:
+			log.exception("Federated search of %s failed" % name)
+			results[name] = SearchBackendError('Error when searching %s.' % (name == 'site' and 'the website' or 'the mailing lists'))
+
+	threads = {
+		'site': threading.Thread(name="search site", target=_run, args=('site', lambda t: search_site(query, firsthit, hitsperpage, allsites, suburl, t))),
+		'lists': threading.Thread(name="search lists", target=_run, args=('lists', lambda t: search_lists(query, 'r', listnames, dateval, t))),
+		}
+	deadline = time.time() + settings.SEARCH_FEDERATED_TIMEOUT
+	for t in threads.values():
+		# If we give up on a backend, don't let it hold up the process
+		t.daemon = True
+		t.start()
+	for t in threads.values():
+		t.join(max(0, deadline - time.time()))
+
+	# A backend we gave up on may still finish later, so only look at
+	# the ones that are done, and leave the others alone.
+	hits = {}
+	errors = []
+	for name in ('site', 'lists'):
+		if threads[name].is_alive():
+			r = None
+		else:
+			r = results.get(name, None)
+			timer.phases.extend(timers[name].phases)
+		if r is None:
+			errors.append('Timeout when searching %s.' % (name == 'site' and 'the website' or 'the mailing lists'))
+		elif isinstance(r, SearchBackendError):
+			errors.append(r.message)
+			r = None
+		hits[name] = r
+
+	return (hits['site'], hits['lists'], errors)
+
+def merge_federated_hits(sitehits, listhits, firsthit, hitsperpage):
+	"""
+	Merge one page of website hits with the matching page of list hits
+	into a single list ordered by rank. The two backends rank on
+	different scales, so each is scaled to its own best hit first.
+	"""
+	site = [{
+			'type': 'site',
+			'title': h[3],
+			'url': "%s%s" % (h[1], h[2]),
+			'abstract': h[4].replace("[[[[[[", "<strong>").replace("]]]]]]","</strong>"),
+			'rank': h[5]} for h in (sitehits or [None])[:-1]]
+	lists = [{
+			'type': 'list',
+			'date': h['d'],
+			'subject': h['s'],
+			'author': h['f'],
+			'messageid': h['m'],
+			'abstract': h['a'],
+			'rank': h['r'],
+			} for h in (listhits or [])[firsthit-1:firsthit+hitsperpage-1]]
+
+	for l in (site, lists):
+		top = max([h['rank'] for h in l] or [0])
+		for h in l:
+			h['score'] = top and h['rank'] / top or 0
+	return sorted(site + lists, key=lambda h: h['score'], reverse=True)
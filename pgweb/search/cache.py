@@ -0,0 +1,218 @@
+from django.conf import settings
+
+from collections import OrderedDict
+import hashlib
+import os
+import re
+import threading
+import time
+
+# Conditionally import memcached library. Everything will work without
+# it, so we allow development installs to run without it...
+try:
+	import pylibmc
+	has_memcached=True
+except:
+	has_memcached=False
+
+# Two-tier cache for search results. A small LRU in each process sits in
+# front of memcached, which is shared between all the frontends. Misses
+# are computed only once: concurrent requests for the same key in this
+# process wait for the one doing the work, and a short-lived lock key in
+# memcached does the same across processes, so a popular query that just
+# expired doesn't send a whole pile of identical searches to the backend.
+
+_whitespace_re = re.compile('\s+', re.UNICODE)
+
+def canonical_query(query, casefold=True):
+	# Full text search ignores case and whitespace, so there is no need
+	# to cache them separately. Searches that might be for something
+	# case sensitive (like a messageid) must set casefold=False.
+	q = _whitespace_re.sub(' ', query.strip())
+	if casefold:
+		q = q.lower()
+	return q
+
+def make_cache_key(kind, query, casefold=True, **params):
+	"""
+	Build a memcached safe key for a search of type kind, using the
+	normalized query text and any other parameters that influence the
+	result (suburl, allsites, page and so on).
+	"""
+	parts = [kind, canonical_query(query, casefold)]
+	parts.extend([u'%s=%s' % (k, params[k]) for k in sorted(params.keys())])
+	return 'pgsearch:%s:%s' % (kind, hashlib.sha1(u'\x00'.join(parts).encode('utf8')).hexdigest())
+
+
+class _Flight(object):
+	def __init__(self):
+		self.event = threading.Event()
+		self.value = None
+		self.failed = False
+
+class SearchResultCache(object):
+	def __init__(self, servers, lrusize=500, lruttl=60, ttl=600, locktimeout=10):
+		self.servers = servers
+		self.lrusize = lrusize
+		self.lruttl = lruttl
+		self.ttl = ttl
+		self.locktimeout = locktimeout
+
+		self._lock = threading.Lock()
+		self._lru = OrderedDict()
+		self._inflight = {}
+		# pylibmc clients must not be shared between threads
+		self._local = threading.local()
+
+		self.counters = {
+			'lruhits': 0,
+			'memchits': 0,
+			'misses': 0,
+			'coalesced': 0,
+			'lockwaits': 0,
+			'memcerrors': 0,
+		}
+
+	def _count(self, what):
+		with self._lock:
+			self.counters[what] += 1
+
+	def _memc(self):
+		if not has_memcached or not self.servers:
+			return None
+		if not hasattr(self._local, 'memc'):
+			self._local.memc = pylibmc.Client(self.servers, binary=True)
+		return self._local.memc
+
+	def _lru_get(self, key):
+		with self._lock:
+			e = self._lru.pop(key, None)
+			if e is None:
+				return None
+			if e[0] < time.time():
+				return None
+			# Re-insert to mark as most recently used
+			self._lru[key] = e
+			return e[1]
+
+	def _lru_put(self, key, value):
+		with self._lock:
+			self._lru.pop(key, None)
+			self._lru[key] = (time.time() + self.lruttl, value)
+			while len(self._lru) > self.lrusize:
+				self._lru.popitem(last=False)
+
+	def _memc_call(self, fn, *args):
+		memc = self._memc()
+		if memc is None:
+			return None
+		try:
+			return getattr(memc, fn)(*args)
+		except Exception:
+			self._count('memcerrors')
+			return None
+
+	def get(self, key, compute, ttl=None):
+		"""
+		Return the cached value for key, or call compute() to generate
+		it. Exceptions from compute() are passed on to the caller, and the
+		result is then not cached.
+		"""
+		v = self._lru_get(key)
+		if v is not None:
+			self._count('lruhits')
+			return v
+
+		with self._lock:
+			flight = self._inflight.get(key)
+			if flight is None:
+				flight = self._inflight[key] = _Flight()
+				leader = True
+			else:
+				leader = False
+
+		if not leader:
+			# Somebody in this process is already working on it
+			flight.event.wait(self.locktimeout)
+			if flight.event.is_set() and not flight.failed:
+				self._count('coalesced')
+				return flight.value
+			# The leader failed or took too long, so do it ourselves
+			self._count('misses')
+			return compute()
+
+		try:
+			flight.value = self._get_shared(key, compute, ttl or self.ttl)
+			self._lru_put(key, flight.value)
+			return flight.value
+		except:
+			flight.failed = True
+			raise
+		finally:
+			with self._lock:
+				del self._inflight[key]
+			flight.event.set()
+
+	def _get_shared(self, key, compute, ttl):
+		v = self._memc_call('get', key)
+		if v is not None:
+			self._count('memchits')
+			return v
+
+		lockkey = key + ':lock'
+		locked = True
+		if self._memc() is not None:
+			try:
+				locked = self._memc().add(lockkey, 1, self.locktimeout)
+			except Exception:
+				# Can't talk to memcached, so just run the search
+				self._count('memcerrors')
+		if not locked:
+			# Another process is running this search. Wait for it to show
+			# up in memcached, but don't wait forever.
+			self._count('lockwaits')
+			giveup = time.time() + self.locktimeout
+			while time.time() < giveup:
+				time.sleep(0.05)
+				v = self._memc_call('get', key)
+				if v is not None:
+					self._count('memchits')
+					return v
+
+		self._count('misses')
+		try:
+			v = compute()
+			# Always compress it, just because we can
+			self._memc_call('set', key, v, ttl, 1)
+			return v
+		finally:
+			if locked:
+				self._memc_call('delete', lockkey)
+
+	def stats(self):
+		with self._lock:
+			s = dict(self.counters)
+			s['lrusize'] = len(self._lru)
+		lookups = s['lruhits'] + s['memchits'] + s['coalesced'] + s['misses']
+		if lookups:
+			s['hitratio'] = float(lookups - s['misses']) / lookups
+			s['lruhitratio'] = float(s['lruhits']) / lookups
+		else:
+			s['hitratio'] = s['lruhitratio'] = 0.0
+		return s
+
+
+_cache = None
+_cachepid = None
+_cachelock = threading.Lock()
+
+def get_search_cache():
+	global _cache, _cachepid
+	with _cachelock:
+		if _cache is None or _cachepid != os.getpid():
+			_cache = SearchResultCache(settings.SEARCH_CACHE_SERVERS,
+									   settings.SEARCH_CACHE_LRU_SIZE,
+									   settings.SEARCH_CACHE_LRU_TTL,
+									   settings.SEARCH_CACHE_TTL)
+			_cachepid = os.getpid()
+		return _cache
@@ -0,0 +1,170 @@
+from django.conf import settings
+
+import os
+import threading
+import time
+import psycopg2
+import psycopg2.extensions
+
+# Process-wide pool of connections to the search database. Setting up
+# a new backend (including authentication) for every search costs
+# considerably more than the search itself, so we keep a number of
+# connections around and hand them out to whichever thread needs one.
+
+class SearchPoolExhausted(Exception):
+	pass
+
+class SearchConnectionPool(object):
+	def __init__(self, dsn, minconn=1, maxconn=10, waittimeout=5, pingidle=60):
+		if minconn > maxconn:
+			raise ValueError("minconn can't be larger than maxconn")
+		self.dsn = dsn
+		self.minconn = minconn
+		self.maxconn = maxconn
+		self.waittimeout = waittimeout
+		self.pingidle = pingidle
+
+		self._cond = threading.Condition(threading.Lock())
+		# Idle connections, as a stack of (connection, time returned), so we
+		# reuse the most recently used one and let the others age out.
+		self._idle = []
+		self._total = 0
+
+		self.counters = {
+			'checkouts': 0,
+			'connects': 0,
+			'waits': 0,
+			'waittime': 0.0,
+			'maxwait': 0.0,
+			'timeouts': 0,
+			'healthfailures': 0,
+			'discarded': 0,
+		}
+
+		for i in range(minconn):
+			self._idle.append((self._connect(), time.time()))
+			self._total += 1
+
+	def _connect(self):
+		conn = psycopg2.connect(self.dsn)
+		# Searches are read-only, so there is no need to ever hold a
+		# transaction open on a pooled connection.
+		conn.autocommit = True
+		with self._cond:
+			self.counters['connects'] += 1
+		return conn
+
+	def _healthy(self, conn, idlesince):
+		if conn.closed:
+			return False
+		if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+			return False
+		if self.pingidle and time.time() - idlesince > self.pingidle:
+			# Connection has been sitting around for a while, so it may
+			# have been killed by a firewall or server restart. Verify it
+			# before handing it out.
+			try:
+				curs = conn.cursor()
+				curs.execute("SELECT 1")
+				curs.fetchall()
+			except psycopg2.Error:
+				return False
+		return True
+
+	def _discard(self, conn):
+		try:
+			conn.close()
+		except Exception:
+			pass
+		with self._cond:
+			self._total -= 1
+			self.counters['discarded'] += 1
+			self._cond.notify()
+
+	def getconn(self):
+		start = time.time()
+		waited = False
+		while True:
+			conn = None
+			with self._cond:
+				while not self._idle and self._total >= self.maxconn:
+					remaining = start + self.waittimeout - time.time()
+					if remaining <= 0:
+						self.counters['timeouts'] += 1
+						raise SearchPoolExhausted("No search connection available after %s seconds" % self.waittimeout)
+					waited = True
+					self._cond.wait(remaining)
+				if self._idle:
+					(conn, idlesince) = self._idle.pop()
+				else:
+					# Reserve a slot, and open the connection outside the lock
+					self._total += 1
+
+			if conn is None:
+				try:
+					conn = self._connect()
+				except Exception:
+					with self._cond:
+						self._total -= 1
+						self._cond.notify()
+					raise
+			elif not self._healthy(conn, idlesince):
+				with self._cond:
+					self.counters['healthfailures'] += 1
+				self._discard(conn)
+				continue
+
+			waittime = time.time() - start
+			with self._cond:
+				self.counters['checkouts'] += 1
+				if waited:
+					self.counters['waits'] += 1
+				self.counters['waittime'] += waittime
+				if waittime > self.counters['maxwait']:
+					self.counters['maxwait'] = waittime
+			return conn
+
+	def putconn(self, conn, broken=False):
+		if broken or conn.closed:
+			self._discard(conn)
+			return
+		with self._cond:
+			self._idle.append((conn, time.time()))
+			self._cond.notify()
+
+	def closeall(self):
+		with self._cond:
+			for conn, idlesince in self._idle:
+				try:
+					conn.close()
+				except Exception:
+					pass
+			self._total -= len(self._idle)
+			self._idle = []
+
+	def stats(self):
+		with self._cond:
+			s = dict(self.counters)
+			s['size'] = self._total
+			s['idle'] = len(self._idle)
+			s['inuse'] = self._total - len(self._idle)
+		s['avgwait'] = s['checkouts'] and s['waittime'] / s['checkouts'] or 0.0
+		return s
+
+
+_pool = None
+_poolpid = None
+_poollock = threading.Lock()
+
+def get_search_pool():
+	# The pool is created on first use rather than at import, so that
+	# connections are never inherited across a fork of the wsgi workers.
+	global _pool, _poolpid
+	with _poollock:
+		if _pool is None or _poolpid != os.getpid():
+			_pool = SearchConnectionPool(settings.SEARCH_DSN,
+										 settings.SEARCH_POOL_MINCONN,
+										 settings.SEARCH_POOL_MAXCONN,
+										 settings.SEARCH_POOL_WAITTIMEOUT)
+			_poolpid = os.getpid()
+		return _pool
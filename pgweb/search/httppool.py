@@ -0,0 +1,167 @@
+from django.conf import settings
+
+import errno
+import httplib
+import os
+import socket
+import threading
+import time
+
+# Per-process pool of keep-alive connections to the archives search
+# server. Setting up a new TCP and TLS session for every uncached list
+# search costs more than many of the searches themselves, so we hold on
+# to the connections and reuse them for as long as the server lets us.
+
+class ArchivesPoolExhausted(Exception):
+	pass
+
+# Errors that on a *reused* connection just mean that the server closed
+# it while it was sitting idle in the pool, and that it's safe to retry
+# on a fresh one.
+_STALE_ERRNOS = (errno.ECONNRESET, errno.EPIPE, errno.ECONNABORTED)
+
+class ArchivesConnectionPool(object):
+	def __init__(self, host, plaintext=False, maxconn=4, connecttimeout=5, readtimeout=20, waittimeout=5, maxidle=30):
+		self.host = host
+		self.plaintext = plaintext
+		self.maxconn = maxconn
+		self.connecttimeout = connecttimeout
+		self.readtimeout = readtimeout
+		self.waittimeout = waittimeout
+		self.maxidle = maxidle
+
+		self._cond = threading.Condition(threading.Lock())
+		self._idle = []
+		self._total = 0
+
+		self.counters = {
+			'requests': 0,
+			'connects': 0,
+			'reused': 0,
+			'stale': 0,
+			'waits': 0,
+			'waittime': 0.0,
+			'timeouts': 0,
+		}
+
+	def _connect(self):
+		if self.plaintext:
+			c = httplib.HTTPConnection(self.host, strict=True, timeout=self.connecttimeout)
+		else:
+			c = httplib.HTTPSConnection(self.host, strict=True, timeout=self.connecttimeout)
+		c.connect()
+		# Once we're connected, allow the search itself to take longer
+		c.sock.settimeout(self.readtimeout)
+		with self._cond:
+			self.counters['connects'] += 1
+		return c
+
+	def _checkout(self):
+		start = time.time()
+		with self._cond:
+			while True:
+				# Throw away anything that's been idle long enough that the
+				# server has most likely closed it already.
+				while self._idle and time.time() - self._idle[0][1] > self.maxidle:
+					self._idle.pop(0)[0].close()
+					self._total -= 1
+				if self._idle:
+					c = self._idle.pop()[0]
+					self.counters['reused'] += 1
+					reused = True
+					break
+				if self._total < self.maxconn:
+					self._total += 1
+					c = None
+					reused = False
+					break
+				remaining = start + self.waittimeout - time.time()
+				if remaining <= 0:
+					self.counters['timeouts'] += 1
+					raise ArchivesPoolExhausted("No archives search connection available after %s seconds" % self.waittimeout)
+				self.counters['waits'] += 1
+				self._cond.wait(remaining)
+			self.counters['waittime'] += time.time() - start
+
+		if c is None:
+			try:
+				c = self._connect()
+			except Exception:
+				self._release(None)
+				raise
+		return (c, reused)
+
+	def _release(self, c, reuse=False):
+		with self._cond:
+			if reuse:
+				self._idle.append((c, time.time()))
+			else:
+				if c:
+					c.close()
+				self._total -= 1
+			self._cond.notify()
+
+	def request(self, method, url, body=None, headers={}):
+		"""
+		Perform a request on a pooled connection, and return a tuple of
+		(status, reason, body). The body is always read completely, so the
+		connection can be handed back to the pool.
+		"""
+		with self._cond:
+			self.counters['requests'] += 1
+
+		for attempt in (1, 2):
+			(c, reused) = self._checkout()
+			try:
+				c.request(method, url, body, headers)
+				r = c.getresponse()
+				data = r.read()
+			except (httplib.BadStatusLine, httplib.CannotSendRequest, httplib.ResponseNotReady):
+				self._release(c)
+				if reused and attempt == 1:
+					with self._cond:
+						self.counters['stale'] += 1
+					continue
+				raise
+			except socket.timeout:
+				self._release(c)
+				raise
+			except socket.error, e:
+				self._release(c)
+				if reused and attempt == 1 and e.errno in _STALE_ERRNOS:
+					with self._cond:
+						self.counters['stale'] += 1
+					continue
+				raise
+			except Exception:
+				self._release(c)
+				raise
+
+			self._release(c, reuse=not r.will_close)
+			return (r.status, r.reason, data)
+
+	def stats(self):
+		with self._cond:
+			s = dict(self.counters)
+			s['size'] = self._total
+			s['idle'] = len(self._idle)
+		return s
+
+
+_pool = None
+_poolpid = None
+_poollock = threading.Lock()
+
+def get_archives_pool():
+	# Created on first use, and re-created in a forked worker, so sockets
+	# are never shared between processes.
+	global _pool, _poolpid
+	with _poollock:
+		if _pool is None or _poolpid != os.getpid():
+			_pool = ArchivesConnectionPool(settings.ARCHIVES_SEARCH_SERVER,
+										   settings.ARCHIVES_SEARCH_PLAINTEXT,
+										   settings.ARCHIVES_SEARCH_POOL_MAXCONN,
+										   settings.ARCHIVES_SEARCH_CONNECT_TIMEOUT,
+										   settings.ARCHIVES_SEARCH_READ_TIMEOUT)
+			_poolpid = os.getpid()
+		return _pool
@@ -0,0 +1,153 @@
+from django.conf import settings
+
+from bisect import bisect_left
+import heapq
+import os
+import threading
+import time
+
+from pgweb.search.dbpool import get_search_pool
+
+# Search-as-you-type suggestions. The crawlers collect page titles and
+# list subjects into the suggestions table in the search database, and
+# each web worker keeps all of it in memory as a sorted list of keys, so
+# a lookup is just a binary search and never has to touch the database.
+#
+# Every word in a title starts a key, so typing "types" finds "Data
+# Types" as well as "Types of Indexes". Results for very short prefixes
+# match so many titles that they are calculated once when loading. For
+# longer prefixes that still match a lot of keys, the keys starting with
+# the same SHORT_PREFIX characters are walked in order of weight, which
+# can stop as soon as it has found enough titles.
+#
+# The index is (re)loaded in a background thread, so requests never wait
+# for it. Until the first load is done there are no suggestions.
+
+SHORT_PREFIX = 3
+# Longer prefixes matching at most this many keys just look at all of them
+SCAN_LIMIT = 500
+
+class SuggestionIndex(object):
+	def __init__(self, rows, maxresults=10):
+		self.maxresults = maxresults
+		self.titles = []
+		entries = []
+		for title, url, weight in rows:
+			if isinstance(title, str):
+				title = title.decode('utf8')
+			idx = len(self.titles)
+			self.titles.append((title, url, weight))
+			words = title.lower().split()
+			for i in range(len(words)):
+				# Matches on the start of the title rank above matches on
+				# a later word.
+				entries.append((u" ".join(words[i:]), idx, i == 0 and weight + 1 or weight))
+		entries.sort()
+		self.keys = [e[0] for e in entries]
+		self.entries = [(e[1], e[2]) for e in entries]
+
+		self.short = {}
+		for k in set([key[:l] for key in self.keys for l in range(1, SHORT_PREFIX+1)]):
+			self.short[k] = self._scan(self._range(k), maxresults)
+
+		# Positions of the keys longer than SHORT_PREFIX, grouped on their
+		# first SHORT_PREFIX characters and ordered by weight
+		self.byweight = {}
+		for pos in range(len(self.keys)):
+			if len(self.keys[pos]) > SHORT_PREFIX:
+				self.byweight.setdefault(self.keys[pos][:SHORT_PREFIX], []).append(pos)
+		for l in self.byweight.values():
+			l.sort(key=lambda pos: self.entries[pos][1], reverse=True)
+
+	def _range(self, prefix):
+		lo = bisect_left(self.keys, prefix)
+		return (lo, bisect_left(self.keys, prefix + u'\uffff', lo))
+
+	def _scan(self, (lo, hi), n):
+		best = {}
+		for idx, weight in self.entries[lo:hi]:
+			if weight > best.get(idx, -1):
+				best[idx] = weight
+		return [self.titles[idx][:2] for idx, weight in heapq.nlargest(n, best.items(), key=lambda x: x[1])]
+
+	def _scan_byweight(self, prefix, n):
+		# The first time a title shows up is with its highest weight
+		found = []
+		for pos in self.byweight.get(prefix[:SHORT_PREFIX], []):
+			if self.keys[pos].startswith(prefix):
+				idx = self.entries[pos][0]
+				if not idx in found:
+					found.append(idx)
+					if len(found) == n:
+						break
+		return [self.titles[idx][:2] for idx in found]
+
+	def lookup(self, prefix, n=None):
+		prefix = u" ".join(prefix.lower().split())
+		n = min(n or self.maxresults, self.maxresults)
+		if not prefix:
+			return []
+		if len(prefix) <= SHORT_PREFIX:
+			return self.short.get(prefix, [])[:n]
+		(lo, hi) = self._range(prefix)
+		if hi - lo <= SCAN_LIMIT:
+			return self._scan((lo, hi), n)
+		return self._scan_byweight(prefix, n)
+
+
+_index = None
+_loadedat = 0
+_loadedpid = None
+_loading = threading.Lock()
+
+def _load_index():
+	pool = get_search_pool()
+	conn = pool.getconn()
+	broken = False
+	try:
+		curs = conn.cursor()
+		curs.execute("SELECT title, url, weight FROM suggestions")
+		rows = curs.fetchall()
+	except Exception:
+		broken = True
+		raise
+	finally:
+		pool.putconn(conn, broken)
+	return SuggestionIndex(rows, settings.SEARCH_SUGGEST_MAXRESULTS)
+
+def _reload_index(lock):
+	global _index
+	try:
+		_index = _load_index()
+	except Exception:
+		# Don't hammer the database if it's down, just try again later
+		pass
+	finally:
+		lock.release()
+
+def get_suggestions(prefix, n=None):
+	"""
+	Return up to n (title, url) tuples for titles matching prefix. url is
+	None for list subjects, which should just be searched for.
+	"""
+	global _loadedat, _loadedpid, _loading
+
+	if _loadedpid != os.getpid():
+		# Forked since the last load, and a thread loading the index in
+		# the parent doesn't exist here
+		_loadedpid = os.getpid()
+		_loadedat = 0
+		_loading = threading.Lock()
+
+	if time.time() - _loadedat > (_index is None and 60 or settings.SEARCH_SUGGEST_REFRESH):
+		# Only one thread starts a reload, and everybody keeps using the
+		# old index (if there is one) until it's done.
+		if _loading.acquire(False):
+			_loadedat = time.time()
+			t = threading.Thread(name="suggestions", target=_reload_index, args=(_loading, ))
+			t.daemon = True
+			t.start()
+
+	if _index is None:
+		return []
+	return _index.lookup(prefix, n)
@@ -0,0 +1,119 @@
+from django.conf import settings
+
+from collections import deque
+from contextlib import contextmanager
+from functools import wraps
+import json
+import random
+import threading
+import time
+
+import logging
+log = logging.getLogger(__name__)
+
+# Per-phase timing of searches. Every search gets a SearchTimer attached
+# to the request, and the parts of the search (connecting, running the
+# query, talking to the archives server, cache lookups, rendering) are
+# wrapped in phases. The result is sent back in a Server-Timing header,
+# a sample of the searches are logged, and the latest timings are kept
+# in memory so they can be looked at through the admin interface.
+#
+# Phases can be nested. The time reported for a phase does not include
+# the time spent in the phases inside it, so that the numbers add up.
+
+_histlock = threading.Lock()
+_histograms = {}
+
+class SearchTimer(object):
+	def __init__(self):
+		self.start = time.time()
+		self.phases = []
+		self._stack = []
+
+	@contextmanager
+	def phase(self, name):
+		self._stack.append(0.0)
+		t = time.time()
+		try:
+			yield
+		finally:
+			elapsed = time.time() - t
+			children = self._stack.pop()
+			if self._stack:
+				self._stack[-1] += elapsed
+			self.phases.append((name, elapsed - children))
+
+	def totals(self):
+		# The same phase can run more than once (e.g. on retries), so
+		# sum them up, but keep the order they first showed up in.
+		t = {}
+		order = []
+		for name, elapsed in self.phases:
+			if not name in t:
+				order.append(name)
+				t[name] = 0.0
+			t[name] += elapsed
+		return [(name, t[name]) for name in order]
+
+	def server_timing_header(self, total):
+		return ", ".join(['%s;dur=%.1f' % (name, elapsed * 1000) for name, elapsed in self.totals() + [('total', total)]])
+
+	def finish(self, request, response):
+		total = time.time() - self.start
+		response['Server-Timing'] = self.server_timing_header(total)
+
+		phases = self.totals() + [('total', total)]
+		with _histlock:
+			for name, elapsed in phases:
+				if not name in _histograms:
+					_histograms[name] = deque(maxlen=settings.SEARCH_TIMING_WINDOW)
+				_histograms[name].append(elapsed)
+
+		if random.random() < settings.SEARCH_TIMING_LOG_SAMPLE:
+			log.info(json.dumps({
+				'path': request.path,
+				'query': request.GET.get('q', ''),
+				'lists': request.GET.get('m', '') == '1',
+				'status': response.status_code,
+				'phases': dict([(name, round(elapsed * 1000, 1)) for name, elapsed in phases]),
+			}))
+
+
+def timed_search(fn):
+	"""
+	Attach a SearchTimer to the request as request.searchtimer, and report
+	the collected timings once the view returns.
+	"""
+	@wraps(fn)
+	def _timed_search(request, *_args, **_kwargs):
+		request.searchtimer = SearchTimer()
+		resp = fn(request, *_args, **_kwargs)
+		request.searchtimer.finish(request, resp)
+		return resp
+	return _timed_search
+
+
+def _percentile(sortedvals, p):
+	return sortedvals[min(len(sortedvals) - 1, int(len(sortedvals) * p))]
+
+def get_timing_stats():
+	"""
+	Return count, average and percentiles (in milliseconds) for each
+	phase, over the most recent searches in this process.
+	"""
+	with _histlock:
+		snapshot = dict([(name, sorted(vals)) for name, vals in _histograms.items()])
+
+	stats = {}
+	for name, vals in snapshot.items():
+		if not vals:
+			continue
+		stats[name] = {
+			'count': len(vals),
+			'avg': round(sum(vals) * 1000 / len(vals), 1),
+			'p50': round(_percentile(vals, 0.50) * 1000, 1),
+			'p90': round(_percentile(vals, 0.90) * 1000, 1),
+			'p99': round(_percentile(vals, 0.99) * 1000, 1),
+			'max': round(vals[-1] * 1000, 1),
+		}
+	return stats
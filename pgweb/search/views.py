@@ -1,26 +1,24 @@
 from django.shortcuts import render
-from django.http import HttpResponseRedirect
+from django.http import HttpResponse, HttpResponseRedirect, HttpResponseNotModified
+from django.contrib.auth.decorators import user_passes_test
 from django.views.decorators.csrf import csrf_exempt
 from django.conf import settings
 
-from pgweb.util.decorators import cache
+from pgweb.util.decorators import cache, login_required
 
-import httplib
 import urllib
-import psycopg2
 import json
-import socket
-import ssl
+import hashlib
 
 from pgweb.lists.models import MailingList
+from pgweb.search.dbpool import get_search_pool
+from pgweb.search.httppool import get_archives_pool
+from pgweb.search.cache import get_search_cache
+from pgweb.search.timing import timed_search, get_timing_stats
+from pgweb.search.backends import search_lists, search_site, SearchBackendError
+from pgweb.search.backends import federated_search, merge_federated_hits
+from pgweb.search.suggest import get_suggestions
 
-# Conditionally import memcached library. Everything will work without
-# it, so we allow development installs to run without it...
-try:
-	import pylibmc
-	has_memcached=True
-except:
-	has_memcached=False
 
 def generate_pagelinks(pagenum, totalpages, querystring):
 	# Generate a list of links to page through a search result
@@ -50,6 +48,7 @@ def generate_pagelinks(pagenum, totalpages, querystring):
 
 @csrf_exempt
 @cache(minutes=15)
+@timed_search
 def search(request):
 	# Perform a general web search
 	# Since this lives in a different database, we open a direct
@@ -126,6 +125,20 @@ def search(request):
 		else:
 			allsites = False
 
+		# Federated mode includes hits from the mailing lists as well,
+		# optionally limited to a list (or list group) and a date range
+		# the same way as list search. They're always sorted by rank.
+		federated = settings.SEARCH_FEDERATED and request.GET.get('f', '') == '1'
+		if federated:
+			try:
+				listid = int(request.GET.get('l', ''))
+			except ValueError:
+				listid = None
+			try:
+				dateval = int(request.GET.get('d', 365)) or 365
+			except ValueError:
+				dateval = 365
+
 	# Check that we actually have something to search for
 	if not request.GET.has_key('q') or request.GET['q'] == '':
 		if searchlists:
@@ -164,54 +177,20 @@ def search(request):
 		# Lists are searched by passing the work down using a http
 		# API. In the future, we probably want to do everything
 		# through a http API and merge hits, but that's for later
-		p = {
-			'q': query.encode('utf-8'),
-			's': listsort,
-			}
 		if listid:
 			if listid < 0:
 				# This is a list group, we expand that on the web server
-				p['ln'] = ','.join([x.listname for x in MailingList.objects.filter(group=-listid)])
+				listnames = ','.join([x.listname for x in MailingList.objects.filter(group=-listid)])
 			else:
-				p['ln'] = MailingList.objects.get(pk=listid).listname
-		if dateval:
-			p['d'] = dateval
-		urlstr = urllib.urlencode(p)
-		# If memcached is available, let's try it
-		hits = None
-		if has_memcached:
-			memc = pylibmc.Client(['127.0.0.1',], binary=True)
-			# behavior not supported on pylibmc in squeeze:: behaviors={'tcp_nodelay':True})
-			try:
-				hits = memc.get(urlstr)
-			except Exception:
-				# If we had an exception, don't try to store either
-				memc = None
-		if not hits:
-			# No hits found - so try to get them from the search server
-			if settings.ARCHIVES_SEARCH_PLAINTEXT:
-				c = httplib.HTTPConnection(settings.ARCHIVES_SEARCH_SERVER, strict=True, timeout=5)
-			else:
-				c = httplib.HTTPSConnection(settings.ARCHIVES_SEARCH_SERVER, strict=True, timeout=5)
-			c.request('POST', '/archives-search/', urlstr, {'Content-type': 'application/x-www-form-urlencoded; charset=utf-8'})
-			c.sock.settimeout(20) # Set a 20 second timeout
-			try:
-				r = c.getresponse()
-			except (socket.timeout, ssl.SSLError):
-				return render(request, 'search/listsearch.html', {
-						'search_error': 'Timeout when talking to search server. Please try your search again later, or with a more restrictive search terms.',
-						})
-			if r.status != 200:
-				memc = None
-				return render(request, 'search/listsearch.html', {
-						'search_error': 'Error talking to search server: %s' % r.reason,
-						})
-			hits = json.loads(r.read())
-			if has_memcached and memc:
-				# Store them in memcached too! But only for 10 minutes...
-				# And always compress it, just because we can
-				memc.set(urlstr, hits, 60*10, 1)
-				memc = None
+				listnames = MailingList.objects.get(pk=listid).listname
+		else:
+			listnames = None
+		try:
+			hits = search_lists(query, listsort, listnames, dateval, request.searchtimer)
+		except SearchBackendError, e:
+			return render(request, 'search/listsearch.html', {
+					'search_error': e.message,
+					})
 
 		if isinstance(hits, dict):
 			# This is not just a list of hits.
@@ -228,66 +207,92 @@ def search(request):
 			listsort
 			)
 
-		return render(request, 'search/listsearch.html', {
-				'hitcount': totalhits,
-				'firsthit': firsthit,
-				'lasthit': min(totalhits, firsthit+hitsperpage-1),
-				'query': request.GET['q'],
-				'pagelinks': "&nbsp;".join(
-					generate_pagelinks(pagenum,
-									   totalhits / hitsperpage + 1,
-									   querystr)),
-				'hits': [{
-						'date': h['d'],
-						'subject': h['s'],
-						'author': h['f'],
-						'messageid': h['m'],
-						'abstract': h['a'],
-						'rank': h['r'],
-						} for h in hits[firsthit-1:firsthit+hitsperpage-1]],
-				'sortoptions': sortoptions,
-				'lists': MailingList.objects.all().order_by("group__sortkey"),
-				'listid': listid,
-				'dates': dateoptions,
-				'dateval': dateval,
-				})
+		with request.searchtimer.phase('render'):
+			return render(request, 'search/listsearch.html', {
+					'hitcount': totalhits,
+					'firsthit': firsthit,
+					'lasthit': min(totalhits, firsthit+hitsperpage-1),
+					'query': request.GET['q'],
+					'pagelinks': "&nbsp;".join(
+						generate_pagelinks(pagenum,
+										   totalhits / hitsperpage + 1,
+										   querystr)),
+					'hits': [{
+							'date': h['d'],
+							'subject': h['s'],
+							'author': h['f'],
+							'messageid': h['m'],
+							'abstract': h['a'],
+							'rank': h['r'],
+							} for h in hits[firsthit-1:firsthit+hitsperpage-1]],
+					'sortoptions': sortoptions,
+					'lists': MailingList.objects.all().order_by("group__sortkey"),
+					'listid': listid,
+					'dates': dateoptions,
+					'dateval': dateval,
+					})
 
-	else:
-		# Website search is still done by making a regular pgsql connection
-		# to the search server.
-		try:
-			conn = psycopg2.connect(settings.SEARCH_DSN)
-			curs = conn.cursor()
-		except:
+	elif federated:
+		# Search both the website and the lists at the same time, and
+		# show whatever we got back in time.
+		listnames = None
+		if listid:
+			if listid < 0:
+				listnames = ','.join([x.listname for x in MailingList.objects.filter(group=-listid)])
+			elif MailingList.objects.filter(pk=listid).exists():
+				listnames = MailingList.objects.get(pk=listid).listname
+		(sitehits, listhits, errors) = federated_search(query, firsthit, hitsperpage, allsites, suburl, listnames, dateval, request.searchtimer)
+		if sitehits is None and listhits is None:
 			return render(request, 'search/sitesearch.html', {
-					'search_error': 'Could not connect to search database.'
+					'search_error': " ".join(errors),
 					})
+		if isinstance(listhits, dict):
+			# Same as for list search, a messageid match is the only
+			# supported dict result.
+			if listhits['messageidmatch'] == 1:
+				return HttpResponseRedirect("/message-id/%s" % query)
+			listhits = []
+
+		sitetotal = sitehits and int(sitehits[-1][5]) or 0
+		listtotal = listhits and len(listhits) or 0
+		hits = merge_federated_hits(sitehits, listhits, firsthit, hitsperpage)
+		# Each page holds one page worth of hits from each backend
+		fedfirsthit = min(sitetotal, firsthit-1) + min(listtotal, firsthit-1) + 1
+		querystr = "?q=%s&a=%s&u=%s&f=1&l=%s&d=%s" % (
+			urllib.quote_plus(query.encode('utf-8')),
+			allsites and "1" or "0",
+			suburl and urllib.quote_plus(suburl) or '',
+			listid or '',
+			dateval,
+			)
 
-		# This is kind of a hack, but... Some URLs are flagged as internal
-		# and should as such only be included in searches that explicitly
-		# reference the suburl that they are in.
-		if suburl and suburl.startswith('/docs/devel'):
-			include_internal = True
-		else:
-			include_internal = False
+		with request.searchtimer.phase('render'):
+			return render(request, 'search/sitesearch.html', {
+					'suburl': suburl,
+					'allsites': allsites,
+					'federated': True,
+					'listid': listid,
+					'dateval': dateval,
+					'partial_errors': errors,
+					'hitcount': sitetotal + listtotal,
+					'firsthit': fedfirsthit,
+					'lasthit': fedfirsthit + len(hits) - 1,
+					'query': request.GET['q'],
+					'pagelinks': "&nbsp;".join(
+						generate_pagelinks(pagenum,
+										   max(sitetotal, listtotal) / hitsperpage + 1,
+										   querystr)),
+					'hits': hits,
+					})
 
-		# perform the query for general web search
+	else:
 		try:
-			curs.execute("SELECT * FROM site_search(%(query)s, %(firsthit)s, %(hitsperpage)s, %(allsites)s, %(suburl)s, %(internal)s)", {
-				'query': query,
-				'firsthit': firsthit - 1,
-				'hitsperpage': hitsperpage,
-				'allsites': allsites,
-				'suburl': suburl,
-				'internal': include_internal,
-				})
-		except psycopg2.ProgrammingError:
+			hits = search_site(query, firsthit, hitsperpage, allsites, suburl, request.searchtimer)
+		except SearchBackendError, e:
 			return render(request, 'search/sitesearch.html', {
-					'search_error': 'Error executing search query.'
+					'search_error': e.message,
 					})
 
-		hits = curs.fetchall()
-		conn.close()
 		totalhits = int(hits[-1][5])
 		querystr = "?q=%s&a=%s&u=%s" % (
 			urllib.quote_plus(query.encode('utf-8')),
@@ -295,20 +300,134 @@ def search(request):
 			suburl and urllib.quote_plus(suburl) or '',
 			)
 
-		return render(request, 'search/sitesearch.html', {
-				'suburl': suburl,
-				'allsites': allsites,
-				'hitcount': totalhits,
-				'firsthit': firsthit,
-				'lasthit': min(totalhits, firsthit+hitsperpage-1),
-				'query': request.GET['q'],
-				'pagelinks': "&nbsp;".join(
-					generate_pagelinks(pagenum,
-									   totalhits / hitsperpage + 1,
-									   querystr)),
-				'hits': [{
-						'title': h[3],
-						'url': "%s%s" % (h[1], h[2]),
-						'abstract': h[4].replace("[[[[[[", "<strong>").replace("]]]]]]","</strong>"),
-						'rank': h[5]} for h in hits[:-1]],
-				})
+		with request.searchtimer.phase('render'):
+			return render(request, 'search/sitesearch.html', {
+					'suburl': suburl,
+					'allsites': allsites,
+					'hitcount': totalhits,
+					'firsthit': firsthit,
+					'lasthit': min(totalhits, firsthit+hitsperpage-1),
+					'query': request.GET['q'],
+					'pagelinks': "&nbsp;".join(
+						generate_pagelinks(pagenum,
+										   totalhits / hitsperpage + 1,
+										   querystr)),
+					'hits': [{
+							'title': h[3],
+							'url': "%s%s" % (h[1], h[2]),
+							'abstract': h[4].replace("[[[[[[", "<strong>").replace("]]]]]]","</strong>"),
+							'rank': h[5]} for h in hits[:-1]],
+					})
+
+
+# Fields available in the hits returned by the JSON API. Website hits
+# use the same style of short keys as the archives API already does.
+_api_fields = {
+	'site': ('t', 'u', 'a', 'r'),
+	'list': ('d', 's', 'f', 'm', 'a', 'r'),
+	}
+
+def _api_response(request, obj, status=200, maxage=0):
+	resp = HttpResponse(json.dumps(obj, separators=(',',':')), content_type='application/json', status=status)
+	if status == 200:
+		# The contents fully determine the etag, so varnish and clients
+		# can revalidate cheaply once the cache time has run out.
+		etag = '"%s"' % hashlib.sha1(resp.content).hexdigest()
+		if request.META.get('HTTP_IF_NONE_MATCH', None) == etag:
+			resp = HttpResponseNotModified()
+		resp['ETag'] = etag
+	resp['Cache-Control'] = 'max-age=%s, s-maxage=%s' % (maxage, maxage)
+	return resp
+
+# JSON version of the search, taking the same parameters as the search
+# view, plus "fields" to pick which fields to include in each hit (so
+# callers that don't show abstracts don't have to pay for them).
+@csrf_exempt
+@timed_search
+def api_search(request):
+	hitsperpage = 20
+
+	query = request.GET.get('q', '').strip()
+	if query == '':
+		return _api_response(request, {'error': 'No search term specified.'}, 400)
+	if len(query) > 1000:
+		return _api_response(request, {'error': 'Search term too long.'}, 400)
+
+	try:
+		pagenum = max(1, int(request.GET.get('p', 1)))
+	except ValueError:
+		pagenum = 1
+	firsthit = (pagenum - 1) * hitsperpage + 1
+
+	searchtype = request.GET.get('m', '') == '1' and 'list' or 'site'
+	if request.GET.has_key('fields'):
+		fields = [f for f in request.GET['fields'].split(',') if f in _api_fields[searchtype]]
+	else:
+		fields = _api_fields[searchtype]
+
+	try:
+		if searchtype == 'list':
+			listnames = None
+			try:
+				listid = int(request.GET.get('l', ''))
+				if listid < 0:
+					listnames = ','.join([x.listname for x in MailingList.objects.filter(group=-listid)])
+				else:
+					listnames = MailingList.objects.get(pk=listid).listname
+			except (ValueError, MailingList.DoesNotExist):
+				if request.GET.get('ln', '') and MailingList.objects.filter(listname=request.GET['ln']).exists():
+					listnames = request.GET['ln']
+			try:
+				dateval = int(request.GET.get('d', 365)) or 365
+			except ValueError:
+				dateval = 365
+			listsort = request.GET.get('s', 'r')
+			if not listsort in ('r', 'd', 'i'):
+				listsort = 'r'
+
+			hits = search_lists(query, listsort, listnames, dateval, request.searchtimer)
+			if isinstance(hits, dict):
+				if hits['messageidmatch'] == 1:
+					return _api_response(request, {'messageid': query}, maxage=15*60)
+				hits = []
+			totalhits = len(hits)
+			pagehits = hits[firsthit-1:firsthit+hitsperpage-1]
+		else:
+			suburl = request.GET.get('u', '') or None
+			allsites = request.GET.get('a', '') == '1'
+			hits = search_site(query, firsthit, hitsperpage, allsites, suburl, request.searchtimer, 'a' in fields)
+			totalhits = int(hits[-1][5])
+			pagehits = [{
+				't': h[3],
+				'u': "%s%s" % (h[1], h[2]),
+				'a': h[4] and h[4].replace("[[[[[[", "<strong>").replace("]]]]]]","</strong>"),
+				'r': h[5],
+				} for h in hits[:-1]]
+	except SearchBackendError, e:
+		return _api_response(request, {'error': e.message}, 503)
+
+	return _api_response(request, {
+		'q': query,
+		'p': pagenum,
+		'n': totalhits,
+		'hits': [dict([(f, h[f]) for f in fields]) for h in pagehits],
+		}, maxage=15*60)
+
+
+# Search-as-you-type suggestions for titles starting with q. These only
+# change when the suggestions are reloaded, so let them be cached.
+def suggest(request):
+	q = request.GET.get('q', '')[:100]
+	return _api_response(request, [[t, u] for t, u in get_suggestions(q)], maxage=settings.SEARCH_SUGGEST_REFRESH)
+
+
+# Timing and cache statistics for searches served by this process
+@login_required
+@user_passes_test(lambda u: u.is_staff)
+def admin_searchstats(request):
+	return HttpResponse(json.dumps({
+		'timings': get_timing_stats(),
+		'cache': get_search_cache().stats(),
+		'dbpool': get_search_pool().stats(),
+		'archivespool': get_archives_pool().stats(),
+	}, indent=2, sort_keys=True), content_type='application/json')
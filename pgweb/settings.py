@@ -155,6 +155,22 @@ FTP_MASTERS=()										   # A tuple containing the *IP addresses* of all machin
 VARNISH_PURGERS=()                                     # Extra servers that can do varnish purges through our queue
 ARCHIVES_SEARCH_SERVER="archives.postgresql.org"       # Where to post REST request for archives search
 ARCHIVES_SEARCH_PLAINTEXT=False                        # Contact ARCHIVES_SEARCH_SERVER with http instead of https
+ARCHIVES_SEARCH_POOL_MAXCONN=4                         # Max keep-alive connections per process to ARCHIVES_SEARCH_SERVER
+ARCHIVES_SEARCH_CONNECT_TIMEOUT=5                      # Seconds to wait for connecting to ARCHIVES_SEARCH_SERVER
+ARCHIVES_SEARCH_READ_TIMEOUT=20                        # Seconds to wait for ARCHIVES_SEARCH_SERVER to answer a search
+SEARCH_CACHE_SERVERS=['127.0.0.1',]                    # memcached servers for caching search results, if pylibmc is available
+SEARCH_CACHE_TTL=600                                   # Seconds to keep search results in memcached
+SEARCH_CACHE_LRU_SIZE=500                              # Number of search results to also keep in memory in each process
+SEARCH_CACHE_LRU_TTL=60                                # Seconds to keep search results in memory in each process
+SEARCH_FEDERATED=True                                  # Allow searching website and lists at the same time
+SEARCH_FEDERATED_TIMEOUT=10                            # Seconds to wait for both backends in a federated search
+SEARCH_TIMING_WINDOW=1000                              # Number of recent searches per process to keep timings for
+SEARCH_TIMING_LOG_SAMPLE=0.01                          # Fraction of searches to log timings for (logger pgweb.search.timing)
+SEARCH_POOL_MINCONN=1                                  # Search database connections opened per process on first search
+SEARCH_POOL_MAXCONN=10                                 # Max search database connections per process
+SEARCH_POOL_WAITTIMEOUT=5                              # Seconds to wait for a free search database connection
+SEARCH_SUGGEST_REFRESH=900                             # Seconds between reloads of the title suggestions in each process
+SEARCH_SUGGEST_MAXRESULTS=10                           # Max title suggestions returned for a prefix
 FRONTEND_SMTP_RELAY="magus.postgresql.org"             # Where to relay user generated email
 OAUTH={}                                               # OAuth providers and keys
 PGDG_ORG_ID=-1                                         # id of the PGDG organisation entry
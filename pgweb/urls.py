@@ -72,6 +72,8 @@ urlpatterns = [
 	url(r'^community/user-groups/$', pgweb.pugs.views.index),
 
 	url(r'^search/$', pgweb.search.views.search),
+	url(r'^search/api/$', pgweb.search.views.api_search),
+	url(r'^search/suggest/$', pgweb.search.views.suggest),
 
 	url(r'^support/security/$', pgweb.security.views.index),
 	url(r'^support/security/([\d\.]+)/$', pgweb.security.views.version),
@@ -152,6 +154,7 @@ urlpatterns = [
 	url(r'^admin/pending/$', pgweb.core.views.admin_pending),
 	url(r'^admin/purge/$', pgweb.core.views.admin_purge),
 	url(r'^admin/mergeorg/$', pgweb.core.views.admin_mergeorg),
+	url(r'^admin/searchstats/$', pgweb.search.views.admin_searchstats),
 
 	# We use selectable only for /admin/ for now, so put it there to avoid caching issues
 	url(r'^admin/selectable/', include('selectable.urls')),
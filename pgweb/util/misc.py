@@ -38,6 +38,13 @@ def varnish_purge(url):
 	url = '^%s' % url
 	connection.cursor().execute("SELECT varnish_purge(%s)", (url, ))
 
+def search_reindex(url):
+	"""
+	Queue the pages matching the specified URL for reindexing by the search
+	crawler. The URL is matched the same way as in varnish_purge().
+	"""
+	connection.cursor().execute("SELECT search_reindex(%s)", (url, ))
+
 def version_sort(l):
 	"""
 	map a directory name to a format that will show up sensibly in an ascii sort
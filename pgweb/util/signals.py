@@ -5,7 +5,7 @@ from django.conf import settings
 import difflib
 
 from pgweb.util.middleware import get_current_user
-from pgweb.util.misc import varnish_purge
+from pgweb.util.misc import varnish_purge, search_reindex
 from pgweb.mailqueue.util import send_simple_mail
 
 def _build_url(obj):
@@ -157,10 +157,13 @@ def my_post_save_handler(sender, **kwargs):
 	instance = kwargs['instance']
 	if hasattr(instance, 'purge_urls'):
 		if callable(instance.purge_urls):
-			purgelist = instance.purge_urls()
+			purgelist = list(instance.purge_urls())
 		else:
 			purgelist = instance.purge_urls
 		map(varnish_purge, purgelist)
+		# Whatever is purged from the cache has changed, so it needs to
+		# be reindexed for the search as well
+		map(search_reindex, purgelist)
 
 def register_basic_signal_handlers():
 	pre_save.connect(my_pre_save_handler)
@@ -0,0 +1,20 @@
+BEGIN;
+
+--
+-- Create a function to queue pages for reindexing by the
+-- search crawler. Takes the same expressions as varnish_purge(),
+-- and notifies the crawler's reindexing daemon, which picks them
+-- up off the queue.
+--
+
+CREATE SCHEMA IF NOT EXISTS searchqueue;
+CREATE TABLE IF NOT EXISTS searchqueue.queue (id bigserial primary key, url text NOT NULL, added timestamptz NOT NULL DEFAULT CURRENT_TIMESTAMP);
+
+DROP FUNCTION IF EXISTS search_reindex(url text);
+CREATE OR REPLACE FUNCTION search_reindex(url text)
+RETURNS void
+AS $$
+   INSERT INTO searchqueue.queue (url) VALUES ($1);
+   NOTIFY searchqueue;
+$$ LANGUAGE 'sql';
+COMMIT;
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# Micro-benchmark for the parser used by the list archives crawler. Runs
+# the parser over a directory of saved message pages, and compares it to
+# the old way of parsing them (one big regexp, and dateutil for all
+# dates), reporting throughput and whether the results agree.
+#
+# Typical use:
+#   archivesbench.py -c /tmp/msgpages --generate 5000
+#   archivesbench.py -c /tmp/msgpages --iterations 5
+#
+
+from optparse import OptionParser
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../crawler'))
+from lib import parsers
+from lib.parsers import ArchivesParser
+
+class LegacyArchivesParser(ArchivesParser):
+	rematcher = re.compile("<!--X-Subject: ([^\n]*) -->.*<!--X-From-R13: ([^\n]*) -->.*<!--X-Date: ([^\n]*) -->.*<!--X-Body-of-Message-->(.*)<!--X-Body-of-Message-End-->", re.DOTALL)
+
+	def parse(self, contents):
+		contents = parsers.lossy_unicode(contents)
+		match = self.rematcher.search(contents)
+		if not match:
+			return False
+		self.subject = self.hp.unescape(match.group(1))
+		self.author = self.almost_rot13(self.hp.unescape(match.group(2)))
+		if not self.parse_date_fallback(self.hp.unescape(match.group(3))):
+			return False
+		self.body = self.hp.unescape(match.group(4))
+		return True
+
+_words = "the quick brown fox jumps over lazy dog postgres vacuum index query planner replication patch review".split()
+_dates = (
+	"Mon, %d Jan 2018 10:%02d:00 +0100 (CET)",
+	"%d Feb 2018 23:%02d:59 -0500",
+	"Wed, %d Mar 2018 08:%02d:12 +0000 (GMT)",
+	"Thu, %d Apr 2018 14:%02d +0200",
+	"Fri, %d May 2018 09:%02d:30 MET DST",
+	)
+
+def generate_corpus(opt):
+	# Write out pages that look like the ones mhonarc generates
+	if not os.path.isdir(opt.corpus):
+		os.makedirs(opt.corpus)
+	r = random.Random(0)
+	for n in range(opt.generate):
+		body = "\n".join([" ".join([r.choice(_words) for i in range(12)]) for j in range(r.randint(5, 200))])
+		with open(os.path.join(opt.corpus, "msg%05d.php" % n), "wb") as f:
+			f.write("""<!-- MHonArc v2.6.16 -->
+<!--X-Subject: Re: %s &amp; %s -->
+<!--X-From-R13: Xbr Hfre &yg;wbr@rknzcyr.pbz&tg; -->
+<!--X-Date: %s -->
+<!--X-Message-Id: %d@example.com -->
+<!--X-Head-End-->
+<html><head><title>Re: %s</title></head><body>
+<!--X-Body-Begin-->
+<!--X-Body-of-Message-->
+<pre>%s</pre>
+<!--X-Body-of-Message-End-->
+<!--X-MsgBody-End-->
+</body></html>
+""" % (r.choice(_words), r.choice(_words), r.choice(_dates) % (r.randint(1, 28), r.randint(0, 59)), n, r.choice(_words), body))
+	print "Wrote %s pages to %s" % (opt.generate, opt.corpus)
+
+def load_corpus(opt):
+	pages = []
+	for fn in sorted(os.listdir(opt.corpus)):
+		with open(os.path.join(opt.corpus, fn), "rb") as f:
+			pages.append(f.read())
+	return pages
+
+def run_parser(cls, pages, iterations):
+	start = time.time()
+	for i in range(iterations):
+		# Start every pass with an empty date cache, like a new crawl
+		parsers._date_cache.clear()
+		results = []
+		for page in pages:
+			p = cls()
+			if p.parse(page):
+				results.append((p.subject, p.author, p.date, p.body))
+			else:
+				results.append(None)
+	return (time.time() - start, results)
+
+if __name__=="__main__":
+	parser = OptionParser()
+	parser.add_option("-c", "--corpus", dest='corpus', help="Directory with saved message pages")
+	parser.add_option("--generate", dest='generate', type='int', default=0, help="Generate this many synthetic pages into the corpus directory first")
+	parser.add_option("--iterations", dest='iterations', type='int', default=3, help="Number of passes over the corpus per parser")
+
+	(opt, args) = parser.parse_args()
+
+	if not opt.corpus:
+		print "Corpus directory must be specified"
+		sys.exit(1)
+
+	if opt.generate:
+		generate_corpus(opt)
+
+	pages = load_corpus(opt)
+	if not pages:
+		print "No pages found in %s" % opt.corpus
+		sys.exit(1)
+	totalbytes = sum([len(p) for p in pages]) * opt.iterations
+	print "%s pages, %.1f MB" % (len(pages), totalbytes / 1048576.0 / opt.iterations)
+
+	results = {}
+	for name, cls in (('legacy', LegacyArchivesParser), ('current', ArchivesParser)):
+		(elapsed, results[name]) = run_parser(cls, pages, opt.iterations)
+		print "%-8s %8.1f messages/sec %8.2f MB/sec" % (name, len(pages) * opt.iterations / elapsed, totalbytes / 1048576.0 / elapsed)
+
+	same = len([1 for a, b in zip(results['legacy'], results['current']) if a == b])
+	print "current matches legacy on %s of %s messages (%.1f%%)" % (same, len(pages), 100.0 * same / len(pages))
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# Micro-benchmark for the html parsers used by the site crawler. Runs
+# every available parser over a directory of saved pages, reporting
+# throughput, and how closely the results of the parsers agree.
+#
+# Typical use:
+#   parserbench.py -c /tmp/docspages --fetch 500
+#   parserbench.py -c /tmp/docspages --iterations 5
+#
+
+from optparse import OptionParser
+import os
+import sys
+import time
+import urllib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../crawler'))
+from lib.parsers import HTML_PARSERS, has_lxml, lossy_unicode
+from lib.sitemapsite import SitemapParser
+
+def fetch_corpus(opt):
+	# Save the first pages listed in the sitemap of the main site
+	if not os.path.isdir(opt.corpus):
+		os.makedirs(opt.corpus)
+	urls = []
+	u = urllib.urlopen("https://%s/sitemap.xml" % opt.host)
+	p = SitemapParser(lambda url, prio, lastmod, internal: urls.append(url))
+	p.parse(u)
+	u.close()
+	for n, url in enumerate(urls[:opt.fetch]):
+		u = urllib.urlopen(url)
+		with open(os.path.join(opt.corpus, "%05d.html" % n), "wb") as f:
+			f.write(u.read())
+		u.close()
+	print "Saved %s pages to %s" % (min(opt.fetch, len(urls)), opt.corpus)
+
+def load_corpus(opt):
+	pages = []
+	for fn in sorted(os.listdir(opt.corpus)):
+		with open(os.path.join(opt.corpus, fn), "rb") as f:
+			pages.append(lossy_unicode(f.read()))
+	return pages
+
+def run_parser(cls, pages, iterations):
+	start = time.time()
+	for i in range(iterations):
+		results = []
+		for page in pages:
+			p = cls()
+			p.feed(page)
+			results.append((p.title, p.links, p.gettext()))
+	return (time.time() - start, results)
+
+def compare(a, b):
+	# Fraction of pages with the same title and the same links, and the
+	# average overlap between the sets of words in the text
+	titles = links = 0
+	overlap = 0.0
+	for (ta, la, xa), (tb, lb, xb) in zip(a, b):
+		if ta == tb:
+			titles += 1
+		if la == lb:
+			links += 1
+		wa = set(xa.split())
+		wb = set(xb.split())
+		if wa or wb:
+			overlap += float(len(wa & wb)) / len(wa | wb)
+		else:
+			overlap += 1
+	n = len(a) or 1
+	return (100.0 * titles / n, 100.0 * links / n, 100.0 * overlap / n)
+
+if __name__=="__main__":
+	parser = OptionParser()
+	parser.add_option("-c", "--corpus", dest='corpus', help="Directory with saved html pages")
+	parser.add_option("--fetch", dest='fetch', type='int', default=0, help="Fetch this many pages into the corpus directory first")
+	parser.add_option("--host", dest='host', default='www.postgresql.org', help="Site to fetch pages from")
+	parser.add_option("--iterations", dest='iterations', type='int', default=3, help="Number of passes over the corpus per parser")
+
+	(opt, args) = parser.parse_args()
+
+	if not opt.corpus:
+		print "Corpus directory must be specified"
+		sys.exit(1)
+
+	if opt.fetch:
+		fetch_corpus(opt)
+
+	pages = load_corpus(opt)
+	if not pages:
+		print "No pages found in %s" % opt.corpus
+		sys.exit(1)
+	totalbytes = sum([len(p.encode('utf8')) for p in pages]) * opt.iterations
+	print "%s pages, %.1f MB" % (len(pages), totalbytes / 1048576.0 / opt.iterations)
+
+	names = [n for n in sorted(HTML_PARSERS.keys()) if n != 'lxml' or has_lxml]
+	results = {}
+	for name in names:
+		(elapsed, results[name]) = run_parser(HTML_PARSERS[name], pages, opt.iterations)
+		print "%-8s %8.1f pages/sec %8.2f MB/sec" % (name, len(pages) * opt.iterations / elapsed, totalbytes / 1048576.0 / elapsed)
+
+	if has_lxml:
+		print "lxml matches python on %.1f%% of titles, %.1f%% of links and %.1f%% of words" % compare(results['lxml'], results['python'])
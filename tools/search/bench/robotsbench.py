@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# Micro-benchmark for the url exclusion checks of the generic site
+# crawler. Checks a set of urls against robots.txt rules and site
+# excludes, both with the compiled matchers and the old way (a loop of
+# startswith over all Disallow rules, and one regexp at a time for the
+# excludes), and reports lookups per second.
+#
+# Typical use:
+#   robotsbench.py --rules 200 --excludes 20
+#   robotsbench.py --robots https://www.example.org/robots.txt
+#
+
+from optparse import OptionParser
+import os
+import random
+import re
+import sys
+import time
+import urllib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../crawler'))
+from lib.parsers import RobotsParser
+from lib.genericsite import compile_excludes
+
+_words = "docs current static admin search list archive files pub projects download about community support news events".split()
+
+def random_path(r, depth):
+	return "/" + "/".join([r.choice(_words) + str(r.randint(0, 50)) for i in range(depth)])
+
+def legacy_excluded(disallows, excludes, url):
+	for d in disallows:
+		if url.startswith(d):
+			return True
+	for e in excludes:
+		if e.search(url):
+			return True
+	return False
+
+if __name__=="__main__":
+	parser = OptionParser()
+	parser.add_option("--robots", dest='robots', help="Use the rules of this robots.txt instead of generated ones")
+	parser.add_option("--rules", dest='rules', type='int', default=100, help="Number of generated Disallow rules")
+	parser.add_option("--excludes", dest='excludes', type='int', default=10, help="Number of generated site excludes")
+	parser.add_option("--urls", dest='urls', type='int', default=20000, help="Number of urls to check")
+	parser.add_option("--iterations", dest='iterations', type='int', default=3, help="Number of passes over the urls")
+
+	(opt, args) = parser.parse_args()
+
+	r = random.Random(0)
+	if opt.robots:
+		u = urllib.urlopen(opt.robots)
+		txt = u.read()
+		u.close()
+	else:
+		txt = "User-agent: *\n" + "".join(["Disallow: %s\n" % random_path(r, r.randint(1, 3)) for i in range(opt.rules)])
+	robots = RobotsParser(txt)
+	# The old parser only knew about plain Disallow rules for everybody
+	disallows = [l[10:] for l in txt.splitlines() if l.lower().startswith("disallow: ") and not '*' in l]
+
+	excludes = ["^%s/.*\\.(pdf|tar\\.gz)$" % random_path(r, 1) for i in range(opt.excludes)]
+	combined = compile_excludes(excludes)
+	separate = [re.compile(x) for x in excludes]
+
+	urls = [random_path(r, r.randint(1, 5)) + r.choice(("/", ".html", ".pdf")) for i in range(opt.urls)]
+	print "%s urls, %s robots rules, %s excludes" % (len(urls), len(disallows), len(excludes))
+
+	start = time.time()
+	for i in range(opt.iterations):
+		legacy = [legacy_excluded(disallows, separate, url) for url in urls]
+	elapsed = time.time() - start
+	print "%-8s %10.1f lookups/sec" % ('legacy', len(urls) * opt.iterations / elapsed)
+
+	start = time.time()
+	for i in range(opt.iterations):
+		current = [robots.block_url(url) or bool(combined and combined.search(url)) for url in urls]
+	elapsed = time.time() - start
+	print "%-8s %10.1f lookups/sec" % ('current', len(urls) * opt.iterations / elapsed)
+
+	print "%s of %s urls excluded, %s differences" % (current.count(True), len(urls), len([1 for a, b in zip(legacy, current) if a != b]))
@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# Offline benchmark for the search functions site_search() and
+# archives_search(). Generates a synthetic corpus into a *scratch*
+# search database (loaded with the scripts in ../sql/), and then replays
+# a mix of queries against it, reporting throughput and latency per
+# class of query.
+#
+# Typical use:
+#   searchbench.py -d dbname=searchbench --generate --pages 100000 --messages 500000
+#   searchbench.py -d dbname=searchbench --replay --iterations 200 --threads 4
+#
+# NEVER point this at the production search database - generating a
+# corpus removes all existing contents!
+#
+
+from optparse import OptionParser
+from StringIO import StringIO
+import datetime
+import random
+import sys
+import threading
+import time
+
+import psycopg2
+
+# Words used to build the corpus. Terms at the start of the list are
+# picked much more often than the ones at the end, giving a roughly
+# zipfian distribution similar to real documentation and mail.
+VOCABULARY = """
+the postgresql database table query index select insert update delete
+server client function column row transaction data type value create
+user schema replication backup vacuum analyze plan join statement lock
+commit rollback trigger view sequence constraint foreign key primary
+unique check default null text integer timestamp interval json jsonb
+array partition tablespace role grant privilege extension operator
+aggregate window cte recursive subquery cursor prepared parameter
+connection socket timeout memory buffer cache wal checkpoint archive
+restore standby primary streaming logical slot publication
+subscription conflict upsert copy dump pg_dump pg_restore psql initdb
+pg_ctl postmaster autovacuum bloat toast heap btree gin gist brin hash
+spgist tsvector tsquery ranking headline dictionary stemmer parser
+collation encoding locale unicode latin1 configuration setting
+parameter postgresql.conf pg_hba.conf authentication md5 scram ssl
+certificate kerberos ldap radius peer trust planner optimizer estimate
+statistics histogram selectivity cost parallel worker gather merge
+nested loop sort limit offset fetch returning release version upgrade
+pg_upgrade migration patch commitfest bug report regression test
+performance benchmark pgbench throughput latency tuning kernel
+filesystem fsync disk ssd raid snapshot isolation serializable
+repeatable read committed deadlock mvcc xmin xmax freeze wraparound
+""".split()
+
+# Classes of queries to replay, see make_query() for what they do
+QUERY_CLASSES = ('single', 'phrase', 'suburl', 'allsites', 'list', 'listdate')
+
+SUBURLS = ('/docs/current/', '/docs/9.6/', '/about/', '/download/', '/support/', '/community/')
+
+
+def zipf_word(r):
+	# Cheap approximation of a zipf distribution over the vocabulary
+	return VOCABULARY[min(len(VOCABULARY) - 1, int(r.paretovariate(1.2)) - 1)]
+
+def make_text(r, words):
+	return u" ".join([zipf_word(r) for i in range(words)])
+
+def copy_escape(s):
+	return s.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+def copy_rows(curs, table, columns, rows):
+	f = StringIO()
+	for row in rows:
+		f.write("\t".join([copy_escape(unicode(c)) for c in row]).encode('utf8'))
+		f.write("\n")
+	f.seek(0)
+	curs.copy_from(f, table, columns=columns)
+
+
+def generate(conn, opt):
+	r = random.Random(opt.seed)
+	curs = conn.cursor()
+
+	print "Removing existing contents"
+	curs.execute("TRUNCATE webpages, messages, site_excludes, sites, lists CASCADE")
+	curs.execute("SELECT site_search_cache_cleanup('0')")
+
+	for i in range(1, opt.sites + 1):
+		curs.execute("INSERT INTO sites (id, hostname, description, pagecount) VALUES (%(id)s, %(host)s, %(host)s, 0)", {
+			'id': i,
+			'host': i == 1 and 'www.postgresql.org' or 'site%s.example.org' % i,
+		})
+	for i in range(1, opt.lists + 1):
+		curs.execute("INSERT INTO lists (id, name, active, grp, pagecount) VALUES (%(id)s, %(name)s, 't', %(grp)s, 0)", {
+			'id': i,
+			'name': 'pgsql-bench%s' % i,
+			'grp': i % 3 + 1,
+		})
+
+	# Load everything in batches through a staging table, and let the
+	# server build the tsvectors, using the same expressions as the
+	# crawlers do.
+	curs.execute("CREATE TEMP TABLE bench_webpages (site int, suburl text, title text, relprio float, isinternal bool, txt text)")
+	start = time.time()
+	n = 0
+	while n < opt.pages:
+		batch = []
+		for i in range(n, min(n + opt.batchsize, opt.pages)):
+			site = r.random() < 0.8 and 1 or r.randint(1, opt.sites)
+			batch.append((
+				site,
+				'%spage%s.html' % (r.choice(SUBURLS), i),
+				make_text(r, r.randint(3, 8)),
+				r.choice((0.5, 0.5, 0.8, 1.0)),
+				r.random() < 0.05,
+				make_text(r, r.randint(opt.pagewords / 2, opt.pagewords * 2)),
+			))
+		copy_rows(curs, 'bench_webpages', ('site', 'suburl', 'title', 'relprio', 'isinternal', 'txt'), batch)
+		curs.execute("INSERT INTO webpages (site, suburl, title, relprio, isinternal, lastscanned, txt, fti) SELECT site, suburl, title, relprio, isinternal, CURRENT_TIMESTAMP, txt, setweight(to_tsvector('public.pg', title), 'A') || to_tsvector('public.pg', txt) FROM bench_webpages")
+		curs.execute("TRUNCATE bench_webpages")
+		conn.commit()
+		n += len(batch)
+		print "%s/%s pages (%.1f pages/sec)" % (n, opt.pages, n / (time.time() - start))
+
+	# Messages are spread out over the last few years, with more of them
+	# recently, to make the date filters do something interesting.
+	now = datetime.datetime.now()
+	curs.execute("SELECT messages_create_partition(y) FROM generate_series(%(first)s, %(last)s) y", {
+		'first': now.year - opt.years,
+		'last': now.year + 1,
+	})
+	curs.execute("CREATE TEMP TABLE bench_messages (list int, year int, month int, msgnum int, date timestamptz, subject text, author text, txt text)")
+	msgnums = {}
+	start = time.time()
+	n = 0
+	while n < opt.messages:
+		batch = []
+		for i in range(n, min(n + opt.batchsize, opt.messages)):
+			d = now - datetime.timedelta(days=min(opt.years * 365, r.expovariate(1.0 / (opt.years * 120))))
+			listid = r.randint(1, opt.lists)
+			k = (listid, d.year, d.month)
+			msgnums[k] = msgnums.get(k, -1) + 1
+			batch.append((
+				listid, d.year, d.month, msgnums[k],
+				d.strftime('%Y-%m-%d %H:%M:%S'),
+				u"Re: %s" % make_text(r, r.randint(3, 8)),
+				u"Author %s <author%s@example.org>" % (r.randint(1, 2000), r.randint(1, 2000)),
+				make_text(r, r.randint(opt.messagewords / 2, opt.messagewords * 2)),
+			))
+		copy_rows(curs, 'bench_messages', ('list', 'year', 'month', 'msgnum', 'date', 'subject', 'author', 'txt'), batch)
+		curs.execute("INSERT INTO messages (list, year, month, msgnum, date, subject, author, txt, fti) SELECT list, year, month, msgnum, date, subject, author, txt, setweight(to_tsvector('pg', subject), 'A') || to_tsvector('pg', txt) FROM bench_messages")
+		curs.execute("TRUNCATE bench_messages")
+		conn.commit()
+		n += len(batch)
+		print "%s/%s messages (%.1f messages/sec)" % (n, opt.messages, n / (time.time() - start))
+
+	curs.execute("WITH t AS (SELECT site,count(*) AS c FROM webpages GROUP BY site) UPDATE sites SET pagecount=t.c FROM t WHERE id=t.site")
+	curs.execute("WITH t AS (SELECT list,count(*) AS c FROM messages GROUP BY list) UPDATE lists SET pagecount=t.c FROM t WHERE id=t.list")
+	conn.commit()
+
+	print "Building indexes"
+	curs.execute("DROP INDEX IF EXISTS webpages_fti_idx")
+	curs.execute("CREATE INDEX webpages_fti_idx ON webpages USING gin(fti)")
+	curs.execute("DROP INDEX IF EXISTS messages_fti_idx")
+	curs.execute("CREATE INDEX messages_fti_idx ON messages USING gin(fti)")
+	curs.execute("DROP INDEX IF EXISTS messages_date_idx")
+	curs.execute("CREATE INDEX messages_date_idx ON messages(date)")
+	conn.commit()
+	conn.autocommit = True
+	curs.execute("VACUUM ANALYZE webpages")
+	curs.execute("VACUUM ANALYZE messages")
+	conn.autocommit = False
+
+
+def make_query(r, qclass, opt):
+	# Returns the SQL and parameters for one query of the given class
+	if qclass == 'single':
+		return ("SELECT * FROM site_search(%(q)s, %(ofs)s, 20, 'f', NULL, 'f')",
+				{'q': zipf_word(r), 'ofs': r.choice((0, 0, 0, 20, 40))})
+	elif qclass == 'phrase':
+		return ("SELECT * FROM site_search(%(q)s, %(ofs)s, 20, 'f', NULL, 'f')",
+				{'q': make_text(r, r.randint(2, 4)), 'ofs': r.choice((0, 0, 0, 20))})
+	elif qclass == 'suburl':
+		return ("SELECT * FROM site_search(%(q)s, 0, 20, 'f', %(suburl)s, 'f')",
+				{'q': make_text(r, r.randint(1, 2)), 'suburl': r.choice(SUBURLS)})
+	elif qclass == 'allsites':
+		return ("SELECT * FROM site_search(%(q)s, 0, 20, 't', NULL, 'f')",
+				{'q': make_text(r, r.randint(1, 2))})
+	elif qclass == 'list':
+		return ("SELECT * FROM archives_search(%(q)s, %(list)s, NULL, NULL, 0, 20, %(sort)s)",
+				{'q': make_text(r, r.randint(1, 3)), 'list': r.choice((None, 1, -1)), 'sort': r.choice(('r', 'd'))})
+	elif qclass == 'listdate':
+		return ("SELECT * FROM archives_search(%(q)s, NULL, CURRENT_TIMESTAMP - %(days)s * '1 day'::interval, NULL, 0, 20, %(sort)s)",
+				{'q': make_text(r, r.randint(1, 3)), 'days': r.choice((1, 7, 31, 186, 365)), 'sort': r.choice(('r', 'd'))})
+	raise Exception("Unknown query class %s" % qclass)
+
+
+def replay_worker(dsn, qclass, opt, seed, results, lock):
+	conn = psycopg2.connect(dsn)
+	conn.autocommit = True
+	curs = conn.cursor()
+	r = random.Random(seed)
+	timings = []
+	for i in range(opt.iterations):
+		(sql, params) = make_query(r, qclass, opt)
+		if opt.nocache:
+			curs.execute("SELECT site_search_cache_cleanup('0')")
+		t = time.time()
+		curs.execute(sql, params)
+		curs.fetchall()
+		timings.append(time.time() - t)
+	conn.close()
+	with lock:
+		results.extend(timings)
+
+def percentile(vals, p):
+	return vals[min(len(vals) - 1, int(len(vals) * p))]
+
+def replay(dsn, opt):
+	classes = opt.classes and opt.classes.split(',') or QUERY_CLASSES
+	print "%-10s %8s %10s %9s %9s %9s %9s" % ('class', 'queries', 'qps', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms')
+	for qclass in classes:
+		results = []
+		lock = threading.Lock()
+		threads = [threading.Thread(target=replay_worker, args=(dsn, qclass, opt, opt.seed + i, results, lock)) for i in range(opt.threads)]
+		start = time.time()
+		for t in threads:
+			t.start()
+		for t in threads:
+			t.join()
+		elapsed = time.time() - start
+		results.sort()
+		if not results:
+			continue
+		print "%-10s %8s %10.1f %9.1f %9.1f %9.1f %9.1f" % (
+			qclass,
+			len(results),
+			len(results) / elapsed,
+			percentile(results, 0.50) * 1000,
+			percentile(results, 0.90) * 1000,
+			percentile(results, 0.99) * 1000,
+			results[-1] * 1000,
+		)
+
+
+if __name__=="__main__":
+	parser = OptionParser()
+	parser.add_option("-d", "--dsn", dest='dsn', help="Connection string for the scratch database")
+	parser.add_option("-g", "--generate", dest='generate', action="store_true", help="Generate a synthetic corpus (removes existing data!)")
+	parser.add_option("-r", "--replay", dest='replay', action="store_true", help="Replay the query mix")
+	parser.add_option("--pages", dest='pages', type='int', default=50000, help="Number of webpages to generate")
+	parser.add_option("--messages", dest='messages', type='int', default=200000, help="Number of messages to generate")
+	parser.add_option("--sites", dest='sites', type='int', default=3, help="Number of sites to generate")
+	parser.add_option("--lists", dest='lists', type='int', default=20, help="Number of lists to generate")
+	parser.add_option("--years", dest='years', type='int', default=5, help="Number of years of messages to generate")
+	parser.add_option("--pagewords", dest='pagewords', type='int', default=400, help="Average words per page")
+	parser.add_option("--messagewords", dest='messagewords', type='int', default=150, help="Average words per message")
+	parser.add_option("--batchsize", dest='batchsize', type='int', default=5000, help="Rows per COPY batch when generating")
+	parser.add_option("--classes", dest='classes', help="Comma separated query classes to replay (default all: %s)" % ",".join(QUERY_CLASSES))
+	parser.add_option("--iterations", dest='iterations', type='int', default=100, help="Queries per thread and class")
+	parser.add_option("--threads", dest='threads', type='int', default=1, help="Concurrent connections during replay")
+	parser.add_option("--nocache", dest='nocache', action="store_true", help="Clear the site_search hit cache before every query")
+	parser.add_option("--seed", dest='seed', type='int', default=42, help="Random seed, for repeatable runs")
+
+	(opt, args) = parser.parse_args()
+
+	if not opt.dsn or not (opt.generate or opt.replay) or args:
+		parser.print_help()
+		sys.exit(1)
+
+	psycopg2.extensions.register_type(psycopg2.extensions.UNICODE)
+	if opt.generate:
+		conn = psycopg2.connect(opt.dsn)
+		generate(conn, opt)
+		conn.close()
+	if opt.replay:
+		replay(opt.dsn, opt)
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# Benchmark for the fetching and parsing done by the crawler, using a
+# local web server that replays the responses saved in WARC files by an
+# earlier crawl (with warcdir set in search.ini) as a stand-in for the
+# real site. Reports pages per second for a full pass over all the pages
+# of the site in the WARC files. Nothing is written to the database.
+#
+# Typical use:
+#   warcreplay.py --host www.postgresql.org /srv/search/warc/www.postgresql.org-*.warc.gz
+#   warcreplay.py --host www.postgresql.org --threads 20 --htmlparser python /srv/search/warc/*.warc.gz
+#
+
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from optparse import OptionParser
+from Queue import Queue
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../crawler'))
+from lib.fetcher import HostConnectionPool
+from lib.parsers import get_html_parser, lossy_unicode
+from lib.warc import WarcIndex
+
+class ReplayServer(ThreadingMixIn, HTTPServer):
+	daemon_threads = True
+
+class ReplayHandler(BaseHTTPRequestHandler):
+	# Keep-alive, like the real frontends
+	protocol_version = "HTTP/1.1"
+
+	def do_GET(self):
+		r = self.server.index.get(self.server.base + self.path)
+		if r is None:
+			self.send_response(404)
+			self.send_header("Content-Length", "0")
+			self.end_headers()
+			return
+		(resp, body) = r
+		self.send_response(resp.status, resp.reason)
+		for k in resp.msg.keys():
+			if not k in ("connection", "content-length", "keep-alive"):
+				self.send_header(k, resp.msg.getheader(k))
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, format, *args):
+		pass
+
+def fetch_from_queue(pool, queue, htmlparser, counts, lock):
+	while True:
+		url = queue.get()
+		if url is None:
+			return
+		try:
+			resp = pool.request(url, {"User-agent": "pgsearch/0.2"})
+			data = resp.read()
+			if resp.status == 200:
+				p = htmlparser()
+				p.feed(lossy_unicode(data))
+				p.gettext()
+			status = resp.status
+		except Exception, e:
+			print "Exception fetching %s: %s" % (url, e)
+			(status, data) = ('error', '')
+		with lock:
+			counts[status] = counts.get(status, 0) + 1
+			counts['bytes'] = counts.get('bytes', 0) + len(data)
+		queue.task_done()
+
+if __name__=="__main__":
+	parser = OptionParser(usage="usage: %prog [options] warcfile ...")
+	parser.add_option("--host", dest='host', default='www.postgresql.org', help="Site to replay")
+	parser.add_option("--http", dest='http', action="store_true", help="The site was crawled over http, not https")
+	parser.add_option("--threads", dest='threads', type='int', default=5, help="Number of fetching threads")
+	parser.add_option("--connections", dest='connections', type='int', default=5, help="Max number of connections to the server")
+	parser.add_option("--htmlparser", dest='htmlparser', help="Html parser to use (python or lxml)")
+
+	(opt, args) = parser.parse_args()
+
+	if not args:
+		print "WARC files must be specified"
+		sys.exit(1)
+
+	start = time.time()
+	index = WarcIndex(args)
+	base = "%s://%s" % (opt.http and "http" or "https", opt.host)
+	urls = index.urls(base)
+	if not urls:
+		print "No pages for %s found" % base
+		sys.exit(1)
+	print "Loaded %s pages for %s in %.1f sec" % (len(urls), opt.host, time.time() - start)
+
+	server = ReplayServer(("127.0.0.1", 0), ReplayHandler)
+	server.index = index
+	server.base = base
+	t = threading.Thread(target=server.serve_forever)
+	t.daemon = True
+	t.start()
+
+	pool = HostConnectionPool(opt.host, "127.0.0.1", False, opt.connections, port=server.server_address[1])
+	htmlparser = get_html_parser(opt.htmlparser)
+	queue = Queue()
+	counts = {}
+	lock = threading.Lock()
+	threads = []
+	for x in range(opt.threads):
+		t = threading.Thread(target=lambda: fetch_from_queue(pool, queue, htmlparser, counts, lock))
+		t.daemon = True
+		t.start()
+		threads.append(t)
+
+	start = time.time()
+	for url in urls:
+		queue.put(url)
+	queue.join()
+	elapsed = time.time() - start
+
+	for t in threads:
+		queue.put(None)
+	for t in threads:
+		t.join()
+	pool.closeall()
+	server.shutdown()
+	server.server_close()
+
+	print "%s pages in %.1f sec, %.1f pages/sec, %.2f MB/sec, %s connections" % (len(urls), elapsed, len(urls) / elapsed, counts.get('bytes', 0) / 1048576.0 / elapsed, pool.connects)
+	print "Responses: %s" % ", ".join(["%s: %s" % (k, v) for k, v in sorted(counts.items()) if k != 'bytes'])
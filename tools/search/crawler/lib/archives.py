@@ -1,12 +1,16 @@
 import datetime
+import errno
 import httplib
+from cStringIO import StringIO
 from Queue import Queue
 import threading
 import sys
 import time
+import urllib2
 
 from lib.log import log
-from lib.parsers import ArchivesParser
+from lib.parsers import ArchivesParser, MboxParser, iter_mbox
+from lib.pagewriter import copy_value
 
 class MultiListCrawler(object):
 	def __init__(self, lists, conn, status_interval=30, commit_interval=500):
@@ -18,17 +22,30 @@ class MultiListCrawler(object):
 		self.queue = Queue()
 		self.counter = 0
 		self.counterlock = threading.RLock()
+		# All writes of a whole month in bulk mode happen under this lock,
+		# so nobody commits while a month is half written
+		self.dblock = threading.RLock()
 		self.stopevent = threading.Event()
 
-	def crawl(self, full=False, month=None):
+	def crawl(self, full=False, month=None, bulk=None):
+		# If bulk is set, whole months are loaded from mbox files instead
+		# of one message at a time from the archives. It's a template for
+		# the path or url of the mbox of a month, like
+		# /srv/mbox/{list}/{list}.{year:04d}{month:02d}
+		self.bulk = bulk
+
 		# Each thread can independently run on one month, so we can get
 		# a reasonable spread. Therefor, submit them as separate jobs
 		# to the queue.
 		for listid, listname in self.lists:
 			if full:
-				# Generate a sequence of everything to index
-				for year in range(1997, datetime.datetime.now().year+1):
+				# Generate a sequence of everything to index, skipping
+				# the months we know the list didn't exist
+				(first, last) = self.list_lifetime(listid)
+				for year in range(first.year, last.year+1):
 					for month in range(1,13):
+						if datetime.date(year, month, 1) < first or datetime.date(year, month, 1) > last:
+							continue
 						self.queue.put((listid, listname, year, month, -1))
 			elif month:
 				# Do one specific month
@@ -84,6 +101,24 @@ class MultiListCrawler(object):
 
 		return self.counter
 
+	def list_lifetime(self, listid):
+		# Returns the first and last month the list has messages, as far
+		# as we know from what's been indexed before. Active lists are
+		# assumed to still get messages. This goes by the months of the
+		# archive pages the messages are on, not the dates in them (which
+		# can be anything), and only needs the ends of the primary key.
+		curs = self.conn.cursor()
+		curs.execute("SELECT active, (SELECT ARRAY[year, month] FROM messages WHERE list=%(id)s ORDER BY year, month LIMIT 1), (SELECT ARRAY[year, month] FROM messages WHERE list=%(id)s ORDER BY year DESC, month DESC LIMIT 1) FROM lists WHERE id=%(id)s", {
+				'id': listid,
+				})
+		(active, firstmonth, lastmonth) = curs.fetchone()
+		first = firstmonth and datetime.date(firstmonth[0], firstmonth[1], 1) or datetime.date(1997, 1, 1)
+		if active or not lastmonth:
+			last = datetime.date.today().replace(day=1)
+		else:
+			last = datetime.date(lastmonth[0], lastmonth[1], 1)
+		return (first, last)
+
 	def status_thread(self):
 		lastcommit = 0
 		starttime = time.time()
@@ -100,14 +135,88 @@ class MultiListCrawler(object):
 				# Commit every 500 messages
 				if self.counter - lastcommit > self.commit_interval:
 					lastcommit = self.counter
-					self.conn.commit()
+					with self.dblock:
+						self.conn.commit()
 
 	def crawl_from_queue(self):
 		while not self.stopevent.is_set():
 			(listid, listname, year, month, maxmsg) = self.queue.get()
-			self.crawl_month(listid, listname, year, month, maxmsg)
+			if self.bulk:
+				self.crawl_month_bulk(listid, listname, year, month, maxmsg)
+			else:
+				self.crawl_month(listid, listname, year, month, maxmsg)
 			self.queue.task_done()
 
+	def open_mbox(self, listname, year, month):
+		# Returns None if there is no mbox for the month
+		src = self.bulk.format(list=listname, year=year, month=month)
+		try:
+			if src.startswith('http://') or src.startswith('https://'):
+				return urllib2.urlopen(src, timeout=60)
+			return open(src, 'rb')
+		except urllib2.HTTPError, e:
+			if e.code == 404:
+				return None
+			raise
+		except IOError, e:
+			if e.errno == errno.ENOENT:
+				return None
+			raise
+
+	def crawl_month_bulk(self, listid, listname, year, month, maxmsg):
+		try:
+			f = self.open_mbox(listname, year, month)
+			if not f:
+				return
+			rows = StringIO()
+			n = 0
+			try:
+				# Messages are numbered by their X-Message-Number header if
+				# they have one, and otherwise by their position in the
+				# mbox, which has to be in the same order as the archives.
+				for pos, contents in enumerate(iter_mbox(f)):
+					p = MboxParser()
+					if not p.parse(contents):
+						log("Failed to parse %s/%s/%s/%s" % (listname, year, month, pos))
+						continue
+					msgnum = p.msgnum is None and pos or p.msgnum
+					if msgnum <= maxmsg:
+						continue
+					rows.write("\t".join([copy_value(v) for v in (listid, year, month, msgnum, p.date, p.subject[:127], p.author[:127], p.body)]))
+					rows.write("\n")
+					n += 1
+			finally:
+				f.close()
+		except Exception, e:
+			log("Exception when loading %s/%s/%s - %s" % (listname, year, month, e))
+			return
+		if not n:
+			return
+		rows.seek(0)
+
+		# Replace whatever we had for the month (past maxmsg) with what's
+		# in the mbox, all in one transaction.
+		with self.dblock:
+			curs = self.conn.cursor()
+			try:
+				curs.execute("CREATE TEMP TABLE IF NOT EXISTS messages_staging (list int, year int, month int, msgnum int, date timestamptz, subject text, author text, txt text)")
+				curs.execute("TRUNCATE messages_staging")
+				curs.copy_from(rows, 'messages_staging', columns=('list', 'year', 'month', 'msgnum', 'date', 'subject', 'author', 'txt'))
+				curs.execute("DELETE FROM messages WHERE list=%(listid)s AND year=%(year)s AND month=%(month)s AND msgnum>%(maxmsg)s", {
+						'listid': listid,
+						'year': year,
+						'month': month,
+						'maxmsg': maxmsg,
+						})
+				curs.execute("INSERT INTO messages (list, year, month, msgnum, date, subject, author, txt, fti) SELECT list, year, month, msgnum, date, subject, author, txt, setweight(to_tsvector('pg', subject), 'A') || to_tsvector('pg', txt) FROM messages_staging")
+				self.conn.commit()
+			except Exception, e:
+				self.conn.rollback()
+				log("Exception when storing %s/%s/%s - %s" % (listname, year, month, e))
+				return
+		with self.counterlock:
+			self.counter += n
+
 	def crawl_month(self, listid, listname, year, month, maxmsg):
 		currentmsg = maxmsg
 		while True:
@@ -1,41 +1,74 @@
 import datetime
-import httplib
+import hashlib
 import time
 from email.utils import formatdate, parsedate
 import urlparse
-import ssl
 
 from Queue import Queue
 import threading
 
 from lib.log import log
-from lib.parsers import GenericHtmlParser, lossy_unicode
+from lib.parsers import get_html_parser, lossy_unicode
+from lib.fetcher import HostConnectionPool
+from lib.pagewriter import PageWriter
+from lib.frontier import CrawlFrontier
+from lib.metrics import CrawlMetrics
+from lib.warc import WarcWriter
 
 class BaseSiteCrawler(object):
-	def __init__(self, hostname, dbconn, siteid, serverip=None, https=False):
+	def __init__(self, hostname, dbconn, siteid, serverip=None, https=False, threads=5, maxconn=5, writebatch=200, writeinterval=5, mindelay=0, budget=None, htmlparser=None, metricsdir=None, warcdir=None, warcfull=False, dsn=None):
 		self.hostname = hostname
 		self.dbconn = dbconn
 		self.siteid = siteid
 		self.serverip = serverip
 		self.https = https
+		self.threads = threads
+		self.htmlparser = get_html_parser(htmlparser)
+		self.fetcher = HostConnectionPool(hostname, serverip, https, maxconn, mindelay=mindelay, budget=budget)
+		# The writer has a connection of its own (made from dsn), and
+		# dbconn is only used from the thread running the crawl
+		self.writer = PageWriter(dsn, self.pages_written, writebatch, writeinterval)
+		self.frontier = CrawlFrontier(dbconn, siteid)
+		self.metrics = CrawlMetrics()
+		self.metricsdir = metricsdir
+		# All responses are written to WARC files in warcdir, if set. Pages
+		# that haven't changed are only in the WARC file of the crawl that
+		# last got them in full, unless warcfull is set, in which case every
+		# page is fetched in full.
+		self.warc = warcdir and WarcWriter(warcdir, hostname) or None
+		self.warcfull = warcfull and self.warc is not None
 		self.pages_crawled = {}
 		self.pages_new = 0
 		self.pages_updated = 0
 		self.pages_deleted = 0
+		self.pages_unchanged = 0
 		self.status_interval = 5
 
 		curs = dbconn.cursor()
-		curs.execute("SELECT suburl, lastscanned FROM webpages WHERE site=%(id)s AND lastscanned IS NOT NULL", {'id': siteid})
-		self.scantimes = dict(curs.fetchall())
+		curs.execute("SELECT suburl, lastscanned, contenthash, etag, bodysize FROM webpages WHERE site=%(id)s AND lastscanned IS NOT NULL", {'id': siteid})
+		self.scantimes = {}
+		self.contenthashes = {}
+		self.etags = {}
+		self.bodysizes = {}
+		for suburl, lastscanned, contenthash, etag, bodysize in curs.fetchall():
+			self.scantimes[suburl] = lastscanned
+			self.contenthashes[suburl] = contenthash
+			if etag:
+				self.etags[suburl] = etag
+			self.bodysizes[suburl] = bodysize
 		self.queue = Queue()
 		self.counterlock = threading.RLock()
 		self.stopevent = threading.Event()
+		# Cleared if not all the pages could be added to the crawl
+		self.seeded = True
 
 	def crawl(self):
+		started = datetime.datetime.now()
 		self.init_crawl()
+		self.writer.start()
 
 		# Fire off worker threads
-		for x in range(5):
+		for x in range(self.threads):
 			t = threading.Thread(name="Indexer %s" % x,
 					   target = lambda: self.crawl_from_queue())
 			t.daemon = True
@@ -45,23 +78,55 @@ class BaseSiteCrawler(object):
 		t.daemon = True
 		t.start()
 
+		# Pages can keep being added to the frontier while the crawl is
+		# already running (e.g. while a big sitemap is downloaded)
+		seeder = threading.Thread(name="seeder", target = lambda: self.seed_from_thread())
+		seeder.daemon = True
+		seeder.start()
+
 		# XXX: need to find a way to deal with all threads crashed and
 		# not done here yet!
-		self.queue.join()
+		self.feed_from_frontier(seeder)
 		self.stopevent.set()
-
-		# Remove all pages that we didn't crawl
-		curs = self.dbconn.cursor()
-		curs.execute("DELETE FROM webpages WHERE site=%(site)s AND NOT suburl=ANY(%(urls)s)", {
-				'site': self.siteid,
-				'urls': self.pages_crawled.keys(),
-				})
-		if curs.rowcount:
-			log("Deleted %s pages no longer accessible" % curs.rowcount)
-		self.pages_deleted += curs.rowcount
-
+		self.fetcher.closeall()
+		self.writer.close()
+		if self.warc:
+			self.warc.close()
+		if self.writer.failed:
+			log("%s: Failed to write %s pages" % (self.hostname, self.writer.failed))
+
+		# Remove all pages that we didn't crawl (in this or any other
+		# process working on the same crawl). If we didn't get to add all
+		# the pages to the crawl, or didn't get to write all the pages we
+		# crawled, we can't tell which ones are gone.
+		t = time.time()
+		if not self.seeded or self.writer.failed:
+			log("%s: Crawl is incomplete, not removing any pages" % self.hostname)
+			self.seeded = False
+		deleted = self.frontier.finish(self.seeded)
+		if deleted is not None:
+			log("%s: Deleted %s pages no longer accessible (%.2f sec)" % (self.hostname, deleted, time.time() - t))
+			self.pages_deleted += deleted
+
+		finished = datetime.datetime.now()
+		self.metrics.save(self.dbconn, self.siteid, started, finished, len(self.pages_crawled))
 		self.dbconn.commit()
-		log("Considered %s pages, wrote %s updated and %s new, deleted %s." % (len(self.pages_crawled), self.pages_updated, self.pages_new, self.pages_deleted))
+		if self.metricsdir:
+			try:
+				self.metrics.write_textfile(self.metricsdir, self.hostname, (finished - started).total_seconds(), len(self.pages_crawled))
+			except Exception, e:
+				log("%s: Failed to write metrics: %s" % (self.hostname, e))
+
+		log("%s: Considered %s pages, wrote %s updated and %s new, deleted %s, %s unchanged." % (self.hostname, len(self.pages_crawled), self.pages_updated, self.pages_new, self.pages_deleted, self.pages_unchanged))
+		log("%s: Used %s connections for %s pages." % (self.hostname, self.fetcher.connects, self.fetcher.connects + self.fetcher.reused))
+		fetch = self.metrics.histograms['fetch_seconds']
+		log("%s: Fetched %.1f MB (%.1f MB saved by %s not modified)%s." % (
+			self.hostname,
+			self.metrics.counters.get('bytes', 0) / 1048576.0,
+			self.metrics.counters.get('bytes_saved', 0) / 1048576.0,
+			self.metrics.counters.get('status_304', 0),
+			fetch.count and ", p50 %ss, p90 %ss, p99 %ss per page" % (fetch.percentile(0.5), fetch.percentile(0.9), fetch.percentile(0.99)) or "",
+			))
 
 	def status_thread(self):
 		starttime = time.time()
@@ -69,37 +134,72 @@ class BaseSiteCrawler(object):
 			self.stopevent.wait(self.status_interval)
 			nowtime = time.time()
 			with self.counterlock:
-				log("Considered %s pages, wrote %s upd, %s new, %s del (%s threads, %s in queue, %.1f pages/sec)" % (
+				log("%s: Considered %s pages, wrote %s upd, %s new, %s del (%s threads, %s in queue, %.1f pages/sec)" % (
+					self.hostname,
 					len(self.pages_crawled),
 					self.pages_updated,
 					self.pages_new,
 					self.pages_deleted,
-					threading.active_count() - 2,
+					self.threads,
 					self.queue.qsize(),
 					len(self.pages_crawled) / (nowtime - starttime),
 					))
 
+	def seed_from_thread(self):
+		try:
+			self.seed_crawl()
+		except Exception, e:
+			self.seeded = False
+			log("%s: Exception adding pages to crawl: %s" % (self.hostname, e))
+
+	def seed_crawl(self):
+		pass
+
+	def feed_from_frontier(self, seeder):
+		# Keep the workers busy with pages claimed from the frontier until
+		# there is nothing left to crawl. Whatever the workers (and the
+		# seeder) did before the queue went idle has been recorded in the
+		# frontier by then, so if sync() finds nothing left after that,
+		# we're done.
+		while True:
+			idle = self.queue.unfinished_tasks == 0 and not seeder.is_alive()
+			if self.queue.qsize() < self.threads:
+				(claimed, remaining) = self.frontier.sync(self.threads * 4)
+			else:
+				(claimed, remaining) = self.frontier.sync(0)
+			for c in claimed:
+				self.queue.put(c)
+			if idle and not claimed and not remaining:
+				return
+			if not claimed:
+				time.sleep(0.5)
+
 	def crawl_from_queue(self):
 		while not self.stopevent.is_set():
 			(url, relprio, internal) = self.queue.get()
+			if self.exclude_url(url):
+				# Not marked done, so that a page we have from an earlier
+				# crawl that is now excluded gets removed
+				self.frontier.skip(url)
+				self.queue.task_done()
+				continue
 			try:
 				self.crawl_page(url, relprio, internal)
 			except Exception, e:
 				log("Exception crawling '%s': %s" % (url, e))
+			self.frontier.done(url)
 			self.queue.task_done()
 
 	def exclude_url(self, url):
 		return False
 
 	def crawl_page(self, url, relprio, internal):
-		if self.pages_crawled.has_key(url) or self.pages_crawled.has_key(url+"/"):
-			return
-
-		if self.exclude_url(url):
-			return
+		with self.counterlock:
+			if self.pages_crawled.has_key(url) or self.pages_crawled.has_key(url+"/"):
+				return
+			self.pages_crawled[url] = 1
 
-		self.pages_crawled[url] = 1
-		(result, pagedata, lastmod) = self.fetch_page(url)
+		(result, pagedata, lastmod, etag) = self.fetch_page(url)
 
 		if result == 0:
 			if pagedata == None:
@@ -108,13 +208,7 @@ class BaseSiteCrawler(object):
 				return
 		else:
 			# Page failed to load or was a redirect, so remove from database
-			curs = self.dbconn.cursor()
-			curs.execute("DELETE FROM webpages WHERE site=%(id)s AND suburl=%(url)s", {
-					'id': self.siteid,
-					'url': url,
-					})
-			with self.counterlock:
-				self.pages_deleted += curs.rowcount
+			self.writer.delete(self.siteid, url)
 
 			if result == 1:
 				# Page was a redirect, so crawl into that page if we haven't
@@ -123,38 +217,42 @@ class BaseSiteCrawler(object):
 			return
 
 		# Try to convert pagedata to a unicode string
+		size = len(pagedata)
 		pagedata = lossy_unicode(pagedata)
+		t = time.time()
 		try:
-			self.page = self.parse_html(pagedata)
+			page = self.parse_html(pagedata)
 		except Exception, e:
 			log("Failed to parse HTML for %s" % url)
 			log(e)
 			return
+		self.metrics.observe('parse_seconds', time.time() - t)
 
-		self.save_page(url, lastmod, relprio, internal)
-		self.post_process_page(url)
+		self.save_page(url, page, lastmod, relprio, internal, etag, size)
+		self.post_process_page(url, page)
 
-	def save_page(self, url, lastmod, relprio, internal):
+	def save_page(self, url, page, lastmod, relprio, internal, etag=None, size=None):
 		if relprio == 0.0:
 			relprio = 0.5
-		params = {
-			'title': self.page.title[:128],
-			'txt': self.page.gettext(),
-			'lastmod': lastmod,
-			'site': self.siteid,
-			'url': url,
-			'relprio': relprio,
-			'internal': internal,
-			}
-		curs = self.dbconn.cursor()
-		curs.execute("UPDATE webpages SET title=%(title)s, txt=%(txt)s, fti=setweight(to_tsvector('public.pg', %(title)s), 'A') || to_tsvector('public.pg', %(txt)s), lastscanned=%(lastmod)s, relprio=%(relprio)s, isinternal=%(internal)s WHERE site=%(site)s AND suburl=%(url)s", params)
-		if curs.rowcount != 1:
-			curs.execute("INSERT INTO webpages (site, suburl, title, txt, fti, lastscanned, relprio, isinternal) VALUES (%(site)s, %(url)s, %(title)s, %(txt)s, setweight(to_tsvector('public.pg', %(title)s), 'A') || to_tsvector('public.pg', %(txt)s), %(lastmod)s, %(relprio)s, %(internal)s)", params)
-			with self.counterlock:
-				self.pages_new += 1
+		title = page.title[:128]
+		txt = page.gettext()
+		contenthash = hashlib.md5(title.encode('utf8') + '\0' + txt.encode('utf8')).hexdigest()
+		if self.contenthashes.get(url, None) == contenthash:
+			# Same contents as what we already have, so there's no need to
+			# write (and re-tokenize) all of it
+			self.writer.put((self.siteid, url, None, None, contenthash, etag, size, lastmod, relprio, internal))
 		else:
-			with self.counterlock:
-				self.pages_updated += 1
+			self.writer.put((self.siteid, url, title, txt, contenthash, etag, size, lastmod, relprio, internal))
+
+	def pages_written(self, new, updated, unchanged, deleted, elapsed):
+		pages = new + updated + unchanged + deleted
+		if pages:
+			self.metrics.observe('write_seconds', elapsed / pages, pages)
+		with self.counterlock:
+			self.pages_new += new
+			self.pages_updated += updated
+			self.pages_unchanged += unchanged
+			self.pages_deleted += deleted
 
 	ACCEPTED_CONTENTTYPES = ("text/html", "text/plain", )
 	def accept_contenttype(self, contenttype):
@@ -164,56 +262,62 @@ class BaseSiteCrawler(object):
 		return contenttype in self.ACCEPTED_CONTENTTYPES
 
 	def fetch_page(self, url):
+		t = time.time()
 		try:
-			# Unfortunatley, persistent connections seem quite unreliable,
-			# so create a new one for each page.
-			if self.serverip:
-				if not self.https:
-					h = httplib.HTTPConnection(host=self.serverip, port=80, strict=True, timeout=10)
-				else:
-					h = httplib.HTTPSConnection(host=self.serverip, port=443, strict=True, timeout=10, context=ssl._create_unverified_context())
-				h.putrequest("GET", url, skip_host=1)
-				h.putheader("Host", self.hostname)
-			else:
-				if not self.https:
-					h = httplib.HTTPConnection(host=self.hostname, port=80, strict=True, timeout=10)
-				else:
-					h = httplib.HTTPSConnection(host=self.hostname, port=443, strict=True, timeout=10, context=ssl._create_unverified_context())
-				h.putrequest("GET", url)
-			h.putheader("User-agent","pgsearch/0.2")
-			h.putheader("Connection","close")
-			if self.scantimes.has_key(url):
-				h.putheader("If-Modified-Since", formatdate(time.mktime(self.scantimes[url].timetuple())))
-			h.endheaders()
-			resp = h.getresponse()
+			headers = {"User-agent": "pgsearch/0.2"}
+			if not self.warcfull:
+				if self.scantimes.has_key(url):
+					headers["If-Modified-Since"] = formatdate(time.mktime(self.scantimes[url].timetuple()))
+				if self.etags.has_key(url):
+					headers["If-None-Match"] = self.etags[url]
+			resp = self.fetcher.request(url, headers)
+			try:
+				if resp.status == 200 and not self.accept_contenttype(resp.getheader("content-type", "")):
+					# Content-type we're not interested in, so don't bother
+					# reading what may well be a large file
+					resp.discard()
+					self.metrics.fetched(url, resp.status, time.time() - t, 0)
+					return (2, None, None, None)
+				data = resp.read()
+			except Exception:
+				resp.discard()
+				raise
+			self.metrics.fetched(url, resp.status, time.time() - t, len(data))
+			if self.warc:
+				self.save_warc(url, resp, data)
 
 			if resp.status == 200:
-				if not self.accept_contenttype(resp.getheader("content-type")):
-					# Content-type we're not interested in
-					return (2, None, None)
-				return (0, resp.read(), self.get_date(resp.getheader("last-modified")))
+				return (0, data, self.get_date(resp.getheader("last-modified")), resp.getheader("etag"))
 			elif resp.status == 304:
 				# Not modified, so no need to reprocess, but also don't
 				# give an error message for it...
-				return (0, None, None)
+				self.metrics.count('bytes_saved', self.bodysizes.get(url, None) or 0)
+				return (0, None, None, None)
 			elif resp.status == 301:
 				# A redirect... So try again with the redirected-to URL
 				# We send this through our link resolver to deal with both
 				# absolute and relative URLs
 				if resp.getheader('location', '') == '':
 					log("Url %s returned empty redirect" % url)
-					return (2, None, None)
+					return (2, None, None, None)
 
 				for tgt in self.resolve_links([resp.getheader('location', '')], url):
-					return (1, tgt, None)
+					return (1, tgt, None, None)
 				# No redirect at all found, becaue it was invalid?
-				return (2, None, None)
+				return (2, None, None, None)
 			else:
 				#print "Url %s returned status %s" % (url, resp.status)
 				pass
 		except Exception, e:
+			self.metrics.fetched(url, 'error', time.time() - t, 0)
 			log("Exception when loading url %s: %s" % (url, e))
-		return (2, None, None)
+		return (2, None, None, None)
+
+	def save_warc(self, url, resp, data):
+		try:
+			self.warc.write_response("%s://%s%s" % (self.https and "https" or "http", self.hostname, url), resp, data)
+		except Exception, e:
+			log("Failed to write %s to WARC: %s" % (url, e))
 
 	def get_date(self, date):
 		d = parsedate(date)
@@ -225,7 +329,7 @@ class BaseSiteCrawler(object):
 		if page == None:
 			return None
 
-		p = GenericHtmlParser()
+		p = self.htmlparser()
 		p.feed(page)
 		return p
 
@@ -0,0 +1,175 @@
+import errno
+import httplib
+import socket
+import ssl
+import threading
+import time
+
+# Keep-alive connections to the host being crawled. Setting up a new TCP
+# (and TLS) session for every page costs a lot more than fetching most of
+# the pages, so the connections are kept open and reused by all the
+# worker threads. No more than maxconn requests are ever in flight to the
+# host at the same time, however many workers there are.
+#
+# To be nice to sites we don't run ourselves, requests can also be spaced
+# out by at least mindelay seconds. And when several sites are crawled at
+# once, budget is a semaphore shared by all of them, limiting the total
+# number of requests in flight.
+
+# Errors that on a *reused* connection just mean that the server closed
+# it while it was sitting idle, and that it's safe to retry on a new one.
+_STALE_ERRNOS = (errno.ECONNRESET, errno.EPIPE, errno.ECONNABORTED)
+
+class HostConnectionPool(object):
+	def __init__(self, hostname, serverip=None, https=False, maxconn=8, timeout=10, maxidle=15, mindelay=0, budget=None, port=None):
+		self.hostname = hostname
+		self.serverip = serverip
+		self.https = https
+		self.maxconn = maxconn
+		self.timeout = timeout
+		self.maxidle = maxidle
+		self.mindelay = mindelay
+		self.budget = budget
+		self.port = port
+
+		self._cond = threading.Condition(threading.Lock())
+		self._idle = []
+		self._total = 0
+		self._nextrequest = 0
+
+		self.connects = 0
+		self.reused = 0
+
+	def _connect(self):
+		host = self.serverip or self.hostname
+		if not self.https:
+			c = httplib.HTTPConnection(host=host, port=self.port or 80, strict=True, timeout=self.timeout)
+		else:
+			c = httplib.HTTPSConnection(host=host, port=self.port or 443, strict=True, timeout=self.timeout, context=ssl._create_unverified_context())
+		with self._cond:
+			self.connects += 1
+		return c
+
+	def _checkout(self):
+		with self._cond:
+			while True:
+				while self._idle and time.time() - self._idle[0][1] > self.maxidle:
+					self._idle.pop(0)[0].close()
+					self._total -= 1
+				if self._idle:
+					self.reused += 1
+					c = self._idle.pop()[0]
+					break
+				if self._total < self.maxconn:
+					self._total += 1
+					c = None
+					break
+				self._cond.wait()
+		# Only take from the shared budget once we have a connection to
+		# the host, so workers waiting for this host don't hold it up.
+		if self.budget:
+			self.budget.acquire()
+		if c is not None:
+			return (c, True)
+		try:
+			return (self._connect(), False)
+		except Exception:
+			self._release(None)
+			raise
+
+	def _release(self, c, reuse=False):
+		if self.budget:
+			self.budget.release()
+		with self._cond:
+			if reuse:
+				self._idle.append((c, time.time()))
+			else:
+				if c:
+					c.close()
+				self._total -= 1
+			self._cond.notify()
+
+	def _wait_turn(self):
+		with self._cond:
+			now = time.time()
+			wait = self._nextrequest - now
+			self._nextrequest = max(now, self._nextrequest) + self.mindelay
+		if wait > 0:
+			time.sleep(wait)
+
+	def request(self, url, headers):
+		"""
+		GET url from the host, and return a PooledResponse as soon as the
+		headers have arrived. The caller has to either read() or discard()
+		it, to give the connection back.
+		"""
+		if self.mindelay:
+			self._wait_turn()
+		for attempt in (1, 2):
+			(c, reused) = self._checkout()
+			try:
+				c.putrequest("GET", url, skip_host=1)
+				c.putheader("Host", self.hostname)
+				for k, v in headers.items():
+					c.putheader(k, v)
+				c.endheaders()
+				r = c.getresponse()
+			except (httplib.BadStatusLine, httplib.CannotSendRequest, httplib.ResponseNotReady):
+				self._release(c)
+				if reused and attempt == 1:
+					continue
+				raise
+			except socket.error, e:
+				self._release(c)
+				if reused and attempt == 1 and e.errno in _STALE_ERRNOS:
+					continue
+				raise
+			except Exception:
+				self._release(c)
+				raise
+
+			return PooledResponse(self, c, r)
+
+	def closeall(self):
+		with self._cond:
+			for c, t in self._idle:
+				c.close()
+			self._total -= len(self._idle)
+			self._idle = []
+
+class PooledResponse(object):
+	"""
+	A response whose body hasn't been read yet, holding on to the
+	connection it came in on until it's either read or discarded.
+	"""
+	def __init__(self, pool, c, r):
+		self._pool = pool
+		self._c = c
+		self._r = r
+		self.status = r.status
+		self.reason = r.reason
+		self.version = r.version
+		self.msg = r.msg
+		self.will_close = r.will_close
+
+	def getheader(self, name, default=None):
+		return self._r.getheader(name, default)
+
+	def read(self):
+		# Read the whole body, after which the connection can be reused
+		try:
+			data = self._r.read()
+		except Exception:
+			self.discard()
+			raise
+		if self._c:
+			self._pool._release(self._c, reuse=not self._r.will_close)
+			self._c = None
+		return data
+
+	def discard(self):
+		# Close the connection without reading the body, which is cheaper
+		# than reading a large body we aren't interested in
+		if self._c:
+			self._pool._release(self._c)
+			self._c = None
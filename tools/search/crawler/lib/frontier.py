@@ -0,0 +1,123 @@
+import threading
+
+# The crawl frontier: all the pages of a site that are to be crawled in
+# the current crawl, kept in the crawlqueue table rather than in memory.
+# Pages are handed out in order of priority, with the ones that were
+# scanned the longest ago first, and are claimed with SKIP LOCKED, so
+# several crawler processes can work on the same site at once. Pages
+# stay in the table (flagged as done) until the crawl of the site is
+# finished, so a crawl that is interrupted can pick up where it stopped.
+#
+# The worker threads only record what they found and what they finished
+# in memory, and the crawler calls sync() from a single thread to write
+# it all out and claim more pages in one short transaction.
+
+class CrawlFrontier(object):
+	def __init__(self, dbconn, siteid, claimtimeout=600):
+		self.dbconn = dbconn
+		self.siteid = siteid
+		# Pages claimed by a crawler that died are handed out again
+		# after this many seconds
+		self.claimtimeout = claimtimeout
+
+		self.lock = threading.Lock()
+		self._new = {}
+		self._done = []
+		self._skipped = []
+
+	def add(self, url, relprio, internal, done=False):
+		# Pages that are already in the crawl are ignored, unless they are
+		# added as done (e.g. pages from a sitemap that haven't changed).
+		if len(url) > 512:
+			return
+		with self.lock:
+			if done or not url in self._new:
+				self._new[url] = (relprio, internal, done)
+
+	def done(self, url):
+		with self.lock:
+			self._done.append(url)
+
+	def skip(self, url):
+		# Pages that turn out to be excluded are dropped from the crawl
+		# (unless they're already done), so the page is removed when the
+		# crawl is finished.
+		with self.lock:
+			self._skipped.append(url)
+
+	def sync(self, claim):
+		"""
+		Write out the pages that have been added or finished since the last
+		call, and claim up to claim pages to crawl. Returns a tuple of the
+		list of claimed (url, relprio, internal), and whether there are any
+		pages left that aren't done (including ones claimed by others).
+		"""
+		with self.lock:
+			new, self._new = self._new, {}
+			done, self._done = self._done, []
+			skipped, self._skipped = self._skipped, []
+
+		curs = self.dbconn.cursor()
+		if new:
+			curs.execute("""INSERT INTO crawlqueue (site, suburl, relprio, isinternal, done, lastscanned)
+SELECT %(site)s, n.suburl, n.relprio, n.isinternal, n.done, w.lastscanned
+FROM unnest(%(urls)s::text[], %(prios)s::float[], %(internal)s::boolean[], %(done)s::boolean[]) n(suburl, relprio, isinternal, done)
+LEFT JOIN webpages w ON w.site=%(site)s AND w.suburl=n.suburl
+ON CONFLICT (site, suburl) DO UPDATE SET done=true WHERE excluded.done""", {
+				'site': self.siteid,
+				'urls': new.keys(),
+				'prios': [v[0] for v in new.values()],
+				'internal': [v[1] for v in new.values()],
+				'done': [v[2] for v in new.values()],
+				})
+		if done:
+			curs.execute("UPDATE crawlqueue SET done=true WHERE site=%(site)s AND suburl=ANY(%(urls)s)", {
+				'site': self.siteid,
+				'urls': done,
+				})
+
+		if skipped:
+			curs.execute("DELETE FROM crawlqueue WHERE site=%(site)s AND suburl=ANY(%(urls)s) AND NOT done", {
+				'site': self.siteid,
+				'urls': skipped,
+				})
+
+		claimed = []
+		if claim:
+			curs.execute("""UPDATE crawlqueue q SET claimed=CURRENT_TIMESTAMP FROM (
+ SELECT suburl FROM crawlqueue
+ WHERE site=%(site)s AND NOT done AND (claimed IS NULL OR claimed < CURRENT_TIMESTAMP - %(timeout)s * '1 second'::interval)
+ ORDER BY relprio DESC, lastscanned NULLS FIRST
+ LIMIT %(claim)s
+ FOR UPDATE SKIP LOCKED
+) c WHERE q.site=%(site)s AND q.suburl=c.suburl
+RETURNING q.suburl, q.relprio, q.isinternal""", {
+				'site': self.siteid,
+				'timeout': self.claimtimeout,
+				'claim': claim,
+				})
+			claimed = curs.fetchall()
+
+		curs.execute("SELECT EXISTS (SELECT 1 FROM crawlqueue WHERE site=%(site)s AND NOT done)", {'site': self.siteid})
+		remaining = curs.fetchone()[0]
+		self.dbconn.commit()
+		return (claimed, remaining)
+
+	def finish(self, delete=True):
+		"""
+		Finish the crawl of the site: remove all pages of the site that were
+		not crawled this time around (unless delete is False), and empty the
+		frontier for the next crawl. Returns the number of pages removed, or
+		None if another crawler process already did this.
+		"""
+		curs = self.dbconn.cursor()
+		curs.execute("SELECT pg_advisory_xact_lock(hashtext('crawlqueue'), %(site)s)", {'site': self.siteid})
+		curs.execute("SELECT EXISTS (SELECT 1 FROM crawlqueue WHERE site=%(site)s)", {'site': self.siteid})
+		if not curs.fetchone()[0]:
+			return None
+		deleted = 0
+		if delete:
+			curs.execute("DELETE FROM webpages w WHERE site=%(site)s AND NOT EXISTS (SELECT 1 FROM crawlqueue q WHERE q.site=%(site)s AND q.suburl=w.suburl AND q.done)", {'site': self.siteid})
+			deleted = curs.rowcount
+		curs.execute("DELETE FROM crawlqueue WHERE site=%(site)s", {'site': self.siteid})
+		return deleted
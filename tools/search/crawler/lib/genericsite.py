@@ -1,50 +1,55 @@
 import re
 
 from basecrawler import BaseSiteCrawler
-from parsers import RobotsParser
+from parsers import fetch_robots
+
+def compile_excludes(excludes):
+	if not excludes:
+		return None
+	return re.compile("|".join(["(?:%s)" % x for x in excludes]))
 
 class GenericSiteCrawler(BaseSiteCrawler):
-	def __init__(self, hostname, dbconn, siteid, https=False):
-		super(GenericSiteCrawler, self).__init__(hostname, dbconn, siteid, https=https)
+	def __init__(self, hostname, dbconn, siteid, https=False, **kwargs):
+		super(GenericSiteCrawler, self).__init__(hostname, dbconn, siteid, https=https, **kwargs)
 
 	def init_crawl(self):
 		# Load robots.txt
-		self.robots = RobotsParser("http://%s/robots.txt" % self.hostname)
+		self.robots = fetch_robots("http://%s/robots.txt" % self.hostname)
 
 		# We need to seed the crawler with every URL we've already seen, since
 		# we don't recrawl the contents if they haven't changed.
 		allpages = self.scantimes.keys()
 
 		# Figure out if there are any excludes to deal with (beyond the
-		# robots.txt ones)
+		# robots.txt ones). They're all combined into a single regexp, so
+		# every url is only matched once.
 		curs = self.dbconn.cursor()
 		curs.execute("SELECT suburlre FROM site_excludes WHERE site=%(site)s", {
 				'site': self.siteid,
 				})
-		self.extra_excludes = [re.compile(x) for x, in curs.fetchall()]
+		self.extra_excludes = compile_excludes([x for x, in curs.fetchall()])
 
 		# We *always* crawl the root page, of course
-		self.queue.put(("/", 0.5, False))
+		self.frontier.add("/", 0.5, False)
 
 		# Now do all the other pages
 		for x in allpages:
-			self.queue.put((x, 0.5, False))
+			self.frontier.add(x, 0.5, False)
 
 	def exclude_url(self, url):
 		if ".." in url:
 			return True
 		if self.robots and self.robots.block_url(url):
 			return True
-		for r in self.extra_excludes:
-			if r.search(url):
-				return True
+		if self.extra_excludes and self.extra_excludes.search(url):
+			return True
 		return False
 
 	def queue_url(self, url):
-		self.queue.put((url.strip(), 0.5, False))
+		self.frontier.add(url.strip(), 0.5, False)
 
-	def post_process_page(self, url):
-		for l in self.resolve_links(self.page.links, url):
+	def post_process_page(self, url, page):
+		for l in self.resolve_links(page.links, url):
 			if self.pages_crawled.has_key(l) or self.pages_crawled.has_key(l+"/"):
 				continue
 			if self.exclude_url(l):
@@ -0,0 +1,148 @@
+from bisect import bisect_left
+import heapq
+import json
+import os
+import threading
+
+# Metrics for the crawl of one site. Timings (in seconds) and sizes are
+# collected in histograms with fixed buckets, and everything else is a
+# counter. At the end of the crawl they are stored in the crawlstats
+# table, and can also be written out in the Prometheus textfile format
+# (for the node_exporter textfile collector).
+
+TIME_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+class Histogram(object):
+	def __init__(self, buckets):
+		self.buckets = buckets
+		self.counts = [0] * (len(buckets) + 1)
+		self.sum = 0
+		self.count = 0
+
+	def observe(self, value, n=1):
+		self.counts[bisect_left(self.buckets, value)] += n
+		self.sum += value * n
+		self.count += n
+
+	def percentile(self, p):
+		# The upper bound of the bucket the percentile falls in, which is
+		# as close as we can get without keeping all the values. Values
+		# above the last bucket give infinity, like the +Inf bucket in
+		# Prometheus.
+		if not self.count:
+			return None
+		n = 0
+		for i, c in enumerate(self.counts):
+			n += c
+			if n >= self.count * p:
+				break
+		if i == len(self.buckets):
+			return float('inf')
+		return self.buckets[i]
+
+	def summary(self):
+		# Infinity isn't valid json, so it's stored the Prometheus way
+		def _p(p):
+			v = self.percentile(p)
+			return v == float('inf') and '+Inf' or v
+		return {
+			'count': self.count,
+			'sum': self.sum,
+			'p50': _p(0.5),
+			'p90': _p(0.9),
+			'p99': _p(0.99),
+			'buckets': self.counts,
+		}
+
+
+class CrawlMetrics(object):
+	HISTOGRAMS = {
+		'fetch_seconds': TIME_BUCKETS,
+		'parse_seconds': TIME_BUCKETS,
+		# Per page written, with the time of each batch split evenly
+		# over the pages in it
+		'write_seconds': TIME_BUCKETS,
+		'response_bytes': SIZE_BUCKETS,
+	}
+
+	def __init__(self, slowest=20):
+		self.lock = threading.Lock()
+		self.histograms = dict([(k, Histogram(v)) for k, v in self.HISTOGRAMS.items()])
+		self.counters = {}
+		self.nslowest = slowest
+		self.slowest = []
+
+	def observe(self, name, value, n=1):
+		with self.lock:
+			self.histograms[name].observe(value, n)
+
+	def count(self, name, n=1):
+		with self.lock:
+			self.counters[name] = self.counters.get(name, 0) + n
+
+	def fetched(self, url, status, elapsed, size):
+		with self.lock:
+			self.histograms['fetch_seconds'].observe(elapsed)
+			self.histograms['response_bytes'].observe(size)
+			k = 'status_%s' % status
+			self.counters[k] = self.counters.get(k, 0) + 1
+			self.counters['bytes'] = self.counters.get('bytes', 0) + size
+			# Keep track of the slowest urls
+			if len(self.slowest) < self.nslowest:
+				heapq.heappush(self.slowest, (elapsed, url))
+			elif elapsed > self.slowest[0][0]:
+				heapq.heapreplace(self.slowest, (elapsed, url))
+
+	def summary(self):
+		with self.lock:
+			return {
+				'histograms': dict([(k, h.summary()) for k, h in self.histograms.items()]),
+				'counters': dict(self.counters),
+				'slowest': [{'url': u, 'seconds': round(t, 3)} for t, u in sorted(self.slowest, reverse=True)],
+			}
+
+	def save(self, dbconn, siteid, started, finished, pages):
+		curs = dbconn.cursor()
+		curs.execute("INSERT INTO crawlstats (site, started, finished, pages, bytes, stats) VALUES (%(site)s, %(started)s, %(finished)s, %(pages)s, %(bytes)s, %(stats)s)", {
+			'site': siteid,
+			'started': started,
+			'finished': finished,
+			'pages': pages,
+			'bytes': self.counters.get('bytes', 0),
+			'stats': json.dumps(self.summary()),
+			})
+
+	def write_textfile(self, directory, hostname, duration, pages):
+		labels = 'site="%s"' % hostname
+		lines = []
+		with self.lock:
+			for name in sorted(self.histograms.keys()):
+				h = self.histograms[name]
+				lines.append('# TYPE pgsearch_crawl_%s histogram' % name)
+				n = 0
+				for le, c in zip(h.buckets, h.counts):
+					n += c
+					lines.append('pgsearch_crawl_%s_bucket{%s,le="%s"} %s' % (name, labels, le, n))
+				lines.append('pgsearch_crawl_%s_bucket{%s,le="+Inf"} %s' % (name, labels, h.count))
+				lines.append('pgsearch_crawl_%s_sum{%s} %s' % (name, labels, h.sum))
+				lines.append('pgsearch_crawl_%s_count{%s} %s' % (name, labels, h.count))
+			lines.append('# TYPE pgsearch_crawl_responses gauge')
+			for k in sorted(self.counters.keys()):
+				if k.startswith('status_'):
+					lines.append('pgsearch_crawl_responses{%s,status="%s"} %s' % (labels, k[7:], self.counters[k]))
+			lines.append('# TYPE pgsearch_crawl_bytes gauge')
+			lines.append('pgsearch_crawl_bytes{%s} %s' % (labels, self.counters.get('bytes', 0)))
+			lines.append('# TYPE pgsearch_crawl_bytes_saved gauge')
+			lines.append('pgsearch_crawl_bytes_saved{%s} %s' % (labels, self.counters.get('bytes_saved', 0)))
+		lines.append('# TYPE pgsearch_crawl_pages gauge')
+		lines.append('pgsearch_crawl_pages{%s} %s' % (labels, pages))
+		lines.append('# TYPE pgsearch_crawl_duration_seconds gauge')
+		lines.append('pgsearch_crawl_duration_seconds{%s} %s' % (labels, duration))
+
+		# Write to a temp file and rename it, so the collector never sees
+		# a half written file
+		fn = os.path.join(directory, 'pgsearch_crawl_%s.prom' % hostname)
+		with open(fn + '.tmp', 'w') as f:
+			f.write("\n".join(lines) + "\n")
+		os.rename(fn + '.tmp', fn)
@@ -0,0 +1,180 @@
+from cStringIO import StringIO
+from Queue import Queue, Empty, Full
+import psycopg2
+import threading
+import time
+
+from lib.log import log
+
+# Writer stage for crawled pages. The worker threads only parse pages
+# and put them on a (bounded) queue, and a single writer thread stores
+# them in batches: COPY into a staging table, followed by one upsert that
+# builds the tsvectors for the whole batch at once. That's a lot cheaper
+# than an UPDATE (and maybe an INSERT) per page, and it keeps the workers
+# from all waiting for their turn on the database connection.
+#
+# Pages whose contents haven't changed since they were last stored are
+# queued without title and text, and only get their lastscanned (and
+# priority) updated, so their tsvectors aren't rebuilt for nothing.
+#
+# Pages that have gone away are deleted by the writer as well, so the
+# writer thread owns all the changes to webpages. It uses a connection of
+# its own, so its transactions never mix with those of the crawler.
+#
+# If a batch fails to write, it's retried one page at a time, so a single
+# bad page doesn't take the rest of the batch with it. The pages that
+# still can't be written are counted in failed, and since they've already
+# been marked as crawled, the crawler has to check it before trusting the
+# crawl to be complete.
+
+_COPY_ESCAPES = (('\\', '\\\\'), ('\t', '\\t'), ('\n', '\\n'), ('\r', '\\r'), ('\x00', ''))
+
+def copy_value(v):
+	if v is None:
+		return '\\N'
+	if isinstance(v, unicode):
+		v = v.encode('utf8')
+	else:
+		v = str(v)
+	for f, t in _COPY_ESCAPES:
+		v = v.replace(f, t)
+	return v
+
+class PageWriter(object):
+	COLUMNS = ('site', 'suburl', 'title', 'txt', 'contenthash', 'etag', 'bodysize', 'lastscanned', 'relprio', 'isinternal')
+
+	def __init__(self, dsn, callback, batchsize=200, flushinterval=5):
+		self.dsn = dsn
+		self.dbconn = None
+		self.callback = callback
+		self.batchsize = batchsize
+		self.flushinterval = flushinterval
+		# Allow the workers to get a few batches ahead, but no more
+		self.queue = Queue(batchsize * 4)
+		self.thread = None
+		self.failed = 0
+
+	def start(self):
+		self.dbconn = psycopg2.connect(self.dsn)
+		curs = self.dbconn.cursor()
+		curs.execute("CREATE TEMP TABLE IF NOT EXISTS webpages_staging (site int, suburl text, title text, txt text, contenthash text, etag text, bodysize int, lastscanned timestamptz, relprio float, isinternal boolean)")
+		self.dbconn.commit()
+
+		self.thread = threading.Thread(name="Writer", target=lambda: self.write_from_queue())
+		self.thread.daemon = True
+		self.thread.start()
+
+	def _put(self, item):
+		# Don't block forever on a full queue if the writer thread has died
+		while True:
+			if not self.thread.is_alive():
+				raise Exception("Page writer is not running")
+			try:
+				self.queue.put(item, True, 5)
+				return
+			except Full:
+				pass
+
+	def put(self, page):
+		# page is a tuple matching COLUMNS, with title and txt set to None
+		# if the page is unchanged
+		self._put(page)
+
+	def delete(self, site, url):
+		self._put((site, url))
+
+	def close(self):
+		# Flush whatever is left and wait for it to be written
+		try:
+			self._put(None)
+		except Exception, e:
+			log("Failed to close page writer: %s" % e)
+		self.thread.join()
+		self.dbconn.close()
+		self.dbconn = None
+
+	def write_from_queue(self):
+		try:
+			self._write_from_queue()
+		except Exception, e:
+			# Whatever is still queued is lost as well
+			log("Page writer stopped: %s" % e)
+			self.failed += 1
+
+	def _write_from_queue(self):
+		batch = []
+		lastflush = time.time()
+		while True:
+			try:
+				page = self.queue.get(True, max(0.1, lastflush + self.flushinterval - time.time()))
+			except Empty:
+				page = False
+
+			if page:
+				batch.append(page)
+			if batch and (page is None or len(batch) >= self.batchsize or time.time() - lastflush >= self.flushinterval):
+				self.flush(batch)
+				batch = []
+				lastflush = time.time()
+			elif not batch:
+				# Nothing waiting, so start the interval over once there is
+				lastflush = time.time()
+			if page is None:
+				return
+
+	def flush(self, batch):
+		start = time.time()
+		try:
+			counts = self.write(batch)
+		except Exception, e:
+			self.dbconn.rollback()
+			log("Failed to write batch of %s pages, retrying one by one: %s" % (len(batch), e))
+			counts = [0, 0, 0, 0]
+			for page in batch:
+				try:
+					for i, n in enumerate(self.write([page])):
+						counts[i] += n
+				except Exception, e:
+					self.dbconn.rollback()
+					self.failed += 1
+					log("Failed to write %s: %s" % (page[1], e))
+		(inserted, updated, unchanged, deleted) = counts
+		self.callback(inserted, updated, unchanged, deleted, time.time() - start)
+
+	def write(self, batch):
+		# Write a batch in a single transaction, returning the number of
+		# pages inserted, updated, unchanged and deleted
+		# Deletes are queued as just (site, suburl)
+		deletes = [p for p in batch if len(p) == 2]
+		pages = [p for p in batch if len(p) != 2]
+		f = StringIO()
+		for page in pages:
+			f.write("\t".join([copy_value(v) for v in page]))
+			f.write("\n")
+		f.seek(0)
+
+		curs = self.dbconn.cursor()
+		deleted = 0
+		for site, url in deletes:
+			curs.execute("DELETE FROM webpages WHERE site=%(id)s AND suburl=%(url)s", {
+					'id': site,
+					'url': url,
+					})
+			deleted += curs.rowcount
+		curs.execute("TRUNCATE webpages_staging")
+		curs.copy_from(f, 'webpages_staging', columns=self.COLUMNS)
+		curs.execute("UPDATE webpages w SET lastscanned=s.lastscanned, etag=s.etag, bodysize=s.bodysize, relprio=s.relprio, isinternal=s.isinternal FROM webpages_staging s WHERE s.txt IS NULL AND w.site=s.site AND w.suburl=s.suburl")
+		unchanged = curs.rowcount
+		# A page can show up more than once in a batch (e.g. through a
+		# redirect), but an upsert can only touch each row once.
+		curs.execute("""INSERT INTO webpages (site, suburl, title, txt, fti, contenthash, etag, bodysize, lastscanned, relprio, isinternal)
+SELECT DISTINCT ON (site, suburl) site, suburl, title, txt, setweight(to_tsvector('public.pg', title), 'A') || to_tsvector('public.pg', txt), contenthash, etag, bodysize, lastscanned, relprio, isinternal
+FROM webpages_staging
+WHERE txt IS NOT NULL
+ORDER BY site, suburl
+ON CONFLICT (site, suburl) DO UPDATE SET title=excluded.title, txt=excluded.txt, fti=excluded.fti, contenthash=excluded.contenthash, etag=excluded.etag, bodysize=excluded.bodysize, lastscanned=excluded.lastscanned, relprio=excluded.relprio, isinternal=excluded.isinternal
+RETURNING xmax=0""")
+		written = [x for x, in curs.fetchall()]
+		self.dbconn.commit()
+		inserted = len([x for x in written if x])
+		return (inserted, len(written) - inserted, unchanged, deleted)
@@ -1,13 +1,33 @@
 import re
 import urllib
+import email
+import email.header
+import email.errors
 from StringIO import StringIO
+import threading
+import time
 import dateutil.parser
-from datetime import timedelta
+import dateutil.tz
+from datetime import datetime, timedelta
 
 from HTMLParser import HTMLParser
 
+# lxml is optional. If it's installed, it can be configured to be used to
+# extract the text from pages, since it's many times faster than
+# HTMLParser.
+try:
+	import lxml.etree
+	has_lxml = True
+except ImportError:
+	has_lxml = False
+
 from lib.log import log
 
+# The html parsers used by the site crawlers all work the same way: an
+# instance is fed the whole page (as unicode), after which it has the
+# title and the links (hrefs of all A tags) of the page, and gettext()
+# returns the text of the body, one chunk per line.
+
 class GenericHtmlParser(HTMLParser):
 	def __init__(self):
 		HTMLParser.__init__(self)
@@ -29,6 +49,10 @@ class GenericHtmlParser(HTMLParser):
 	def handle_endtag(self, tag):
 		if tag == "body":
 			self.inbody = False
+		# Text following the end of the title or a script is not part
+		# of it
+		if tag == self.lasttag:
+			self.lasttag = None
 
 	DATA_IGNORE_TAGS = ("script",)
 	def handle_data(self, data):
@@ -56,8 +80,93 @@ class GenericHtmlParser(HTMLParser):
 		return self.pagedata.read()
 
 
+# lxml is used as a streaming parser: the parser calls the start, end and
+# data methods for everything it finds (the parser target interface), so
+# no tree is built for the page. The text between two tags can come in
+# several pieces (e.g. split at entities), so it's collected until the
+# next tag.
+class LxmlHtmlParser(object):
+	def __init__(self):
+		self.title = ""
+		self.links = []
+		self.text = []
+		self.data_parts = []
+		self.intitle = False
+		self.inbody = False
+		self.inscript = 0
+
+	def feed(self, page):
+		# libxml2 won't take unicode with an encoding declaration in it,
+		# so give it utf8 instead
+		parser = lxml.etree.HTMLParser(target=self, encoding='utf-8', remove_comments=True, remove_pis=True)
+		parser.feed(page.encode('utf8'))
+		parser.close()
+
+	def flush_data(self):
+		if not self.data_parts:
+			return
+		d = "".join(self.data_parts).strip()
+		self.data_parts = []
+		if len(d) < 2:
+			return
+		if self.intitle:
+			self.title += d
+		elif self.inbody and not self.inscript:
+			self.text.append(d)
+
+	def start(self, tag, attrib):
+		self.flush_data()
+		if tag == "title":
+			self.intitle = True
+		elif tag == "body":
+			self.inbody = True
+		elif tag == "script":
+			self.inscript += 1
+		elif tag == "a" and attrib.has_key("href"):
+			self.links.append(attrib["href"])
+
+	def end(self, tag):
+		self.flush_data()
+		if tag == "title":
+			self.intitle = False
+		elif tag == "body":
+			self.inbody = False
+		elif tag == "script":
+			self.inscript -= 1
+
+	def data(self, data):
+		self.data_parts.append(data)
+
+	def close(self):
+		self.flush_data()
+
+	def gettext(self):
+		return "".join([t + "\n" for t in self.text])
+
+
+HTML_PARSERS = {
+	'python': GenericHtmlParser,
+	'lxml': LxmlHtmlParser,
+	}
+
+def get_html_parser(name=None):
+	# lxml doesn't extract exactly the same text (e.g. it handles entities
+	# differently), so it's only used if asked for
+	if not name:
+		name = 'python'
+	if name == 'lxml' and not has_lxml:
+		raise Exception("lxml is not installed")
+	return HTML_PARSERS[name]
+
+
+# Dates that have been parsed recently, and the timezones used for them.
+# The same dates show up over and over (in a thread, and when a month is
+# recrawled), and most use just a handful of timezones.
+_date_cache = {}
+_date_cache_max = 10000
+_tz_cache = {}
+
 class ArchivesParser(object):
-	rematcher = re.compile("<!--X-Subject: ([^\n]*) -->.*<!--X-From-R13: ([^\n]*) -->.*<!--X-Date: ([^\n]*) -->.*<!--X-Body-of-Message-->(.*)<!--X-Body-of-Message-End-->", re.DOTALL)
 	hp = HTMLParser()
 	def __init__(self):
 		self.subject = None
@@ -65,21 +174,97 @@ class ArchivesParser(object):
 		self.date = None
 		self.body = None
 
+	def _header(self, contents, marker, start):
+		# The header comments written by mhonarc are one per line, like
+		# <!--X-Subject: foo -->
+		i = contents.find(marker, start)
+		if i < 0:
+			return (None, -1)
+		i += len(marker)
+		eol = contents.find("\n", i)
+		if eol < 0:
+			eol = len(contents)
+		j = contents.rfind(" -->", i, eol)
+		if j < 0:
+			return (None, -1)
+		return (contents[i:j], j)
+
 	def parse(self, contents):
+		# Find the parts of the page we want by scanning for the markers
+		# mhonarc puts in, in the order they appear in. Since anything in
+		# the message itself is html escaped, the markers can't show up
+		# anywhere else.
 		contents = lossy_unicode(contents)
-		match = self.rematcher.search(contents)
-		if not match:
+		(subject, pos) = self._header(contents, "<!--X-Subject: ", 0)
+		if subject is None:
+			return False
+		(author, pos) = self._header(contents, "<!--X-From-R13: ", pos)
+		if author is None:
+			return False
+		(date, pos) = self._header(contents, "<!--X-Date: ", pos)
+		if date is None:
+			return False
+		start = contents.find("<!--X-Body-of-Message-->", pos)
+		if start < 0:
 			return False
-		self.subject = self.hp.unescape(match.group(1))
-		self.author = self.almost_rot13(self.hp.unescape(match.group(2)))
-		if not self.parse_date(self.hp.unescape(match.group(3))):
+		start += len("<!--X-Body-of-Message-->")
+		end = contents.rfind("<!--X-Body-of-Message-End-->", start)
+		if end < 0:
 			return False
-		self.body = self.hp.unescape(match.group(4))
+
+		self.subject = self.hp.unescape(subject)
+		self.author = self.almost_rot13(self.hp.unescape(author))
+		if not self.parse_date(self.hp.unescape(date)):
+			return False
+		self.body = self.hp.unescape(contents[start:end])
+		return True
+
+	# Plain RFC 2822 dates, like "Mon, 1 Jan 2018 10:00:00 +0100 (CET)",
+	# which is what nearly all messages have.
+	_date_rfc2822_re = re.compile('^(?:[A-Za-z]{3}, )?(\d{1,2}) ([A-Za-z]{3}) (\d{4}) (\d{2}):(\d{2})(?::(\d{2}))? ([+-])(\d{2})(\d{2})(?: \([^)]*\))?$')
+	_months = dict([(m, i+1) for i, m in enumerate(('jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct', 'nov', 'dec'))])
+	def parse_date_rfc2822(self, d):
+		m = self._date_rfc2822_re.match(d)
+		if not m:
+			return None
+		month = self._months.get(m.group(2).lower(), None)
+		if not month:
+			return None
+		offset = (m.group(7) == '-' and -1 or 1) * (int(m.group(8)) * 3600 + int(m.group(9)) * 60)
+		if not offset in _tz_cache:
+			_tz_cache[offset] = dateutil.tz.tzoffset(None, offset)
+		try:
+			return datetime(int(m.group(3)), month, int(m.group(1)), int(m.group(4)), int(m.group(5)), int(m.group(6) or 0), tzinfo=_tz_cache[offset])
+		except ValueError:
+			return None
+
+	def parse_date(self, d):
+		if d in _date_cache:
+			self.date = _date_cache[d]
+			return True
+
+		self.date = self.parse_date_rfc2822(d)
+		if self.date is None:
+			# Anything else goes through the slow path, which knows
+			# about all the weird formats out there
+			if not self.parse_date_fallback(d):
+				return False
+
+		if self.date.utcoffset():
+			# We have some messages with completely incorrect utc offsets,
+			# so we need to reject those too
+			if self.date.utcoffset() > timedelta(hours=12) or self.date.utcoffset() < timedelta(hours=-12):
+				log("Failed to parse date %s', timezone offset out of range." % d)
+				return False
+
+		if len(_date_cache) >= _date_cache_max:
+			_date_cache.clear()
+		_date_cache[d] = self.date
 		return True
 
 	_date_multi_re = re.compile(' \((\w+\s\w+|)\)$')
 	_date_trailing_envelope = re.compile('\s+\(envelope.*\)$')
-	def parse_date(self, d):
+	def parse_date_fallback(self, d):
 		# For some reason, we have dates that look like this:
 		# http://archives.postgresql.org/pgsql-bugs/1999-05/msg00018.php
 		# Looks like an mhonarc bug, but let's just remove that trailing
@@ -112,14 +297,6 @@ class ArchivesParser(object):
 		except ValueError:
 			log("Failed to parse date '%s'" % d)
 			return False
-
-		if self.date.utcoffset():
-			# We have some messages with completely incorrect utc offsets,
-			# so we need to reject those too
-			if self.date.utcoffset() > timedelta(hours=12) or self.date.utcoffset() < timedelta(hours=-12):
-				log("Failed to parse date %s', timezone offset out of range." % d)
-				return False
-
 		return True
 
 	# Semi-hacked rot13, because the one used by mhonarc is broken.
@@ -131,31 +308,161 @@ class ArchivesParser(object):
 	def almost_rot13(self, s):
 		return unicode(s).translate(self._arot13_trans)
 
-class RobotsParser(object):
-	def __init__(self, url):
+# Parse a message from an mbox file (as split up by iter_mbox), giving
+# the same fields as ArchivesParser.
+# Messages in an mbox file. The body is the first text/plain part, or the
+# text of the first text/html part for messages without one. If the
+# archives numbered the message in an X-Message-Number header, that's in
+# msgnum, otherwise it's None.
+class MboxParser(ArchivesParser):
+	def parse(self, contents):
+		msg = email.message_from_string(contents)
+		self.subject = self.decode_header(msg.get('Subject', ''))
+		self.author = self.decode_header(msg.get('From', ''))
+		if not self.parse_date(msg.get('Date', '').strip()):
+			return False
 		try:
-			u = urllib.urlopen(url)
-			txt = u.read()
-			u.close()
-			self.disallows = []
-			activeagent = False
-			for l in txt.splitlines():
-				if l.lower().startswith("user-agent: ") and len(l) > 12:
-					if l[12] == "*" or l[12:20] == "pgsearch":
-						activeagent = True
-					else:
-						activeagent = False
-				if activeagent and l.lower().startswith("disallow: "):
-					self.disallows.append(l[10:])
-		except Exception:
-			self.disallows = []
+			self.msgnum = int(msg.get('X-Message-Number', '').strip())
+		except ValueError:
+			self.msgnum = None
+		self.body = u""
+		html = None
+		for part in msg.walk():
+			if part.get_filename():
+				continue
+			if part.get_content_type() == 'text/plain':
+				self.body = self.decode_payload(part)
+				return True
+			if part.get_content_type() == 'text/html' and html is None:
+				html = self.decode_payload(part)
+		if html:
+			# Text outside of the body is skipped, so make sure there is one
+			if not '<body' in html.lower():
+				html = u"<body>" + html
+			p = GenericHtmlParser()
+			p.feed(html)
+			self.body = p.gettext()
+		return True
+
+	def decode_payload(self, part):
+		payload = part.get_payload(decode=True) or ''
+		try:
+			return unicode(payload, part.get_content_charset() or 'us-ascii')
+		except (LookupError, UnicodeDecodeError):
+			return lossy_unicode(payload)
+
+	def decode_header(self, h):
+		parts = []
+		try:
+			for s, charset in email.header.decode_header(h):
+				try:
+					parts.append(unicode(s, charset or 'us-ascii'))
+				except (LookupError, UnicodeDecodeError):
+					parts.append(lossy_unicode(s))
+		except email.errors.HeaderParseError:
+			return lossy_unicode(h)
+		return u" ".join(parts).strip()
+
+_mbox_from_escaped = re.compile('^>(>*From )')
+def iter_mbox(f):
+	# Split an mbox file into messages, without needing the whole file
+	# in memory. A new message starts at a From line at the beginning
+	# of the file or after an empty line.
+	lines = []
+	lastempty = True
+	for l in f:
+		if l.startswith('From ') and lastempty:
+			if lines:
+				yield "".join(lines)
+			lines = []
+		else:
+			lines.append(_mbox_from_escaped.sub(r'\1', l))
+		lastempty = not l.strip()
+	if lines:
+		yield "".join(lines)
+
+# The Allow and Disallow rules from robots.txt that apply to us. Plain
+# rules are kept in a prefix trie (nested dicts, one level per character,
+# with the key None marking the end of a rule), so checking a url only
+# walks as far as it shares a prefix with any rule, however many rules
+# there are. Rules with wildcards (* and a trailing $) are compiled to
+# regexps, and checked only if they are longer than the best plain match.
+# Like the big search engines, the longest matching rule wins, and Allow
+# wins over Disallow for rules of the same length.
+class RobotsParser(object):
+	def __init__(self, txt):
+		self.trie = {}
+		self.wildcards = []
+		activeagent = False
+		for l in txt.splitlines():
+			l = l.split('#', 1)[0]
+			if not ':' in l:
+				continue
+			(k, v) = [x.strip() for x in l.split(':', 1)]
+			k = k.lower()
+			if k == "user-agent":
+				activeagent = (v == "*" or v.startswith("pgsearch"))
+			elif activeagent and v and (k == "allow" or k == "disallow"):
+				self.add_rule(v, k == "allow")
+		self.wildcards.sort(key=lambda w: (-w[0], not w[1]))
+
+	def add_rule(self, path, allow):
+		if '*' in path or path.endswith('$'):
+			r = re.escape(path).replace('\\*', '.*')
+			if r.endswith('\\$'):
+				r = r[:-2] + '$'
+			self.wildcards.append((len(path), allow, re.compile(r)))
+			return
+		node = self.trie
+		for c in path:
+			node = node.setdefault(c, {})
+		node[None] = node.get(None, False) or allow
 
 	def block_url(self, url):
 		# Assumes url comes in as relative
-		for d in self.disallows:
-			if url.startswith(d):
-				return True
-		return False
+		length = -1
+		allow = True
+		node = self.trie
+		depth = 0
+		for c in url:
+			node = node.get(c, None)
+			if node is None:
+				break
+			depth += 1
+			if None in node:
+				length = depth
+				allow = node[None]
+		for (l, a, r) in self.wildcards:
+			if l < length:
+				break
+			if r.match(url):
+				if l > length or a:
+					allow = a
+				break
+		return not allow
+
+# robots.txt of the hosts we've crawled, so it's not fetched over and
+# over again by a process that crawls the same host many times.
+_robots_cache = {}
+_robots_lock = threading.Lock()
+
+def fetch_robots(url, maxage=3600):
+	with _robots_lock:
+		if _robots_cache.has_key(url) and _robots_cache[url][0] > time.time() - maxage:
+			return _robots_cache[url][1]
+	try:
+		u = urllib.urlopen(url)
+		if u.getcode() == 200:
+			txt = u.read()
+		else:
+			txt = ""
+		u.close()
+	except Exception:
+		txt = ""
+	robots = RobotsParser(txt)
+	with _robots_lock:
+		_robots_cache[url] = (time.time(), robots)
+	return robots
 
 
 # Convert a string to unicode, try utf8 first, then latin1, then give
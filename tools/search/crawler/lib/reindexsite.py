@@ -0,0 +1,80 @@
+import re
+
+from lib.log import log
+from lib.sitemapsite import SitemapSiteCrawler
+
+# Reindexing of just the pages of the main site that pgweb tells us have
+# changed, as soon as they change, instead of waiting for the next full
+# crawl. pgweb queues the same expressions it purges from varnish, which
+# are regexps matched against the start of the url. Those are matched
+# against the pages we already have indexed. An expression that is just
+# a plain url we don't have yet is looked up in the sitemaps, and crawled
+# with the priority it has there, so new pages get indexed too. Anything
+# else is left for the next full crawl.
+
+# Characters that make an expression more than just a url (a dot is most
+# likely just a dot, as in /events.rss)
+_expr_special = re.compile('[][\\\\*+?(){}|^$]')
+
+class ReindexSiteCrawler(SitemapSiteCrawler):
+	def reindex(self, exprs):
+		"""
+		Recrawl all pages matching any of the expressions in exprs. Returns
+		the number of pages that were added, updated or deleted.
+		"""
+		self.pages_crawled = {}
+		self.pages_new = self.pages_updated = self.pages_deleted = self.pages_unchanged = 0
+
+		curs = self.dbconn.cursor()
+		curs.execute("SELECT suburl, relprio, isinternal, contenthash FROM webpages WHERE site=%(site)s AND suburl ~ ANY(%(res)s)", {
+			'site': self.siteid,
+			'res': ['^' + e for e in exprs],
+			})
+		pages = {}
+		for suburl, relprio, internal, contenthash in curs.fetchall():
+			pages[suburl] = (relprio, internal)
+			self.contenthashes[suburl] = contenthash
+		new = set()
+		for e in exprs:
+			if e.endswith('$'):
+				e = e[:-1]
+			if e.startswith('/') and not _expr_special.search(e) and not pages.has_key(e):
+				new.add(e)
+		if new:
+			pages.update(self.find_in_sitemaps(new))
+
+		self.writer.start()
+		try:
+			for url, (relprio, internal) in pages.items():
+				# We've been told the page has changed, so always get the
+				# full page
+				self.scantimes.pop(url, None)
+				self.etags.pop(url, None)
+				try:
+					self.crawl_page(url, relprio, internal)
+				except Exception, e:
+					log("Exception reindexing '%s': %s" % (url, e))
+		finally:
+			self.writer.close()
+			self.dbconn.commit()
+
+		log("%s: Reindexed %s pages, wrote %s updated and %s new, deleted %s, %s unchanged." % (self.hostname, len(self.pages_crawled), self.pages_updated, self.pages_new, self.pages_deleted, self.pages_unchanged))
+		return self.pages_new + self.pages_updated + self.pages_deleted
+
+	def find_in_sitemaps(self, urls):
+		"""
+		Look up urls in sitemap.xml and sitemap_internal.xml, returning a
+		dict of (relprio, internal) for the ones that are there.
+		"""
+		found = {}
+		def _found(url, prio, lastmod, internal):
+			url = url[len(self.hostname)+8:]
+			if url in urls:
+				found[url] = (prio, internal)
+		try:
+			for sitemap, internal in (("sitemap.xml", False), ("sitemap_internal.xml", True)):
+				self.crawl_sitemap("https://%s/%s" % (self.hostname, sitemap), internal, set(), _found)
+		except Exception, e:
+			log("Failed to load sitemaps, leaving new pages for the full crawl: %s" % e)
+			return {}
+		return found
@@ -1,13 +1,21 @@
 import urllib
 import xml.parsers.expat
+import zlib
 import dateutil.parser
 
 from lib.log import log
 from lib.basecrawler import BaseSiteCrawler
 
+# Sitemaps are parsed as they are downloaded, and every url is handed to
+# the callback as soon as it has been parsed, so there is never a need
+# to hold all of a (possibly huge) sitemap in memory. Gzipped sitemaps
+# are decompressed on the fly. For a sitemap index, the locations of the
+# sitemaps it lists are collected in sitemaps.
+
 class SitemapParser(object):
-	def __init__(self):
-		self.urls = []
+	def __init__(self, callback):
+		self.callback = callback
+		self.sitemaps = []
 
 	def parse(self, f, internal=False):
 		self.parser = xml.parsers.expat.ParserCreate()
@@ -24,10 +32,26 @@ class SitemapParser(object):
 		self.parser.CharacterDataHandler = lambda data: self.processcharacterdata(data)
 		self.internal = internal
 
-		self.parser.ParseFile(f)
+		decompressor = None
+		first = True
+		while True:
+			chunk = f.read(65536)
+			if first and chunk[:2] == '\x1f\x8b':
+				# gzip magic, whatever the url or content-type said
+				decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+			first = False
+			if decompressor:
+				if chunk:
+					self.parser.Parse(decompressor.decompress(chunk), False)
+				else:
+					self.parser.Parse(decompressor.flush(), True)
+			else:
+				self.parser.Parse(chunk, not chunk)
+			if not chunk:
+				break
 
 	def processelement(self, name, attrs):
-		if name == "url":
+		if name == "url" or name == "sitemap":
 			self.currenturl = ""
 			self.currentprio = 0
 			self.currentlastmod = None
@@ -44,7 +68,7 @@ class SitemapParser(object):
 	def processendelement(self, name):
 		if name == "loc":
 			self.geturl = False
-			self.currenturl = self.currstr
+			self.currenturl = self.currstr.strip()
 		elif name == "priority":
 			self.getprio = False
 			self.currentprio = float(self.currstr)
@@ -52,51 +76,77 @@ class SitemapParser(object):
 			self.getlastmod = False
 			self.currentlastmod = dateutil.parser.parse(self.currstr)
 		elif name == "url":
-			self.urls.append((self.currenturl, self.currentprio, self.currentlastmod, self.internal))
+			self.callback(self.currenturl, self.currentprio, self.currentlastmod, self.internal)
+		elif name == "sitemap":
+			self.sitemaps.append(self.currenturl)
 
 	def processcharacterdata(self, data):
 		if self.geturl or self.getprio or self.getlastmod:
 			self.currstr += data
 
 class SitemapSiteCrawler(BaseSiteCrawler):
-	def __init__(self, hostname, dbconn, siteid, serverip, https=False):
-		super(SitemapSiteCrawler, self).__init__(hostname, dbconn, siteid, serverip, https)
+	def __init__(self, hostname, dbconn, siteid, serverip, https=False, **kwargs):
+		super(SitemapSiteCrawler, self).__init__(hostname, dbconn, siteid, serverip, https, **kwargs)
+		self.sitemap_pages = 0
 
 	def init_crawl(self):
+		pass
+
+	def seed_crawl(self):
 		# Fetch the sitemap. We ignore robots.txt in this case, and
 		# assume it's always under /sitemap.xml
-		u = urllib.urlopen("https://%s/sitemap.xml" % self.hostname)
-		p = SitemapParser()
-		p.parse(u)
-		u.close()
+		if not self.crawl_sitemap("https://%s/sitemap.xml" % self.hostname, False, set()):
+			raise Exception("Could not load sitemap.xml")
 
 		# Attempt to fetch a sitempa_internal.xml. This is used to index
 		# pages on our internal search engine that we don't want on
 		# Google. They should also be excluded from default search
 		# results (unless searching with a specific suburl)
-		u = urllib.urlopen("https://%s/sitemap_internal.xml" % self.hostname)
-		if u.getcode() == 200:
-			p.parse(u, True)
-		u.close()
-
-		for url, prio, lastmod, internal in p.urls:
-			# Advance 8 characters - length of https://.
-			url = url[len(self.hostname)+8:]
-			if lastmod:
-				if self.scantimes.has_key(url):
-					if lastmod < self.scantimes[url]:
-						# Not modified since last scan, so don't reload
-						# Stick it in the list of pages we've scanned though,
-						# to make sure we don't remove it...
-						self.pages_crawled[url] = 1
-						continue
-			self.queue.put((url, prio, internal))
+		self.crawl_sitemap("https://%s/sitemap_internal.xml" % self.hostname, True, set())
 
-		log("About to crawl %s pages from sitemap" % self.queue.qsize())
+		log("%s: Queued %s pages from sitemap" % (self.hostname, self.sitemap_pages))
+
+	def crawl_sitemap(self, url, internal, seen, callback=None):
+		# Queue all pages in the sitemap at url (or hand them to callback
+		# instead). If it's a sitemap index, do the same for all the
+		# sitemaps in it.
+		seen.add(url)
+		u = urllib.urlopen(url)
+		try:
+			if u.getcode() != 200:
+				return False
+			p = SitemapParser(callback or self.queue_sitemap_url)
+			p.parse(u, internal)
+		finally:
+			u.close()
+
+		# Every sitemap listed in an index has to load, or we'd end up
+		# removing all the pages in it
+		for s in p.sitemaps:
+			if not s in seen:
+				if not self.crawl_sitemap(s, internal, seen, callback):
+					raise Exception("Could not load sitemap %s" % s)
+		return True
+
+	def queue_sitemap_url(self, url, prio, lastmod, internal):
+		# Advance 8 characters - length of https://.
+		url = url[len(self.hostname)+8:]
+		if lastmod and not self.warcfull:
+			if self.scantimes.has_key(url):
+				if lastmod < self.scantimes[url]:
+					# Not modified since last scan, so don't reload
+					# Stick it in the list of pages we've scanned though,
+					# to make sure we don't remove it...
+					with self.counterlock:
+						self.pages_crawled[url] = 1
+					self.frontier.add(url, prio, internal, True)
+					return
+		self.frontier.add(url, prio, internal)
+		self.sitemap_pages += 1
 
 	# Stub functions used when crawling, ignored here
 	def queue_url(self, url):
 		pass
 
-	def post_process_page(self, url):
+	def post_process_page(self, url, page):
 		pass
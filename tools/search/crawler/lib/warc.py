@@ -0,0 +1,198 @@
+from cStringIO import StringIO
+import httplib
+import os
+import threading
+import time
+import uuid
+import zlib
+
+# Writing and reading of WARC files, the standard format for web archives.
+# Every record is compressed as a separate gzip member, so the files can
+# be read by any WARC tool, and a single record can be read by seeking
+# straight to it.
+#
+# The crawler can write all the responses it gets to WARC files, which
+# can later be used to rebuild the index without fetching everything
+# again (e.g. after changing the text search configuration), or be served
+# up again to benchmark the crawler without hitting the real sites.
+
+class WarcWriter(object):
+	def __init__(self, directory, prefix, maxsize=1024*1024*1024):
+		self.directory = directory
+		self.prefix = prefix
+		self.maxsize = maxsize
+		self.lock = threading.Lock()
+		self.f = None
+		self.filenum = 0
+
+	def _open(self):
+		self.filenum += 1
+		fn = os.path.join(self.directory, "%s-%s-%05d.warc.gz" % (self.prefix, time.strftime("%Y%m%d%H%M%S"), self.filenum))
+		self.f = open(fn, "wb")
+		self._write_record("warcinfo", None, "application/warc-fields", "software: pgsearch/0.2\r\nformat: WARC File Format 1.0\r\n")
+
+	def _write_record(self, warctype, url, contenttype, block):
+		headers = [
+			"WARC/1.0",
+			"WARC-Type: %s" % warctype,
+			"WARC-Record-ID: <urn:uuid:%s>" % uuid.uuid4(),
+			"WARC-Date: %s" % time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+			]
+		if url:
+			headers.append("WARC-Target-URI: %s" % url)
+		headers.append("Content-Type: %s" % contenttype)
+		headers.append("Content-Length: %s" % len(block))
+		c = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+		self.f.write(c.compress("\r\n".join(headers) + "\r\n\r\n" + block + "\r\n\r\n") + c.flush())
+
+	def write_response(self, url, resp, data):
+		# The body has already been read (and de-chunked), so the headers
+		# are written without any transfer encoding
+		block = ["HTTP/%s %s %s\r\n" % (resp.version == 10 and "1.0" or "1.1", resp.status, resp.reason)]
+		for l in resp.msg.headers:
+			if not l.lower().startswith("transfer-encoding:"):
+				block.append(l.rstrip("\r\n") + "\r\n")
+		block.append("\r\n")
+		block.append(data)
+		with self.lock:
+			if self.f and self.f.tell() > self.maxsize:
+				self.f.close()
+				self.f = None
+			if not self.f:
+				self._open()
+			self._write_record("response", url, "application/http; msgtype=response", "".join(block))
+
+	def close(self):
+		with self.lock:
+			if self.f:
+				self.f.close()
+				self.f = None
+
+
+def _gzip_members(f):
+	# Yields (offset, data) for each gzip member in f, starting at the
+	# current position, with offset being relative to that position.
+	offset = 0
+	pending = ""
+	while True:
+		chunk = pending or f.read(65536)
+		pending = ""
+		if not chunk:
+			return
+		d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+		start = offset
+		data = []
+		while chunk:
+			data.append(d.decompress(chunk))
+			if d.unused_data:
+				offset += len(chunk) - len(d.unused_data)
+				pending = d.unused_data
+				break
+			offset += len(chunk)
+			chunk = f.read(65536)
+		else:
+			data.append(d.flush())
+		yield (start, "".join(data))
+
+def _parse_record(data):
+	(head, block) = data.split("\r\n\r\n", 1)
+	headers = {}
+	for l in head.split("\r\n")[1:]:
+		(k, v) = l.split(":", 1)
+		headers[k.strip().lower()] = v.strip()
+	return (headers, block[:int(headers['content-length'])])
+
+def iter_warc(filename):
+	"""
+	Yield a tuple of (offset, headers, block) for each record in a WARC
+	file. The names of the headers are lowercased.
+	"""
+	with open(filename, "rb") as f:
+		for offset, data in _gzip_members(f):
+			(headers, block) = _parse_record(data)
+			yield (offset, headers, block)
+
+class WarcResponse(object):
+	# Just enough of a PooledResponse for the crawler
+	def __init__(self, status, reason, msg, body=""):
+		self.status = status
+		self.reason = reason
+		self.version = 11
+		self.msg = msg
+		self.will_close = False
+		self.body = body
+
+	def getheader(self, name, default=None):
+		return self.msg.getheader(name, default)
+
+	def read(self):
+		return self.body
+
+	def discard(self):
+		pass
+
+def parse_response(block):
+	"""
+	Parse the block of a WARC response record into a tuple of a response
+	object and the body.
+	"""
+	(head, body) = block.split("\r\n\r\n", 1)
+	(statusline, head) = (head + "\r\n").split("\r\n", 1)
+	(version, status, reason) = (statusline + " ").split(" ", 2)
+	return (WarcResponse(int(status), reason.strip(), httplib.HTTPMessage(StringIO(head + "\r\n")), body), body)
+
+class WarcIndex(object):
+	"""
+	Index of the latest response for every url in a set of WARC files,
+	with the responses themselves left in the files until they're needed.
+	Not modified responses are skipped if there is an earlier response
+	for the same url, since that is what the url returned at the time.
+	"""
+	def __init__(self, filenames):
+		self.records = {}
+		# Files are named by the time they were started, and records in a
+		# file are in the order they were fetched, so the last one wins
+		for fn in sorted(filenames, key=os.path.basename):
+			for offset, headers, block in iter_warc(fn):
+				if headers.get('warc-type', None) != 'response':
+					continue
+				url = headers['warc-target-uri']
+				if self.records.has_key(url) and block[9:12] == "304":
+					continue
+				self.records[url] = (fn, offset)
+
+	def get(self, url):
+		# Returns a tuple of (response, body), or None if the url isn't in
+		# the index
+		if not self.records.has_key(url):
+			return None
+		(fn, offset) = self.records[url]
+		with open(fn, "rb") as f:
+			f.seek(offset)
+			for o, data in _gzip_members(f):
+				return parse_response(_parse_record(data)[1])
+
+	def urls(self, base):
+		# All the urls under base (e.g. https://www.postgresql.org), as
+		# host relative urls
+		return [u[len(base):] for u in self.records.keys() if u.startswith(base + "/")]
+
+class WarcReplayPool(object):
+	"""
+	Stand-in for a HostConnectionPool that returns the responses from a
+	WarcIndex instead of fetching anything.
+	"""
+	def __init__(self, index, base):
+		self.index = index
+		self.base = base
+		self.connects = 0
+		self.reused = 0
+
+	def request(self, url, headers):
+		r = self.index.get(self.base + url)
+		if r is None:
+			return WarcResponse(404, "Not Found", httplib.HTTPMessage(StringIO("\r\n")))
+		return r[0]
+
+	def closeall(self):
+		pass
@@ -0,0 +1,37 @@
+from lib.basecrawler import BaseSiteCrawler
+from lib.warc import WarcReplayPool
+
+# Rebuild the index of a site from the responses saved in WARC files by
+# an earlier crawl, without fetching anything. Every page in the WARC
+# files is parsed and written again, even if its text hasn't changed,
+# since the point is usually to rebuild the tsvectors. Pages we have in
+# the index that aren't in the WARC files are left alone.
+
+class WarcSiteCrawler(BaseSiteCrawler):
+	def __init__(self, hostname, dbconn, siteid, https=False, index=None, **kwargs):
+		super(WarcSiteCrawler, self).__init__(hostname, dbconn, siteid, https=https, **kwargs)
+		self.index = index
+		self.fetcher = WarcReplayPool(index, "%s://%s" % (https and "https" or "http", hostname))
+		self.contenthashes = {}
+
+	def init_crawl(self):
+		# Keep the priorities the pages already have, since they aren't
+		# in the WARC files
+		curs = self.dbconn.cursor()
+		curs.execute("SELECT suburl, relprio, isinternal FROM webpages WHERE site=%(site)s", {'site': self.siteid})
+		pages = dict([(suburl, (relprio, internal)) for suburl, relprio, internal in curs.fetchall()])
+
+		urls = self.index.urls(self.fetcher.base)
+		for url in urls:
+			(relprio, internal) = pages.pop(url, (0.5, False))
+			self.frontier.add(url, relprio, internal)
+		for url, (relprio, internal) in pages.items():
+			self.frontier.add(url, relprio, internal, True)
+
+	# Only what's in the WARC files is indexed, so links and redirects
+	# aren't followed
+	def queue_url(self, url):
+		pass
+
+	def post_process_page(self, url, page):
+		pass
@@ -18,6 +18,10 @@ def doit(opt):
 
 	curs = conn.cursor()
 
+	# Make sure the partitions for messages that are about to arrive exist
+	curs.execute("SELECT messages_create_partition(y) FROM generate_series(extract(year FROM CURRENT_DATE)::int, extract(year FROM CURRENT_DATE)::int+1) y")
+	conn.commit()
+
 	if opt.list:
 		# Multiple lists can be specified with a comma separator (no spaces)
 		curs.execute("SELECT id,name FROM lists WHERE name=ANY(%(names)s)", {
@@ -28,7 +32,7 @@ def doit(opt):
 
 	listinfo = [(id,name) for id,name in curs.fetchall()]
 	c = MultiListCrawler(listinfo, conn, opt.status_interval, opt.commit_interval)
-	n = c.crawl(opt.full, opt.month)
+	n = c.crawl(opt.full, opt.month, opt.bulk)
 
 	# Update total counts
 	curs.execute("WITH t AS (SELECT list,count(*) AS c FROM messages GROUP BY list) UPDATE lists SET pagecount=t.c FROM t WHERE id=t.list")
@@ -46,6 +50,7 @@ if __name__=="__main__":
 	parser.add_option("-f", "--full", dest='full', action="store_true", help="Make a full crawl")
 	parser.add_option("-t", "--status-interval", dest='status_interval', help="Seconds between status updates")
 	parser.add_option("-c", "--commit-interval", dest='commit_interval', help="Messages between each commit")
+	parser.add_option("-b", "--bulk", dest='bulk', help="Load whole months from mbox files at this path or url, with {list}, {year} and {month} in it (e.g. /srv/mbox/{list}/{list}.{year:04d}{month:02d}). Messages without an X-Message-Number header are numbered by their position in the mbox, which must be the same order as in the archives")
 
 	(opt, args) = parser.parse_args()
 
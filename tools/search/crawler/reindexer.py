@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# reindexer.py - reindex pages on the main site as soon as they change
+#
+# Listens for notifications from pgweb whenever it queues pages for
+# reindexing (see sql/searchqueue.sql in pgweb), and recrawls just those
+# pages. The full crawl still needs to run once in a while, to pick up
+# changes pgweb doesn't know about, but not nearly as often.
+#
+# Only the main site is reindexed, and just like in webcrawler.py it's
+# hardcoded as www.postgresql.org with site id 1.
+#
+
+from lib.log import log
+from lib.reindexsite import ReindexSiteCrawler
+from lib.threadwrapper import threadwrapper
+
+from ConfigParser import ConfigParser
+import psycopg2
+import select
+import time
+
+def doit():
+	psycopg2.extensions.register_type(psycopg2.extensions.UNICODE)
+	conn = psycopg2.connect(cp.get("search", "db"))
+	queueconn = psycopg2.connect(cp.get("search", "pgwebdb"))
+
+	# Wait this long after being notified before fetching the pages, so
+	# that varnish has been purged, and so that changes made together are
+	# handled together.
+	delay = cp.has_option("search", "reindexdelay") and cp.getfloat("search", "reindexdelay") or 2
+	htmlparser = cp.has_option("search", "htmlparser") and cp.get("search", "htmlparser") or None
+
+	crawler = ReindexSiteCrawler("www.postgresql.org", conn, 1, cp.get("search", "frontendip"), True, htmlparser=htmlparser, dsn=cp.get("search", "db"))
+
+	curs = queueconn.cursor()
+	curs.execute("LISTEN searchqueue")
+	queueconn.commit()
+
+	while True:
+		# See if there is something to pick up off the queue
+		curs.execute("SELECT id, url FROM searchqueue.queue FOR UPDATE")
+		res = curs.fetchall()
+
+		if len(res):
+			try:
+				if crawler.reindex(list(set([r[1] for r in res]))):
+					# Cached search hits may now be outdated
+					conn.cursor().execute("SELECT site_search_cache_cleanup('0')")
+					conn.commit()
+			except Exception, e:
+				log("Failed to reindex: %s" % e)
+				conn.rollback()
+				queueconn.rollback()
+				time.sleep(30)
+				continue
+
+			# Then remove from queue
+			curs.execute("DELETE FROM searchqueue.queue WHERE id=ANY(%(idlist)s)", {
+				'idlist': [r[0] for r in res],
+			})
+			queueconn.commit()
+		else:
+			# Nothing, so roll back the transaction and wait
+			queueconn.rollback()
+
+			select.select([queueconn],[],[],5*60)
+			queueconn.poll()
+			while queueconn.notifies:
+				queueconn.notifies.pop()
+
+			# Since we're running anyway, get rid of cached search hits
+			# that are too old to be used
+			conn.cursor().execute("SELECT site_search_cache_cleanup()")
+			conn.commit()
+
+			time.sleep(delay)
+			# Loop back up and process the full queue
+
+
+if __name__=="__main__":
+	cp = ConfigParser()
+	cp.read("search.ini")
+
+	threadwrapper(doit)
@@ -4,38 +4,137 @@
 from lib.log import log
 from lib.genericsite import GenericSiteCrawler
 from lib.sitemapsite import SitemapSiteCrawler
+from lib.warcsite import WarcSiteCrawler
+from lib.warc import WarcIndex
 from lib.threadwrapper import threadwrapper
 
 from ConfigParser import ConfigParser
+from optparse import OptionParser
+from Queue import Queue, Empty
 import psycopg2
+import sys
+import threading
 import time
 
-def doit():
+def crawl_site(crawlerclass, args, kwargs):
+	# Each site gets its own database connection, so that the sites
+	# crawled at the same time don't have to take turns on it.
+	conn = psycopg2.connect(cp.get("search","db"))
+	try:
+		crawlerclass(args[0], conn, *args[1:], **kwargs).crawl()
+		conn.commit()
+	except Exception, e:
+		log("Failed to crawl %s: %s" % (args[0], e))
+	finally:
+		conn.close()
+
+def crawl_from_queue(sitequeue, kwargs):
+	while True:
+		try:
+			(crawlerclass, args, politeness) = sitequeue.get(False)
+		except Empty:
+			return
+		log("Starting indexing of %s" % args[0])
+		k = dict(kwargs)
+		k.update(politeness)
+		crawl_site(crawlerclass, args, k)
+
+def getint(name, default):
+	return cp.has_option("search", name) and cp.getint("search", name) or default
+
+def getfloat(name, default):
+	return cp.has_option("search", name) and cp.getfloat("search", name) or default
+
+def doit(opt, warcfiles):
 	psycopg2.extensions.register_type(psycopg2.extensions.UNICODE)
 	conn = psycopg2.connect(cp.get("search","db"))
 
 	curs = conn.cursor()
 
-	# Start by indexing the main website
-	log("Starting indexing of main website")
-	SitemapSiteCrawler("www.postgresql.org", conn, 1, cp.get("search", "frontendip"), True).crawl()
+	# Number of worker threads per site, and how many of them are allowed
+	# to talk to the site at the same time
+	threads = getint("threads", 5)
+	maxconn = getint("hostconnections", 5)
+	# Pages are written in batches of this size, or at least this often
+	writebatch = getint("writebatch", 200)
+	writeinterval = getint("writeinterval", 5)
+	# Number of sites crawled at the same time, and the max number of
+	# requests in flight to all of them together
+	parallelsites = getint("parallelsites", 4)
+	budget = threading.BoundedSemaphore(getint("maxrequests", 32))
+	# Min seconds between requests to sites other than the main one
+	requestdelay = getfloat("requestdelay", 0)
+	# python (the default) or lxml, which has to be asked for explicitly
+	htmlparser = cp.has_option("search", "htmlparser") and cp.get("search", "htmlparser") or None
+	# Directory to write Prometheus textfiles with crawl metrics to
+	metricsdir = cp.has_option("search", "metricsdir") and cp.get("search", "metricsdir") or None
+	# Directory to write WARC files with all fetched responses to, and
+	# whether to fetch all pages in full, even if they haven't changed
+	warcdir = cp.has_option("search", "warcdir") and cp.get("search", "warcdir") or None
+	warcfull = cp.has_option("search", "warcfull") and cp.getboolean("search", "warcfull")
+
+	kwargs = {
+		'threads': threads,
+		'maxconn': maxconn,
+		'writebatch': writebatch,
+		'writeinterval': writeinterval,
+		'budget': budget,
+		'htmlparser': htmlparser,
+		'metricsdir': metricsdir,
+		'dsn': cp.get("search", "db"),
+		}
+
+	sitequeue = Queue()
+	if opt.fromwarc:
+		# Rebuild the index of all the sites from the WARC files, without
+		# crawling anything
+		index = WarcIndex(warcfiles)
+		log("Loaded %s urls from %s WARC files" % (len(index.records), len(warcfiles)))
+		curs.execute("SELECT id, hostname, https FROM sites ORDER BY pagecount DESC")
+		for siteid, hostname, https in curs.fetchall():
+			# The main site is always crawled over https
+			sitequeue.put((WarcSiteCrawler, (hostname, siteid, https or siteid == 1), {'index': index}))
+	else:
+		kwargs['warcdir'] = warcdir
+		kwargs['warcfull'] = warcfull
+		# The main website goes first, since it's by far the largest one. Then
+		# all the others (skipping id=1, which is the main site..)
+		sitequeue.put((SitemapSiteCrawler, ("www.postgresql.org", 1, cp.get("search", "frontendip"), True), {}))
+		curs.execute("SELECT id, hostname, https FROM sites WHERE id>1 ORDER BY pagecount DESC")
+		for siteid, hostname, https in curs.fetchall():
+			sitequeue.put((GenericSiteCrawler, (hostname, siteid, https), {'mindelay': requestdelay}))
 	conn.commit()
 
-	# Skip id=1, which is the main site..
-	curs.execute("SELECT id, hostname, https FROM sites WHERE id>1")
-	for siteid, hostname, https in curs.fetchall():
-		log("Starting indexing of %s" % hostname)
-		GenericSiteCrawler(hostname, conn, siteid, https).crawl()
-		conn.commit()
+	sitethreads = []
+	for x in range(parallelsites):
+		t = threading.Thread(name="Site %s" % x, target=lambda: crawl_from_queue(sitequeue, kwargs))
+		t.daemon = True
+		t.start()
+		sitethreads.append(t)
+	for t in sitethreads:
+		t.join()
 
 	curs.execute("WITH t AS (SELECT site,count(*) AS c FROM webpages GROUP BY site) UPDATE sites SET pagecount=t.c FROM t WHERE id=t.site")
+	# Any cached search hits are now outdated
+	curs.execute("SELECT site_search_cache_cleanup('0')")
+	curs.execute("SELECT suggestions_rebuild()")
+	log("Rebuilt %s title suggestions" % curs.fetchone()[0])
 	conn.commit()
 
 	time.sleep(1)
 
 
 if __name__=="__main__":
+	parser = OptionParser(usage="usage: %prog [options] [warcfile ...]")
+	parser.add_option("-w", "--fromwarc", dest='fromwarc', action="store_true", help="Reindex from the given WARC files instead of crawling")
+
+	(opt, args) = parser.parse_args()
+
+	if opt.fromwarc and not args:
+		print "WARC files must be specified"
+		sys.exit(1)
+
 	cp = ConfigParser()
 	cp.read("search.ini")
 
-	threadwrapper(doit)
+	threadwrapper(doit, opt, args)
@@ -3,10 +3,6 @@ RETURNS TABLE (listname text, year int, month int, msgnum int, date timestamptz,
 AS $$
 DECLARE
    tsq tsquery;
-   qry text;
-   hits int;
-   hit RECORD;
-   curs refcursor;
    pagecount int;
    listary int[];
 BEGIN
@@ -16,15 +12,8 @@ BEGIN
       RETURN;
    END IF;
 
-   hits := 0;
-
    IF _lists IS NULL THEN
       SELECT INTO pagecount sum(lists.pagecount) FROM lists;
-      IF sort = 'd' THEN
-         OPEN curs FOR SELECT m.list,m.year,m.month,m.msgnum,ts_rank_cd(m.fti,tsq) FROM messages m WHERE m.fti @@ tsq AND m.date>COALESCE(firstdate,'1900-01-01') ORDER BY m.date DESC LIMIT 1000;
-      ELSE
-         OPEN curs FOR SELECT m.list,m.year,m.month,m.msgnum,ts_rank_cd(m.fti,tsq) FROM messages m WHERE m.fti @@ tsq AND m.date>COALESCE(firstdate,'1900-01-01') ORDER BY ts_rank_cd(m.fti,tsq) DESC LIMIT 1000;
-      END IF;
    ELSE
       IF _lists < 0 THEN
          SELECT INTO listary ARRAY(SELECT id FROM lists WHERE grp=-_lists);
@@ -32,44 +21,44 @@ BEGIN
          listary = ARRAY[_lists];
       END IF;
       SELECT INTO pagecount sum(lists.pagecount) FROM lists WHERE id=ANY(listary);
-      IF sort = 'd' THEN
-         OPEN curs FOR SELECT m.list,m.year,m.month,m.msgnum,ts_rank_cd(m.fti,tsq) FROM messages m WHERE (m.list=ANY(listary)) AND m.fti @@ tsq AND m.date>COALESCE(firstdate,'1900-01-01') ORDER BY m.date DESC LIMIT 1000;
-      ELSE
-         OPEN curs FOR SELECT m.list,m.year,m.month,m.msgnum,ts_rank_cd(m.fti,tsq) FROM messages m WHERE (m.list=ANY(listary)) AND m.fti @@ tsq AND m.date>COALESCE(firstdate,'1900-01-01') ORDER BY ts_rank_cd(m.fti,tsq) DESC LIMIT 1000;
-      END IF;
    END IF;
-   LOOP
-      FETCH curs INTO hit;
-      IF NOT FOUND THEN
-         EXIT;
-      END IF;
-      hits := hits+1;
-      IF (hits < startofs+1) OR (hits > startofs + hitsperpage) THEN
-         CONTINUE;
-      END IF;
-      RETURN QUERY SELECT lists.name::text, hit.year, hit.month, hit.msgnum, messages.date, messages.subject::text, messages.author::text, ts_headline(messages.txt,tsq,'StartSel="[[[[[[",StopSel="]]]]]]"'), hit.ts_rank_cd::float FROM messages INNER JOIN lists ON messages.list=lists.id WHERE messages.list=hit.list AND messages.year=hit.year AND messages.month=hit.month AND messages.msgnum=hit.msgnum;
-   END LOOP;
 
-   listname := NULL; msgnum := NULL; date := NULL; subject := NULL; author := NULL; headline := NULL; rank := NULL;
-   year=hits;
-   month=pagecount;
-   RETURN NEXT;
+   -- Rank all hits (up to 1000) in one pass, and then fetch subject,
+   -- author and headline for the requested page in the same statement.
+   -- The filter on year lets the planner skip all partitions of messages
+   -- that are older than firstdate. The year of the archive a message is
+   -- in isn't always the year in its date, so allow for a year of slack.
+   RETURN QUERY SELECT x.listname, x.year, x.month, x.msgnum, x.date, x.subject, x.author, x.headline, x.rank FROM (
+      WITH hits AS (
+         SELECT m.list, m.year, m.month, m.msgnum, m.date, ts_rank_cd(m.fti,tsq) AS r,
+                row_number() OVER (ORDER BY CASE WHEN sort='d' THEN m.date END DESC, ts_rank_cd(m.fti,tsq) DESC) AS n
+         FROM messages m
+         WHERE (listary IS NULL OR m.list=ANY(listary)) AND m.fti @@ tsq AND m.date>COALESCE(firstdate,'1900-01-01') AND m.year>=COALESCE(extract(year FROM firstdate)::int-1, 0)
+         ORDER BY n
+         LIMIT 1000
+      )
+      SELECT lists.name::text AS listname, h.year, h.month, h.msgnum, msg.date, msg.subject::text AS subject, msg.author::text AS author, ts_headline(msg.txt,tsq,'StartSel="[[[[[[",StopSel="]]]]]]"') AS headline, h.r::float AS rank, h.n
+      FROM hits h
+      INNER JOIN messages msg ON msg.list=h.list AND msg.year=h.year AND msg.month=h.month AND msg.msgnum=h.msgnum
+      INNER JOIN lists ON lists.id=h.list
+      WHERE h.n > startofs AND h.n <= startofs + hitsperpage
+      UNION ALL
+      SELECT NULL::text, (SELECT count(*) FROM hits)::int, pagecount, NULL::int, NULL::timestamptz, NULL::text, NULL::text, NULL::text, NULL::float, 1001
+   ) x ORDER BY x.n;
 END;
 $$
 LANGUAGE 'plpgsql';
 ALTER FUNCTION archives_search(text, int, timestamptz, timestamptz, int, int, char) SET default_text_search_config = 'public.pg';
 
 
-CREATE OR REPLACE FUNCTION site_search(query text, startofs int, hitsperpage int, allsites bool, _suburl text, includeinternal boolean DEFAULT False)
+DROP FUNCTION IF EXISTS site_search(text, int, int, bool, text, bool);
+CREATE OR REPLACE FUNCTION site_search(query text, startofs int, hitsperpage int, allsites bool, _suburl text, includeinternal boolean DEFAULT False, withheadlines boolean DEFAULT True)
 RETURNS TABLE (siteid int, baseurl text, suburl text, title text, headline text, rank float)
 AS $$
 DECLARE
     tsq tsquery;
-    qry text;
-    hits int;
-    hit RECORD;
-    curs refcursor;
-    pagecount int;
+    cachekey text;
+    c site_search_cache%ROWTYPE;
 BEGIN
     tsq := plainto_tsquery('public.pg', query);
     IF numnode(tsq) = 0 THEN
@@ -78,32 +67,123 @@ BEGIN
         RETURN;
     END IF;
 
-    hits := 0;
-
+    -- The ranked list of hits only depends on the parsed query and the
+    -- filters, not on which page is requested. So we build it once,
+    -- and then just page through the cached copy for the next pages.
     IF allsites THEN
-        SELECT INTO pagecount sum(sites.pagecount) FROM sites;
-        OPEN curs FOR SELECT sites.id AS siteid, sites.baseurl, webpages.suburl, ts_rank_cd(fti,tsq) * relprio AS ts_rank_cd FROM webpages INNER JOIN sites ON webpages.site=sites.id WHERE fti @@ tsq AND (includeinternal OR NOT isinternal) ORDER BY ts_rank_cd(fti,tsq) * relprio DESC LIMIT 1000;
+        cachekey := md5(tsq::text || '|a|' || includeinternal::text);
     ELSE
-        SELECT INTO pagecount sites.pagecount FROM sites WHERE id=1;
-        IF _suburl IS NULL THEN
-            OPEN curs FOR SELECT sites.id AS siteid, sites.baseurl, webpages.suburl, ts_rank_cd(fti,tsq) * relprio AS ts_rank_cd FROM webpages INNER JOIN sites ON webpages.site=sites.id WHERE fti @@ tsq AND site=1 AND (includeinternal OR NOT isinternal) ORDER BY ts_rank_cd(fti,tsq) * relprio DESC LIMIT 1000;
+        cachekey := md5(tsq::text || '|s|' || COALESCE(_suburl, '') || '|' || includeinternal::text);
+    END IF;
+
+    -- On a standby the (unlogged) cache can't be used at all, so every
+    -- page is searched from scratch there.
+    IF NOT pg_is_in_recovery() THEN
+        SELECT * INTO c FROM site_search_cache WHERE querykey=cachekey AND created > CURRENT_TIMESTAMP - '10 minutes'::interval;
+    END IF;
+    IF c.querykey IS NULL THEN
+        c.querykey := cachekey;
+        c.created := CURRENT_TIMESTAMP;
+        IF allsites THEN
+            SELECT INTO c.pagecount sum(sites.pagecount) FROM sites;
+            SELECT INTO c.siteids, c.suburls, c.ranks COALESCE(array_agg(h.site ORDER BY h.r DESC, h.site, h.suburl), '{}'), COALESCE(array_agg(h.suburl ORDER BY h.r DESC, h.site, h.suburl), '{}'), COALESCE(array_agg(h.r ORDER BY h.r DESC, h.site, h.suburl), '{}') FROM (
+                SELECT webpages.site, webpages.suburl::text, ts_rank_cd(fti,tsq) * relprio AS r FROM webpages WHERE fti @@ tsq AND (includeinternal OR NOT isinternal) ORDER BY ts_rank_cd(fti,tsq) * relprio DESC LIMIT 1000
+            ) h;
         ELSE
-            OPEN curs FOR SELECT sites.id AS siteid, sites.baseurl, webpages.suburl, ts_rank_cd(fti,tsq) * relprio AS ts_rank_cd FROM webpages INNER JOIN sites ON webpages.site=sites.id WHERE fti @@ tsq AND site=1 AND webpages.suburl LIKE _suburl||'%' AND (includeinternal OR NOT isinternal) ORDER BY ts_rank_cd(fti,tsq) * relprio DESC LIMIT 1000;
+            SELECT INTO c.pagecount sites.pagecount FROM sites WHERE id=1;
+            IF _suburl IS NULL THEN
+                SELECT INTO c.siteids, c.suburls, c.ranks COALESCE(array_agg(h.site ORDER BY h.r DESC, h.site, h.suburl), '{}'), COALESCE(array_agg(h.suburl ORDER BY h.r DESC, h.site, h.suburl), '{}'), COALESCE(array_agg(h.r ORDER BY h.r DESC, h.site, h.suburl), '{}') FROM (
+                    SELECT webpages.site, webpages.suburl::text, ts_rank_cd(fti,tsq) * relprio AS r FROM webpages WHERE fti @@ tsq AND site=1 AND (includeinternal OR NOT isinternal) ORDER BY ts_rank_cd(fti,tsq) * relprio DESC LIMIT 1000
+                ) h;
+            ELSE
+                SELECT INTO c.siteids, c.suburls, c.ranks COALESCE(array_agg(h.site ORDER BY h.r DESC, h.site, h.suburl), '{}'), COALESCE(array_agg(h.suburl ORDER BY h.r DESC, h.site, h.suburl), '{}'), COALESCE(array_agg(h.r ORDER BY h.r DESC, h.site, h.suburl), '{}') FROM (
+                    SELECT webpages.site, webpages.suburl::text, ts_rank_cd(fti,tsq) * relprio AS r FROM webpages WHERE fti @@ tsq AND site=1 AND webpages.suburl LIKE _suburl||'%' AND (includeinternal OR NOT isinternal) ORDER BY ts_rank_cd(fti,tsq) * relprio DESC LIMIT 1000
+                ) h;
+            END IF;
+        END IF;
+
+        IF NOT pg_is_in_recovery() THEN
+            INSERT INTO site_search_cache (querykey, created, pagecount, siteids, suburls, ranks)
+               VALUES (c.querykey, c.created, COALESCE(c.pagecount, 0), c.siteids, c.suburls, c.ranks)
+               ON CONFLICT (querykey) DO UPDATE SET created=excluded.created, pagecount=excluded.pagecount, siteids=excluded.siteids, suburls=excluded.suburls, ranks=excluded.ranks;
         END IF;
     END IF;
-    LOOP
-       FETCH curs INTO hit;
-       IF NOT FOUND THEN
-          EXIT;
-       END IF;
-       hits := hits+1;
-       IF (hits < startofs+1) OR (hits > startofs+hitsperpage) THEN
-          CONTINUE;
-       END IF;
-       RETURN QUERY SELECT hit.siteid, hit.baseurl::text, hit.suburl::text, webpages.title::text, ts_headline(webpages.txt,tsq,'StartSel="[[[[[[",StopSel="]]]]]]"'), hit.ts_rank_cd::float * relprio FROM webpages WHERE webpages.site=hit.siteid AND webpages.suburl=hit.suburl;
-    END LOOP;
-    RETURN QUERY SELECT pagecount, NULL::text, NULL::text, NULL::text, NULL::text, hits::float;
+
+    -- Only the hits on the requested page get their title and headline,
+    -- and the headline can be skipped completely if it's not needed.
+    RETURN QUERY SELECT h.siteid, sites.baseurl::text, h.suburl, webpages.title::text, CASE WHEN withheadlines THEN ts_headline(webpages.txt,tsq,'StartSel="[[[[[[",StopSel="]]]]]]"') END, h.rank * webpages.relprio
+       FROM unnest(c.siteids[startofs+1:startofs+hitsperpage], c.suburls[startofs+1:startofs+hitsperpage], c.ranks[startofs+1:startofs+hitsperpage]) WITH ORDINALITY AS h(siteid, suburl, rank, ord)
+       INNER JOIN sites ON sites.id=h.siteid
+       INNER JOIN webpages ON webpages.site=h.siteid AND webpages.suburl=h.suburl
+       ORDER BY h.ord;
+    RETURN QUERY SELECT c.pagecount, NULL::text, NULL::text, NULL::text, NULL::text, COALESCE(array_length(c.siteids, 1), 0)::float;
 END;
 $$
 LANGUAGE 'plpgsql';
-ALTER FUNCTION site_search(text, int, int, bool, text, bool) SET default_text_search_config = 'public.pg';
+ALTER FUNCTION site_search(text, int, int, bool, text, bool, bool) SET default_text_search_config = 'public.pg';
+
+-- Remove cached hit lists that are too old to be used by site_search().
+-- Should be run after each crawl (when they're also outdated), and
+-- regularly from cron (see README). The reindexer daemon also runs it
+-- whenever it wakes up.
+CREATE OR REPLACE FUNCTION site_search_cache_cleanup(maxage interval DEFAULT '10 minutes')
+RETURNS int
+AS $$
+   WITH d AS (DELETE FROM site_search_cache WHERE created < CURRENT_TIMESTAMP - maxage RETURNING 1)
+   SELECT count(*)::int FROM d;
+$$
+LANGUAGE 'sql';
+
+
+-- Create the partition of messages holding one year worth of messages.
+-- Anything that already ended up in the default partition for that year
+-- is moved over.
+CREATE OR REPLACE FUNCTION messages_create_partition(_year int)
+RETURNS void
+AS $$
+BEGIN
+   IF EXISTS (SELECT 1 FROM pg_class WHERE relname='messages_' || _year) THEN
+      RETURN;
+   END IF;
+
+   CREATE TEMP TABLE _moved_messages (LIKE messages);
+   WITH d AS (
+      DELETE FROM messages_default WHERE messages_default.year = _year RETURNING *
+   )
+   INSERT INTO _moved_messages SELECT * FROM d;
+
+   EXECUTE format('CREATE TABLE messages_%s PARTITION OF messages FOR VALUES FROM (%s) TO (%s)',
+                  _year, _year, _year+1);
+
+   INSERT INTO messages SELECT * FROM _moved_messages;
+   DROP TABLE _moved_messages;
+END;
+$$
+LANGUAGE 'plpgsql';
+
+
+CREATE OR REPLACE FUNCTION suggestions_rebuild()
+RETURNS int
+AS $$
+   DELETE FROM suggestions;
+   -- The same title shows up in every version of the docs, so keep only
+   -- one url per title, preferring the main site and the current docs.
+   INSERT INTO suggestions (title, url, weight)
+      SELECT DISTINCT ON (lower(w.title)) w.title, CASE WHEN s.https THEN 'https://' ELSE 'http://' END || s.hostname || w.suburl, w.relprio
+      FROM webpages w INNER JOIN sites s ON s.id=w.site
+      WHERE NOT w.isinternal AND w.title != ''
+      ORDER BY lower(w.title), w.site=1 DESC, w.suburl LIKE '/docs/current/%' DESC, w.relprio DESC;
+   -- Subjects of the threads from the last year, weighted by the size
+   -- of the thread.
+   INSERT INTO suggestions (title, url, weight)
+      SELECT min(subject), NULL, least(1.0, count(*)/20.0)
+      FROM (
+         SELECT regexp_replace(subject, '^(\s*(re|fwd?|aw|sv)(\[\d+\])?:)+\s*', '', 'i') AS subject
+         FROM messages WHERE date > CURRENT_TIMESTAMP - '1 year'::interval
+      ) m
+      WHERE subject != ''
+      GROUP BY lower(subject)
+      HAVING count(*) > 1;
+   SELECT count(*)::int FROM suggestions;
+$$
+LANGUAGE 'sql';
@@ -0,0 +1,43 @@
+-- Convert the messages table of an existing database to the partitioned
+-- one in schema.sql. Works both from the original plain table and from
+-- the earlier version partitioned on date. Load functions.sql first, and
+-- indexes.sql again afterwards.
+--
+-- The earlier version partitioned on date could store the same message
+-- more than once with different dates, only one of them is kept.
+
+BEGIN;
+
+ALTER TABLE messages RENAME TO messages_old;
+ALTER TABLE messages_old RENAME CONSTRAINT pk_messages TO pk_messages_old;
+ALTER TABLE IF EXISTS messages_default RENAME TO messages_default_old;
+DROP INDEX IF EXISTS messages_date_idx;
+DROP INDEX IF EXISTS messages_fti_idx;
+
+CREATE TABLE messages (
+   list int NOT NULL REFERENCES lists(id) ON DELETE CASCADE,
+   year int NOT NULL,
+   month int NOT NULL,
+   msgnum int NOT NULL,
+   date timestamptz NOT NULL,
+   subject varchar(128) NOT NULL,
+   author varchar(128) NOT NULL,
+   txt text NOT NULL,
+   fti tsvector NOT NULL
+) PARTITION BY RANGE (year);
+ALTER TABLE messages ADD CONSTRAINT pk_messages PRIMARY KEY (list,year,month,msgnum);
+CREATE TABLE messages_default PARTITION OF messages DEFAULT;
+
+INSERT INTO messages
+   SELECT DISTINCT ON (list,year,month,msgnum) * FROM messages_old
+   ORDER BY list,year,month,msgnum,date DESC;
+
+-- Also drops the yearly partitions of the earlier version, so they can
+-- be created again below
+DROP TABLE messages_old;
+
+SELECT messages_create_partition(y) FROM generate_series(
+   LEAST((SELECT min(year) FROM messages), 1997),
+   extract(year FROM CURRENT_DATE)::int+1) y;
+
+COMMIT;
@@ -16,8 +16,11 @@ CREATE TABLE messages (
    author varchar(128) NOT NULL,
    txt text NOT NULL,
    fti tsvector NOT NULL
-);
+) PARTITION BY RANGE (year);
 ALTER TABLE messages ADD CONSTRAINT pk_messages PRIMARY KEY (list,year,month,msgnum);
+-- One partition per year is created by messages_create_partition(), this
+-- one just catches anything outside of those.
+CREATE TABLE messages_default PARTITION OF messages DEFAULT;
 
 
 CREATE TABLE sites (
@@ -35,11 +38,60 @@ CREATE TABLE webpages (
    relprio float NOT NULL DEFAULT 0.5,
    isinternal boolean NOT NULL DEFAULT 'f',
    lastscanned timestamptz NULL,
+   contenthash text NULL,
+   etag text NULL,
+   bodysize int NULL,
    txt text NOT NULL,
    fti tsvector NOT NULL
 );
 ALTER TABLE webpages ADD CONSTRAINT pk_webpages PRIMARY KEY (site, suburl);
 
+-- Ranked hit lists for site_search(), so paging through a result
+-- doesn't have to re-run the full search for every page. This is just
+-- a cache, so it doesn't need to survive a crash.
+CREATE UNLOGGED TABLE site_search_cache (
+   querykey text NOT NULL PRIMARY KEY,
+   created timestamptz NOT NULL,
+   pagecount int NOT NULL,
+   siteids int[] NOT NULL,
+   suburls text[] NOT NULL,
+   ranks float[] NOT NULL
+);
+
+-- Page titles and list subjects used for search-as-you-type suggestions.
+-- Rebuilt by suggestions_rebuild() after each crawl, and loaded into
+-- memory by the web frontends. url is NULL for list subjects.
+CREATE TABLE suggestions (
+   title text NOT NULL,
+   url text NULL,
+   weight float NOT NULL
+);
+
+-- The crawl frontier, see crawler/lib/frontier.py. Empty except while a
+-- site is being crawled (or if a crawl was interrupted).
+CREATE TABLE crawlqueue (
+   site int NOT NULL REFERENCES sites(id) ON DELETE CASCADE,
+   suburl varchar(512) NOT NULL,
+   relprio float NOT NULL,
+   isinternal boolean NOT NULL,
+   lastscanned timestamptz NULL,
+   claimed timestamptz NULL,
+   done boolean NOT NULL DEFAULT 'f',
+   PRIMARY KEY (site, suburl)
+);
+CREATE INDEX crawlqueue_todo_idx ON crawlqueue (site, relprio DESC, lastscanned NULLS FIRST) WHERE NOT done;
+
+-- Metrics from each crawl of a site, see crawler/lib/metrics.py
+CREATE TABLE crawlstats (
+   site int NOT NULL REFERENCES sites(id) ON DELETE CASCADE,
+   started timestamptz NOT NULL,
+   finished timestamptz NOT NULL,
+   pages int NOT NULL,
+   bytes bigint NOT NULL,
+   stats jsonb NOT NULL,
+   PRIMARY KEY (site, started)
+);
+
 CREATE TABLE site_excludes (
    site int NOT NULL REFERENCES sites(id) ON DELETE CASCADE,
    suburlre varchar(512) NOT NULL